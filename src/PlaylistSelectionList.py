@@ -77,17 +77,12 @@ class PlaylistSelectionList(QFrame):
     
   
 
-  def _search_text_changed(self, text : str):
-    # Update selection with all of the playlists that match the text
-    
-    # Clear all visible choices
-    self._delete_layout_elements()
-
-    # Add only the ones that match
-    for plist in self._playlists:
-      regex_match = re.match(text, plist["name"])
-      if regex_match is not None:
-        self.add_element(plist)
+  def show_only(self, playlist_ids : List[int] | None):
+    # Update selection with only the playlists that matched the search
+    # Hiding instead of deleting keeps every element at the same index
+    visible = set(playlist_ids) if playlist_ids is not None else None
+    for element in self._selection_list:
+      element.setVisible(visible is None or element._id in visible)
 
   
   def add_element(self, playlist : Dict[str, Any]):
@@ -164,9 +159,9 @@ class PlaylistSelection(QFrame):
 
     # Saving in milliseconds simply to avoid carrying floats around
     # and it's easy to convert back into seconds, or work with pydub
-    self._length_ms  : int = self._data["total_duration"] * 1000
+    self._length_ms  : int = (self._data["total_duration"] or 0) * 1000
 
-    self._song_count : int = self._data["song_count"]
+    self._song_count : int = self._data["song_count"] or 0
 
     self._is_highlighted : bool = False    
     
@@ -199,7 +194,17 @@ class PlaylistSelection(QFrame):
     self._button_layout.setAlignment(Qt.AlignmentFlag.AlignRight)
     
     
+    # Straight from the playlist row, the triggers keep these up to date
+    self._length_label = QLabel()
+    self._length_label.setText(f"{util.seconds_to_length_text(self._length_ms // 1000)} length")
+
+    self._count_label = QLabel()
+    self._count_label.setText(f"{self._song_count:02d} songs")
+
     self._length_and_count_layout = QHBoxLayout()
+    self._length_and_count_layout.addWidget(self._length_label)
+    self._length_and_count_layout.addWidget(self._count_label)
+    self._length_and_count_layout.setAlignment(Qt.AlignmentFlag.AlignRight)
 
 
 
@@ -29,79 +29,154 @@ import utility as util
 import config
 import logging
 from typing import Dict, Any, Optional, Tuple, List
-from playlist import (PlayListContainer, PlaylistElement)
+from playlist import (PlayListContainer)
 from widgets import (MusicDownloadWidget, AudioPlayer, UIContainer) 
 from database import DatabaseConnection
+from async_database import AsyncDatabase
+from library_cache import LibraryCache
+from ingest import LibraryIngest, LibraryWatcher
 
 
 
 
 
 class MainApplication(QMainWindow):
+    _ingest_progress = Signal(int, int)
+
     def __init__(self):
         super().__init__()
 
         self._audio_player  = AudioPlayer()
-        self._db_connection = DatabaseConnection()
+        self._db_connection = DatabaseConnection(hash_mode=config.get_hash_mode(), pragmas=config.get_sqlite_pragmas())
+        self._library_cache  = LibraryCache(self._db_connection)
+        # Everything the handlers below ask of the database goes through this, so the window never waits on sqlite
+        self._async_db       = AsyncDatabase(self._db_connection)
+        self._db_tasks        : set[asyncio.Task]       = set()
+        self._latest_db_tasks : Dict[str, asyncio.Task] = {}
+        # Work that changes the library runs one at a time, in the order it was asked for
+        self._library_lock    = asyncio.Lock()
+        self._library_ingest = LibraryIngest(self._db_connection, progress_callback=self._report_ingest_progress)
         
         # Initialize UI with all playlists to show to the user
-        self._ui_container  = UIContainer(self, self._db_connection.get_all_playlists())
+        self._ui_container  = UIContainer(self, self._library_cache.get_all_playlists(), self._async_db)
         
 
+        self._ingest_progress.connect(self._show_ingest_progress)
         self._ui_container._play_song_signal.connect(self.handlePlayButtonClick)
         self._ui_container._new_songs_downloaded.connect(self.update_with_new_songs)
+        self._ui_container._downloads_running.connect(self._downloads_running)
         self._ui_container._request_songs_for_refresh.connect(self.send_playlist_songs_to_ui)
         self._ui_container._create_new_playlist_in_db.connect(self._create_new_playlist_in_db)
         self._ui_container._update_db_with_new_song_in_playlist.connect(self._add_new_song_to_playlist)
         self._ui_container._request_all_songs_to_add_to_playlist.connect(self._send_all_songs_to_AddSongWindow)
         self._ui_container._remove_song_from_playlist_signal.connect(self._db_connection.remove_song_from_playlist)
+        self._ui_container._request_playlist_search.connect(self._search_playlists)
+        self._ui_container._request_song_search.connect(self._search_songs)
+        # The player moving on to the next song by itself, the playlist highlights follow it
+        self._audio_player.track_changed.connect(self._ui_container._toggle_off_songs)
+
+        # Picks up files that were added/removed/renamed in the download folder outside of the app
+        self._library_watcher = LibraryWatcher(self._library_ingest, self._async_db)
+        self._library_watcher.library_changed.connect(lambda _: self.reload_current_playlist())
+        self._library_watcher.watch_directory(config.get_audio_download_dir())
 
         self.setCentralWidget(self._ui_container)
 
 
     def closeEvent(self, event):
-        self._audio_player._ensure_stopped()
+        self._audio_player.close()
+        self._async_db.close()
         event.accept()
 
-    def send_all_songs_to_ui(self):
-        self._ui_container.refresh_playlist(self._db_connection.get_all_songs())
+
+    def _spawn(self, coroutine, key : Optional[str] = None):
+        # Starts a handler's database work. A newer request with the same key replaces the
+        # older one, so e.g. search results for text that was already typed over never show up.
+        # Only reads get a key, cancelling something that changes the library would lose that change
+        task = asyncio.create_task(coroutine)
+        # The event loop only keeps weak references to tasks
+        self._db_tasks.add(task)
+        task.add_done_callback(self._db_tasks.discard)
+
+        if key is not None:
+            previous = self._latest_db_tasks.get(key)
+            if previous is not None and not previous.done():
+                previous.cancel()
+            self._latest_db_tasks[key] = task
+
+
+    def reload_current_playlist(self):
+        # The library changed (a download, or files changed on disk), whatever playlist is shown gets its songs again.
+        # Its own key, so it doesn't cancel a playlist that's being switched to, or get cancelled by one
+        playlist_id = self._ui_container.current_playlist_id()
+        if playlist_id is not None:
+            self._spawn(self._send_playlist_songs_to_ui(playlist_id), "library_refresh")
 
     def send_playlist_songs_to_ui(self, playlist_data : Dict[str, Any]):
-        songs = self._db_connection.get_songs_by_playlist_id(playlist_data.get('id', -1))
-        print(f"MAIN APP send_playlist_songs_to_ui: {songs}")
+        self._spawn(self._send_playlist_songs_to_ui(playlist_data.get('id', -1)), "playlist_songs")
 
+    async def _send_playlist_songs_to_ui(self, playlist_id : int):
+        songs = await self._async_db.run(self._library_cache.get_songs_by_playlist_id, playlist_id)
+        # Another playlist got picked while this one was loading
+        if self._ui_container.current_playlist_id() != playlist_id:
+            return
         self._ui_container.refresh_playlist(songs)
 
     def _send_all_songs_to_AddSongWindow(self, playlist_id : int):
-        songs = self._db_connection.get_songs_NOT_in_playlist_by_id(playlist_id)
+        self._spawn(self._send_all_songs_to_AddSongWindow_async(playlist_id), "add_song_window")
+
+    async def _send_all_songs_to_AddSongWindow_async(self, playlist_id : int):
+        songs = await self._async_db.get_songs_NOT_in_playlist_by_id(playlist_id)
         print(f"MAIN APP _send_all_songs_to_AddSongWindow: {songs}")
         self._ui_container.send_all_songs_to_playlist_container_for_addSongWindow(songs)
 
 
-    def update_with_new_songs(self, download_path : str):
+    def _search_playlists(self, text : str):
+        self._spawn(self._search_playlists_async(text), "playlist_search")
+
+    async def _search_playlists_async(self, text : str):
+        playlists = await self._async_db.search_playlists(text)
+        self._ui_container.show_playlist_search_results(text, [playlist["id"] for playlist in playlists])
+
+    def _search_songs(self, playlist_id : int, text : str, in_playlist : bool):
+        # The playlist's search bar and the add song window's are separate searches, neither cancels the other
+        self._spawn(self._search_songs_async(playlist_id, text, in_playlist), "song_search" if in_playlist else "add_song_search")
+
+    async def _search_songs_async(self, playlist_id : int, text : str, in_playlist : bool):
+        if in_playlist:
+            songs = await self._async_db.search_songs(text, playlist_id=playlist_id)
+        else:
+            songs = await self._async_db.search_songs(text, exclude_playlist_id=playlist_id)
+        self._ui_container.show_song_search_results(playlist_id, text, [song["id"] for song in songs], in_playlist)
+
+
+    def update_with_new_songs(self, files : List[Dict[str, Any]]):
         # At this point, new songs have been downloaded, but not yet added to the DB
-        # This function checks what new files have been added to the folder
-        # Could be reused to just add more songs
-
-        logging.debug(f"Update called with: {download_path}")
-
-        # Create a list of all the song locations
-        ### [Technically original_title, and file_path do the same thing, but this is just for semantics] 
-        all_current_songs = [song["file_path"] for song in self._db_connection.get_all_songs()]
-        # Look at the file location to find any new ones
-        for file in os.listdir(download_path):
-            logging.debug(f"checking file: {file}")
-            # If the file is an appropriate audio file
-
-            if os.path.splitext(file)[1] in [".wav", ".mp3", ".webm"]:
-                logging.debug("File valid format!")
-                # If it isn't already in the table
-                full_path = os.path.join(download_path, file)
-                if full_path not in all_current_songs:
-                    self._db_connection.create_song(full_path)
-                else:
-                    pass        
-        self.send_all_songs_to_ui()
+        # The downloader says exactly which files it made, so only those get added
+
+        logging.debug(f"Update called with {len(files)} downloaded files")
+        # No key, every download's files have to make it in
+        self._spawn(self._update_with_new_songs(files))
+
+    async def _update_with_new_songs(self, files : List[Dict[str, Any]]):
+        async with self._library_lock:
+            await self._async_db.run_background(self._library_ingest.ingest_downloads, files)
+        self.reload_current_playlist()
+
+    def _downloads_running(self, running : bool):
+        # Downloads add their own files, the watcher doesn't have to rescan for every one of them
+        if running:
+            self._library_watcher.pause()
+        else:
+            self._library_watcher.resume()
+
+
+    def _report_ingest_progress(self, processed : int, added : int):
+        # Ingest runs on its own thread, the signal hands this over to the UI thread
+        self._ingest_progress.emit(processed, added)
+
+    def _show_ingest_progress(self, processed : int, added : int):
+        self._ui_container._music_downloader.set_label(f"Added {added} new songs ({processed} files checked)")
 
 
     def handlePlayButtonClick(self, song_id : int, song_path : str):
@@ -126,20 +201,21 @@ class MainApplication(QMainWindow):
             self._audio_player._ensure_stopped()
             self._audio_player.set_source(song_id, song_path)
             self._audio_player.play_song()
+            # Whatever comes after it in the playlist gets loaded ahead of time
+            self._audio_player.set_queue(self._ui_container.upcoming_songs(song_id))
     
     
     def update_songs_directory(self, path : str):
         # The received path was through file dialogue, so it should be valid
         # First clear the database, since all of the information is now invalid
         logging.debug(f"Called update_songs_directory with : {path}")
-        self._db_connection.clear_all()
-        # For each file
-        for file in os.listdir(path):
-            # Get only the filename
-            filename = os.fsdecode(file)
-            # And add it along with the whole path to the database
-            self._db_connection.create_song(os.path.join(path, filename))
+        self._spawn(self._update_songs_directory(path))
 
+    async def _update_songs_directory(self, path : str):
+        async with self._library_lock:
+            await self._async_db.clear_all()
+            await self._async_db.run_background(self._library_ingest.ingest_directory, path)
+        self._library_watcher.watch_directory(path)
                     
     
     def set_audio_source(self, path : str):
@@ -151,9 +227,9 @@ class MainApplication(QMainWindow):
 
         all_names = []
         if is_song:
-            all_names = [song["user_title"] for song in self._db_connection.get_all_songs()]
+            all_names = self._library_cache.get_song_titles()
         else:
-            all_names = [playlist["name"] for playlist in self._db_connection.get_all_playlists()]
+            all_names = self._library_cache.get_playlist_names()
 
         pattern = r'^(.+) \((\d+)\)$'
         # Matched all text until parentheses into g1,
@@ -173,15 +249,21 @@ class MainApplication(QMainWindow):
 
 
     def _create_new_playlist_in_db(self):
-        playlist_id = self._db_connection.create_playlist(self._make_unique_name(False), "Add your description!")
+        # No key, every click should make a playlist
+        self._spawn(self._create_new_playlist_in_db_async())
+
+    async def _create_new_playlist_in_db_async(self):
+        name = await self._async_db.run(self._make_unique_name, False)
+        playlist_id = await self._async_db.create_playlist(name, "Add your description!")
         if playlist_id is None:
-            playlist_id = self._db_connection.create_playlist(self._make_unique_name(False, "Really untitled?"), "Add your description!")
+            name = await self._async_db.run(self._make_unique_name, False, "Really untitled?")
+            playlist_id = await self._async_db.create_playlist(name, "Add your description!")
         
         if playlist_id is None:
             raise RuntimeError("Attempting to create playlist resulted in an error!")
         
         # At this point, the playlist exists, so the information is passed on to the UI
-        playlist_info = self._db_connection.get_playlist(playlist_id)
+        playlist_info = await self._async_db.get_playlist(playlist_id)
         if playlist_info is None:
             raise RuntimeError("After playtlist creation, failuire to retrieve data from database!")
         self._ui_container.handle_new_playlist(playlist_info)
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from database import DatabaseConnection
+
+
+class AsyncDatabase:
+  """
+  Awaitable front for a DatabaseConnection, so the Qt event loop never sits in sqlite.
+
+  Every call runs on one dedicated thread, in the order it was made, and comes back as an
+  awaitable. Lock waits (up to the connection's 20 second timeout) and long queries only ever
+  block that thread. Any DatabaseConnection method can be called through this:
+
+      songs = await async_db.get_songs_by_playlist_id(playlist_id)
+
+  and anything else that should run on the database thread goes through run().
+
+  Long jobs (ingesting or rescanning a whole folder, which hash and probe every file) go through
+  run_background() instead. They get a thread of their own, so searches and playlist loads never
+  queue up behind an import. That thread has its own reader connection, and only takes the
+  writer lock for each batch it writes.
+  """
+
+  def __init__(self, db_connection : DatabaseConnection):
+    self._db_connection = db_connection
+    # A single worker keeps the calls in order, and means only one extra reader connection
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Database")
+    # One at a time too, two imports at once would just fight over the disk
+    self._background_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Ingest")
+
+
+  @property
+  def connection(self) -> DatabaseConnection:
+    """The DatabaseConnection itself, for code on threads of its own that's fine blocking on it"""
+    return self._db_connection
+
+
+  def submit(self, function : Callable[..., Any], *args, **kwargs) -> Future:
+    """Run `function` on the database thread. For callers outside of the event loop."""
+    return self._executor.submit(function, *args, **kwargs)
+
+
+  def run(self, function : Callable[..., Any], *args, **kwargs) -> Awaitable[Any]:
+    """Run `function` on the database thread, and await its result"""
+    return asyncio.wrap_future(self.submit(function, *args, **kwargs))
+
+
+  def run_background(self, function : Callable[..., Any], *args, **kwargs) -> Awaitable[Any]:
+    """Run a long job (see above) on the background thread, and await its result"""
+    return asyncio.wrap_future(self._background_executor.submit(function, *args, **kwargs))
+
+
+  def __getattr__(self, name : str) -> Callable[..., Awaitable[Any]]:
+    method = getattr(self._db_connection, name)
+    if not callable(method):
+      raise AttributeError(f"{name} is not a DatabaseConnection method")
+    return lambda *args, **kwargs: self.run(method, *args, **kwargs)
+
+
+  def close(self):
+    """Finish the calls already made, and stop the database threads"""
+    self._background_executor.shutdown(wait=True, cancel_futures=False)
+    self._executor.shutdown(wait=True, cancel_futures=False)
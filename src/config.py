@@ -9,6 +9,38 @@ config_obj = json.load(open(os.path.join(util.SOURCE_PATH, 'config.json'), 'r'))
 def get_audio_download_dir() -> str:
     return config_obj["audio_download_path"]
 
+def get_hash_mode() -> str:
+    # "full" or "fast", see hashing.HASH_MODES
+    return config_obj.get("hash_mode", "full")
+
+def get_download_workers() -> int:
+    # How many downloads run at the same time
+    return config_obj.get("download_workers", 2)
+
+def get_spotify_threads() -> int:
+    # How many tracks of a Spotify playlist spotdl downloads at the same time
+    return config_obj.get("spotify_threads", 4)
+
+def get_spotify_match_ttl() -> float:
+    # How long (in seconds) a Spotify track -> YouTube match is trusted, default is 30 days
+    return config_obj.get("spotify_match_ttl_days", 30) * 24 * 60 * 60
+
+def get_spotify_match_cache_size() -> int:
+    # How many matches are kept, the least recently used ones go first
+    return config_obj.get("spotify_match_cache_size", 5000)
+
+def get_storage_format() -> str:
+    # What downloads get stored as: "wav", "flac", "opus", "aac" or "copy", see transcode.STORAGE_FORMATS
+    return config_obj.get("storage_format", "wav")
+
+def get_transcode_workers() -> int:
+    # How many ffmpeg conversions run at the same time
+    return config_obj.get("transcode_workers", 2)
+
+def get_sqlite_pragmas() -> dict:
+    # Overrides for database.DEFAULT_PRAGMAS, e.g. {"cache_size": -131072, "mmap_size": 0}
+    return config_obj.get("sqlite_pragmas", {})
+
 def get_config_object() -> dict:
     return config_obj
 
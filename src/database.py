@@ -1,17 +1,116 @@
 import os
 import json
 import sqlite3
-import hashlib
 import threading
 import atexit
 import utility as util
-from typing import Dict, Any, Optional, Tuple, List
+from concurrent.futures import Future
+from write_queue import WriteBehindQueue
+from hashing import FileHasher
+from mylogger import global_logger
+import migrations
+from collections import namedtuple
+from typing import Dict, Any, Optional, Tuple, List, Iterator
+
+
+# ------ Records ------
+# Rows come back as these instead of dicts. They're tuples underneath (so they're small, and
+# made straight from the sqlite row), but can still be read like the dicts they replaced:
+# song.user_title, song["user_title"] and song.get("user_title") all work.
+
+SONG_COLUMNS = ("id", "file_path", "original_title", "user_title", "duration", "file_size", "file_hash",
+                "user_note", "date_added", "date_modified", "play_count", "sample_rate", "channels", "frames",
+                "source_url", "source_extractor", "source_id", "uploader", "thumbnail_url")
+PLAYLIST_COLUMNS = ("id", "name", "description", "date_created", "date_modified", "total_duration", "song_count")
+PLAYLIST_ENTRY_COLUMNS = ("id", "playlist_id", "song_id", "position", "date_added")
+DOWNLOAD_COLUMNS = ("id", "url", "source", "priority", "status", "attempts", "last_error", "date_added")
+
+
+class _Record:
+  __slots__ = ()
+
+  def __getitem__(self, key):
+    if isinstance(key, str):
+      try:
+        return getattr(self, key)
+      except AttributeError:
+        raise KeyError(key) from None
+    return tuple.__getitem__(self, key)
+
+  def get(self, key : str, default : Any = None) -> Any:
+    return getattr(self, key, default)
+
+  def keys(self) -> Tuple[str, ...]:
+    return self._fields
+
+  def to_dict(self) -> Dict[str, Any]:
+    return dict(zip(self._fields, self))
+
+  @classmethod
+  def from_row(cls, cursor : sqlite3.Cursor, row : tuple):
+    # Used as a sqlite3 row_factory, the query has to select columns in `_fields` order
+    return tuple.__new__(cls, row)
+
+  @classmethod
+  def select_columns(cls, table_alias : str) -> str:
+    return ", ".join(f"{table_alias}.{column}" for column in cls._fields)
+
+
+class Song(_Record, namedtuple("SongBase", SONG_COLUMNS)):
+  __slots__ = ()
+
+class Playlist(_Record, namedtuple("PlaylistBase", PLAYLIST_COLUMNS)):
+  __slots__ = ()
+
+class PlaylistEntry(_Record, namedtuple("PlaylistEntryBase", PLAYLIST_ENTRY_COLUMNS)):
+  __slots__ = ()
+
+class DownloadItem(_Record, namedtuple("DownloadItemBase", DOWNLOAD_COLUMNS)):
+  __slots__ = ()
+
+
+SONG_SELECT     = Song.select_columns("s")
+PLAYLIST_SELECT = Playlist.select_columns("p")
+
+
+# Performance settings applied to every connection. config.json can override any of them under "sqlite_pragmas"
+DEFAULT_PRAGMAS : Dict[str, Any] = {
+  "cache_size" : -65536,     # Negative means KiB, so 64 MB of page cache per connection
+  "mmap_size"  : 268435456,  # Read up to 256 MB of the file through memory mapping instead of read() calls
+  "temp_store" : "MEMORY",   # Sorts and temporary indexes stay off the disk
+}
+
+
+# Tables whose writes are counted by DatabaseConnection.generations()
+CACHED_TABLES = ("songs", "playlists", "playlists_songs")
+
 
 class DatabaseConnection:
-  def __init__(self, path_to_db : str = os.path.join(util.DATA_LOCATION, 'schema.db')):
+  def __init__(
+      self,
+      path_to_db : str = os.path.join(util.DATA_LOCATION, 'schema.db'),
+      hash_mode  : str = "full",
+      pragmas    : Dict[str, Any] | None = None):
     self.db_path = path_to_db
-    self._lock = threading.Lock()  # Thread safety
+    self._pragmas = self._validate_pragmas({**DEFAULT_PRAGMAS, **(pragmas or {})})
+    self._lock = threading.Lock()  # Thread safety, only ever held around the writer connection
     self._connection = self._create_connection() 
+
+    # Reads go through a connection per thread. With WAL they see the last committed
+    # state and never wait behind the writer, however long its transaction is
+    self._readers     = threading.local()
+    self._reader_list : List[sqlite3.Connection] = []
+    self._readers_lock = threading.Lock()
+
+    # Writes bump the generation of every table they touch, so caches (see library_cache.py)
+    # can tell whether what they hold is still current without asking sqlite
+    self._generations      : Dict[str, int] = dict.fromkeys(CACHED_TABLES, 0)
+    self._generations_lock = threading.Lock()
+    self._run_migrations()
+    self.hasher = FileHasher(self, hash_mode)
+
+    # Small, frequent writes (play counts, playlist edits) get batched up by this
+    self._write_queue = WriteBehindQueue(self._connection, self._lock, on_commit=lambda tables: self._bump_generations(*tables))
     
     # Ensure connection closes when app shuts down
     atexit.register(self.close)
@@ -29,9 +128,96 @@ class DatabaseConnection:
     connection.execute("PRAGMA foreign_keys = ON")
     connection.execute("PRAGMA journal_mode = WAL")
     connection.execute("PRAGMA synchronous = NORMAL")
+    self._apply_pragmas(connection)
     return connection
+
+
+  @staticmethod
+  def _validate_pragmas(pragmas : Dict[str, Any]) -> Dict[str, Any]:
+    # These end up formatted straight into PRAGMA statements, so only known names and plain values get through
+    for name, value in pragmas.items():
+      if name not in DEFAULT_PRAGMAS:
+        raise ValueError(f"Unsupported pragma: {name}")
+      if not isinstance(value, int) and not (isinstance(value, str) and value.isalnum()):
+        raise ValueError(f"Invalid value for pragma {name}: {value!r}")
+    return pragmas
+
+
+  def _apply_pragmas(self, connection : sqlite3.Connection):
+    for name, value in self._pragmas.items():
+      connection.execute(f"PRAGMA {name} = {value}")
   
 
+  # Counts and durations of every playlist, worked out from scratch
+  _PLAYLIST_AGGREGATES_QUERY = """
+    SELECT p.id, COUNT(s.id), COALESCE(SUM(s.duration), 0)
+    FROM playlists p
+    LEFT JOIN playlists_songs ps ON ps.playlist_id = p.id
+    LEFT JOIN songs s ON s.id = ps.song_id
+    GROUP BY p.id
+  """
+
+  def _run_migrations(self):
+    with self._lock:
+      before, after = migrations.migrate(self.get_connection())
+    if before != after:
+      global_logger.info(f"Database schema upgraded from version {before} to {after}")
+      for name, plan in self.check_query_plans().items():
+        global_logger.warning(f"Query {name} scans a whole table: {plan}")
+
+
+  _PLAYLIST_SONGS_QUERY = f"""
+        SELECT {SONG_SELECT}
+        FROM playlists_songs ps
+        JOIN songs s on s.id = ps.song_id
+        WHERE ps.playlist_id = ?
+        ORDER BY ps.position
+      """
+
+  # The queries that run all the time, and have to stay on an index as the schema changes.
+  # Parameters only need the right types, EXPLAIN QUERY PLAN doesn't look at the values
+  _HOT_QUERIES : Dict[str, Tuple[str, tuple]] = {
+    "song_by_id"          : (f"SELECT {SONG_SELECT} FROM songs s WHERE s.id = ?", (0,)),
+    "song_by_path"        : ("SELECT id FROM songs WHERE file_path = ?", ("",)),
+    "songs_by_hash"       : (f"SELECT {SONG_SELECT} FROM songs s WHERE s.file_hash = ?", ("",)),
+    "playlist_songs"      : (_PLAYLIST_SONGS_QUERY, (0,)),
+    "playlists_of_song"   : ("SELECT playlist_id FROM playlists_songs WHERE song_id = ?", (0,)),
+    "song_position"       : ("SELECT position FROM playlists_songs WHERE playlist_id = ? AND song_id = ?", (0, 0)),
+    "playlist_end"        : ("SELECT COALESCE(MAX(position), 0) FROM playlists_songs WHERE playlist_id = ?", (0,)),
+    "cached_hash"         : ("SELECT file_hash FROM hash_cache WHERE device = ? AND inode = ? AND file_size = ? AND mtime_ns = ? AND mode = ?", (0, 0, 0, 0, "")),
+    "song_by_source"      : ("SELECT id FROM songs WHERE source_extractor = ? AND source_id = ?", ("", "")),
+    "source_ids"          : ("SELECT source_id FROM songs WHERE source_extractor = ? AND source_id IS NOT NULL", ("",)),
+    "spotify_match"       : ("SELECT download_url, song_json FROM spotify_matches WHERE track_id = ? AND fetched_at > ?", ("", 0)),
+    "song_search"         : ("SELECT rowid FROM songs_fts WHERE songs_fts MATCH ? ORDER BY bm25(songs_fts, 10.0, 5.0, 1.0)", ("a*",)),
+  }
+
+  def check_query_plans(self) -> Dict[str, List[str]]:
+    """Run EXPLAIN QUERY PLAN on every hot query. Returns the plan of each one that does a full table scan."""
+    cursor = self._cursor()
+    offenders = {}
+    for name, (query, params) in self._HOT_QUERIES.items():
+      cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)
+      plan = [row[3] for row in cursor.fetchall()]
+      # Virtual tables (FTS) report a SCAN even when they use their own index
+      if any(step.startswith("SCAN ") and "VIRTUAL TABLE" not in step for step in plan):
+        offenders[name] = plan
+    return offenders
+
+
+  def generations(self, *tables : str) -> Tuple[int, ...]:
+    """Current write generation of each of `tables`"""
+    with self._generations_lock:
+      return tuple(self._generations[table] for table in tables)
+
+
+  def _bump_generations(self, *tables : str):
+    # Called after the commit, so a reader that saw the old generation never gets the old data labelled as new
+    with self._generations_lock:
+      for table in tables:
+        if table in self._generations:
+          self._generations[table] += 1
+
+
   def get_connection(self) -> sqlite3.Connection:
     """Get the persistent connection"""
     if self._connection is None:
@@ -39,120 +225,486 @@ class DatabaseConnection:
     return self._connection
 
 
+  def _create_reader_connection(self) -> sqlite3.Connection:
+    connection = sqlite3.connect(
+      self.db_path,
+      check_same_thread=False,  # Only used by the thread that made it, but close() runs elsewhere
+      timeout=20.0
+    )
+    connection.execute("PRAGMA query_only = ON")
+    self._apply_pragmas(connection)
+    return connection
+
+
+  def get_read_connection(self) -> sqlite3.Connection:
+    """Get the calling thread's read-only connection, creating it on first use"""
+    connection = getattr(self._readers, "connection", None)
+    if connection is None:
+      connection = self._create_reader_connection()
+      self._readers.connection = connection
+      with self._readers_lock:
+        self._reader_list.append(connection)
+    return connection
+
+
+  def _cursor(self, record_type : type | None = None) -> sqlite3.Cursor:
+    """New cursor on this thread's reader connection, whose rows come back as `record_type`"""
+    cursor = self.get_read_connection().cursor()
+    if record_type is not None:
+      cursor.row_factory = record_type.from_row
+    return cursor
+
+
+  def flush(self, wait : bool = True) -> Future:
+    """Commit every queued write now. Blocks until it's on disk unless `wait` is False,
+    and raises if the batch failed to write."""
+    future = self._write_queue.flush()
+    if wait:
+      future.result()
+    return future
+
+
   def close(self):
-    if self.get_connection():
-      self.get_connection().close()
+    # Queued writes go in before anything gets closed. The queue stays around, so writes
+    # after this get a future that failed with a "closed" error rather than an AttributeError
+    self._write_queue.close()
+
+    with self._readers_lock:
+      for reader in self._reader_list:
+        reader.close()
+      self._reader_list = []
+    self._readers = threading.local()
+
+    if self._connection is not None:
+      # Lets sqlite refresh the planner statistics of whatever this session queried a lot
+      try:
+        self._connection.execute("PRAGMA optimize")
+      except sqlite3.Error as e:
+        global_logger.warning(f"PRAGMA optimize failed: {e}")
+      self._connection.close()
       self._connection = None
 
 
   def create_song(
       self,
-      path_to_song   : str,
-      original_title : str = "",
-      user_title     : str = "",
-      duration       : int = 0,
-      note           : str = "") -> Optional[int]:
-    """Add a new song to the database. Returns song ID."""
-    with self._lock:
-      if not os.path.exists(path_to_song):
-        raise FileNotFoundError(f"File not found: {path_to_song}")
+      path_to_song     : str,
+      original_title   : str = "",
+      user_title       : str = "",
+      duration         : int = 0,
+      note             : str = "",
+      stream_info      : Dict[str, Any] | None = None,
+      source_url       : str | None = None,
+      source_extractor : str | None = None,
+      source_id        : str | None = None,
+      uploader         : str | None = None,
+      thumbnail_url    : str | None = None) -> Optional[int]:
+    """Add a new song to the database. Returns song ID.
+    `stream_info` is the output of `util.probe_audio_file()`, and is probed here if not given.
+    The source_ arguments say where a downloaded song came from, and uploader/thumbnail_url what
+    the site said about it. If the file is already in the table, only those get filled in."""
+    if not os.path.exists(path_to_song):
+      raise FileNotFoundError(f"File not found: {path_to_song}")
 
-      file_size = os.path.getsize(path_to_song)
-      file_hash = self._get_song_hash(path_to_song)
+    # Reading the file happens outside of the lock, nothing else has to wait on the disk
+    file_size = os.path.getsize(path_to_song)
+    file_hash = self.hasher.hash_file(path_to_song)
+    if stream_info is None:
+      stream_info = util.probe_audio_file(path_to_song)
+
+    with self._lock:
 
       cursor = self.get_connection().cursor()
 
 
       cursor.execute(
       "INSERT INTO songs (file_path, original_title, user_title," \
-      "duration, file_size, file_hash, user_note, date_added, date_modified)" \
+      "duration, file_size, file_hash, user_note, sample_rate, channels, frames," \
+      "source_url, source_extractor, source_id, uploader, thumbnail_url, date_added, date_modified)" \
       "VALUES"
-      "(?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)",
+      "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)" \
+      "ON CONFLICT(file_path) DO UPDATE SET source_url = COALESCE(excluded.source_url, source_url)," \
+      "source_extractor = COALESCE(excluded.source_extractor, source_extractor), source_id = COALESCE(excluded.source_id, source_id)," \
+      "uploader = COALESCE(excluded.uploader, uploader), thumbnail_url = COALESCE(excluded.thumbnail_url, thumbnail_url)" \
+      "RETURNING id",
         (
         path_to_song,
         original_title if len(original_title) > 0 else os.path.basename(path_to_song),
         user_title if len(user_title) > 0 else os.path.basename(path_to_song),
-        duration,
+        duration if duration > 0 else stream_info["duration"],
         file_size,
         file_hash,
-        note
+        note,
+        stream_info["sample_rate"],
+        stream_info["channels"],
+        stream_info["frames"],
+        source_url,
+        source_extractor,
+        source_id,
+        uploader,
+        thumbnail_url
         )
     )
+      song_id = cursor.fetchone()[0]
       
-    self.get_connection().commit()
-    return cursor.lastrowid
+      self.get_connection().commit()
+      self._bump_generations("songs")
+      return song_id
+
+
+  def get_song_ids_by_source(self, sources : List[Tuple[str, str]]) -> Dict[Tuple[str, str], int]:
+    """Look up songs by (source_extractor, source_id). Sources that aren't in the library are left out."""
+    cursor = self._cursor()
+    found = {}
+    for source in sources:
+      cursor.execute("SELECT id FROM songs WHERE source_extractor = ? AND source_id = ?", source)
+      row = cursor.fetchone()
+      if row:
+        found[source] = row[0]
+    return found
+
+
+  def get_source_ids(self, source_extractor : str) -> set[str]:
+    """Every source_id from one extractor, for skipping the known entries of a whole playlist at once"""
+    cursor = self._cursor()
+    cursor.execute("SELECT source_id FROM songs WHERE source_extractor = ? AND source_id IS NOT NULL", (source_extractor,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+  # Columns expected in every dict passed into create_songs()
+  _SONG_INSERT_COLUMNS = ("file_path", "original_title", "user_title", "duration", "file_size",
+                          "file_hash", "user_note", "sample_rate", "channels", "frames")
+  # Only downloaded songs know these, they're NULL for everything else
+  _SONG_SOURCE_COLUMNS = ("source_url", "source_extractor", "source_id", "uploader", "thumbnail_url")
+
+  def create_songs(self, songs : List[Dict[str, Any]]) -> int:
+    """Add many already hashed/probed songs in a single transaction.
+    Songs whose file_path is already in the table are skipped, apart from filling in
+    any of the _SONG_SOURCE_COLUMNS they're missing. Returns the amount added."""
+    if len(songs) == 0:
+      return 0
+
+    insert_columns = self._SONG_INSERT_COLUMNS + self._SONG_SOURCE_COLUMNS
+    columns      = ", ".join(insert_columns)
+    placeholders = ", ".join(f":{c}" for c in insert_columns)
+    songs = [{**dict.fromkeys(self._SONG_SOURCE_COLUMNS), **song} for song in songs]
+    with self._lock:
+      cursor = self.get_connection().cursor()
+      cursor.executemany(f"INSERT OR IGNORE INTO songs ({columns}) VALUES ({placeholders})", songs)
+      added = cursor.rowcount
+
+      # A download that landed on a file the library already had
+      sourced = [song for song in songs if song["source_id"] is not None]
+      cursor.executemany(f"""
+          UPDATE OR IGNORE songs SET {", ".join(f"{c} = COALESCE({c}, :{c})" for c in self._SONG_SOURCE_COLUMNS)}
+          WHERE file_path = :file_path AND source_id IS NULL
+        """, sourced)
+
+      # Rows that come with a stat() result also get their fingerprint recorded
+      fingerprinted = [song for song in songs if "inode" in song]
+      cursor.executemany("""
+          INSERT OR REPLACE INTO file_fingerprints (song_id, inode, file_size, mtime_ns)
+          SELECT id, :inode, :file_size, :mtime_ns FROM songs WHERE file_path = :file_path
+        """, fingerprinted)
+      self.get_connection().commit()
+      self._bump_generations("songs")
+      return added
+
+
+  def get_song_fingerprints(self) -> Dict[str, Tuple[int, int | None, int | None, int | None]]:
+    """Maps every song's file_path to (song_id, inode, file_size, mtime_ns).
+    The last three are None for songs that haven't been fingerprinted yet."""
+    cursor = self._cursor()
+    cursor.execute("""
+        SELECT s.file_path, s.id, f.inode, f.file_size, f.mtime_ns
+        FROM songs s
+        LEFT JOIN file_fingerprints f ON f.song_id = s.id
+      """)
+    return {row[0] : row[1:] for row in cursor.fetchall()}
+
+
+  def set_song_fingerprints(self, fingerprints : List[Tuple[int, int, int, int]]):
+    """Record (song_id, inode, file_size, mtime_ns) for each song"""
+    with self._lock:
+      cursor = self.get_connection().cursor()
+      cursor.executemany("""
+          INSERT OR REPLACE INTO file_fingerprints (song_id, inode, file_size, mtime_ns)
+          VALUES (?, ?, ?, ?)
+        """, fingerprints)
+      self.get_connection().commit()
+
+
+  def update_songs_file_info(self, songs : List[Dict[str, Any]]) -> int:
+    """Refresh the file derived columns (and fingerprint) of songs whose file changed on disk.
+    Each dict needs `id` on top of the keys create_songs() expects. Returns the amount updated."""
+    with self._lock:
+      cursor = self.get_connection().cursor()
+      cursor.executemany("""
+          UPDATE songs
+          SET file_size = :file_size, file_hash = :file_hash, duration = :duration,
+              sample_rate = :sample_rate, channels = :channels, frames = :frames
+          WHERE id = :id
+        """, songs)
+      updated = cursor.rowcount
+      cursor.executemany("""
+          INSERT OR REPLACE INTO file_fingerprints (song_id, inode, file_size, mtime_ns)
+          VALUES (:id, :inode, :file_size, :mtime_ns)
+        """, songs)
+      self.get_connection().commit()
+      self._bump_generations("songs", "playlists")
+      return updated
+
+
+  def rename_songs(self, renames : List[Tuple[int, str, int, int, int]]) -> int:
+    """Point songs at their new file path after a move/rename.
+    Takes (song_id, new_path, inode, file_size, mtime_ns). Returns the amount renamed."""
+    with self._lock:
+      cursor = self.get_connection().cursor()
+      cursor.executemany("UPDATE songs SET file_path = ? WHERE id = ?",
+                         [(new_path, song_id) for song_id, new_path, *_ in renames])
+      renamed = cursor.rowcount
+      cursor.executemany("""
+          INSERT OR REPLACE INTO file_fingerprints (song_id, inode, file_size, mtime_ns)
+          VALUES (?, ?, ?, ?)
+        """, [(song_id, inode, size, mtime) for song_id, _, inode, size, mtime in renames])
+      self.get_connection().commit()
+      self._bump_generations("songs")
+      return renamed
+
+
+  def get_cached_hashes(self, keys : List[Tuple[int, int, int, int]], mode : str) -> Dict[Tuple[int, int, int, int], str]:
+    """Look up cached hashes by (device, inode, file_size, mtime_ns). Keys without a cached hash are left out."""
+    cursor = self._cursor()
+    cached = {}
+    for key in keys:
+      cursor.execute("""
+          SELECT file_hash FROM hash_cache
+          WHERE device = ? AND inode = ? AND file_size = ? AND mtime_ns = ? AND mode = ?
+        """, (*key, mode))
+      row = cursor.fetchone()
+      if row:
+        cached[key] = row[0]
+    return cached
+
+
+  def cache_hashes(self, entries : List[Tuple[int, int, int, int, str, str]]):
+    """Store (device, inode, file_size, mtime_ns, mode, file_hash) entries in the hash cache"""
+    if len(entries) == 0:
+      return
+    with self._lock:
+      self.get_connection().executemany("INSERT OR REPLACE INTO hash_cache VALUES (?, ?, ?, ?, ?, ?)", entries)
+      self.get_connection().commit()
+
+
+  def prune_hash_cache(self) -> int:
+    """Drop cached hashes no song has anymore (deleted or changed files). Returns the amount dropped."""
+    with self._lock:
+      removed = self._prune_hash_cache(self.get_connection().cursor())
+      self.get_connection().commit()
+      return removed
+
+
+  @staticmethod
+  def _prune_hash_cache(cursor : sqlite3.Cursor) -> int:
+    cursor.execute("""
+        DELETE FROM hash_cache
+        WHERE file_hash NOT IN (SELECT file_hash FROM songs WHERE file_hash IS NOT NULL)
+      """)
+    return cursor.rowcount
+
+
+  def get_spotify_matches(self, track_ids : List[str], fetched_after : int, now : int) -> Dict[str, Tuple[str, str]]:
+    """Look up cached matches fetched after `fetched_after`, as track_id -> (download_url, song_json).
+    Every hit gets its last_used set to `now`."""
+    cursor = self._cursor()
+    found = {}
+    for track_id in track_ids:
+      cursor.execute("""
+          SELECT download_url, song_json FROM spotify_matches
+          WHERE track_id = ? AND fetched_at > ?
+        """, (track_id, fetched_after))
+      row = cursor.fetchone()
+      if row:
+        found[track_id] = row
+    if len(found) > 0:
+      with self._lock:
+        self.get_connection().executemany("UPDATE spotify_matches SET last_used = ? WHERE track_id = ?",
+                                          [(now, track_id) for track_id in found])
+        self.get_connection().commit()
+    return found
+
+
+  def cache_spotify_matches(self, entries : List[Tuple[str, str, str]], now : int, max_entries : int, expire_before : int):
+    """Store (track_id, download_url, song_json) entries, then drop expired ones and
+    the least recently used ones past `max_entries`"""
+    with self._lock:
+      cursor = self.get_connection().cursor()
+      cursor.executemany("INSERT OR REPLACE INTO spotify_matches VALUES (?, ?, ?, ?, ?)",
+                         [(*entry, now, now) for entry in entries])
+      cursor.execute("DELETE FROM spotify_matches WHERE fetched_at <= ?", (expire_before,))
+      cursor.execute("""
+          DELETE FROM spotify_matches WHERE track_id IN (
+            SELECT track_id FROM spotify_matches ORDER BY last_used DESC, fetched_at DESC LIMIT -1 OFFSET ?)
+        """, (max_entries,))
+      self.get_connection().commit()
+
+
+  def delete_songs(self, song_ids : List[int]) -> int:
+    """Delete many songs (and their playlist entries) in one transaction. Returns the amount deleted."""
+    # Queued writes to these songs came in first, so they go in first.
+    # If they fail, that's on their own futures, not on this delete
+    self._write_queue.flush().exception()
+    with self._lock:
+      cursor = self.get_connection().cursor()
+      cursor.executemany("DELETE FROM songs WHERE id = ?", [(song_id,) for song_id in song_ids])
+      deleted = cursor.rowcount
+      self._prune_hash_cache(cursor)
+      self.get_connection().commit()
+      self._bump_generations("songs", "playlists", "playlists_songs")
+      return deleted
+
+
+  def get_all_song_paths(self) -> set[str]:
+    """Every file_path in the songs table, for cheap membership checks"""
+    cursor = self._cursor()
+    cursor.execute("SELECT file_path FROM songs")
+    return {row[0] for row in cursor.fetchall()}
 
 
   def get_song(
     self,
-    song_id : int) -> Optional[Dict[str, Any]]:
-    cursor = self.get_connection().cursor()
-    cursor.execute("SELECT * FROM songs WHERE id = ?", (song_id,))
-    row = cursor.fetchone()
-
-    if row:
-      columns = [desc[0] for desc in cursor.description]
-      return dict(zip(columns, row))
-    return None
+    song_id : int) -> Optional[Song]:
+    cursor = self._cursor(Song)
+    cursor.execute(f"SELECT {SONG_SELECT} FROM songs s WHERE s.id = ?", (song_id,))
+    return cursor.fetchone()
 
 
   def get_songs_by_title(
     self,
     title : str,
     exact_match : bool = False
-  ) -> List[Dict[str, Any]]:
+  ) -> List[Song]:
    """Search songs by title (user_title or original_title)"""
-   cursor = self.get_connection().cursor()
+   cursor = self._cursor(Song)
    statement = f"""
-      SELECT * FROM songs
+      SELECT {SONG_SELECT} FROM songs s
       WHERE user_title {"=" if exact_match else "LIKE"} ? OR original_title {"=" if exact_match else "LIKE"} ?
     """
-   if exact_match:
+   if not exact_match:
      title = f"%{title}%"
     
    cursor.execute(statement, (title, title))
-   columns = [desc[0] for desc in cursor.description]
-   return [dict(zip(columns, row)) for row in cursor.fetchall()]
+   return cursor.fetchall()
+
+
+  @staticmethod
+  def _to_fts_query(text : str) -> str:
+    # Every word has to match, and the last one can be half typed. Each word is quoted
+    # so things like '-' or 'AND' in a title don't get parsed as FTS syntax
+    terms = [term.replace('"', '""') for term in text.split()]
+    return " ".join(f'"{term}"*' for term in terms if len(term) > 0)
+
+
+  def search_songs(
+    self,
+    text                : str,
+    limit               : int = -1,
+    playlist_id         : int | None = None,
+    exclude_playlist_id : int | None = None
+  ) -> List[Song]:
+    """Full text search over user_title, original_title and user_note, best matches first.
+    Can be narrowed down to songs in (or not in) a playlist. A limit of -1 returns everything."""
+    query = self._to_fts_query(text)
+    if len(query) == 0:
+      return []
+
+    filters = ""
+    params : List[Any] = [query]
+    if playlist_id is not None:
+      filters += " AND EXISTS (SELECT 1 FROM playlists_songs ps WHERE ps.song_id = s.id AND ps.playlist_id = ?)"
+      params.append(playlist_id)
+    if exclude_playlist_id is not None:
+      filters += " AND NOT EXISTS (SELECT 1 FROM playlists_songs ps WHERE ps.song_id = s.id AND ps.playlist_id = ?)"
+      params.append(exclude_playlist_id)
+    params.append(limit)
+
+    cursor = self._cursor(Song)
+    # Title matches are worth a lot more than a word somewhere in the note
+    cursor.execute(f"""
+        SELECT {SONG_SELECT}
+        FROM songs_fts
+        JOIN songs s ON s.id = songs_fts.rowid
+        WHERE songs_fts MATCH ?{filters}
+        ORDER BY bm25(songs_fts, 10.0, 5.0, 1.0)
+        LIMIT ?
+      """, params)
+    return cursor.fetchall()
+
+
+  def search_playlists(
+    self,
+    text  : str,
+    limit : int = -1
+  ) -> List[Playlist]:
+    """Full text search over playlist names, best matches first"""
+    query = self._to_fts_query(text)
+    if len(query) == 0:
+      return []
+
+    cursor = self._cursor(Playlist)
+    cursor.execute(f"""
+        SELECT {PLAYLIST_SELECT}
+        FROM playlists_fts
+        JOIN playlists p ON p.id = playlists_fts.rowid
+        WHERE playlists_fts MATCH ?
+        ORDER BY rank
+        LIMIT ?
+      """, (query, limit))
+    return cursor.fetchall()
 
 
   def get_songs_by_playlist_title(
       self,
       playlist_title : str 
-  ):
-    cursor = self.get_connection().cursor()
-    cursor.execute("""
-        SELECT s.*
+  ) -> List[Song]:
+    cursor = self._cursor(Song)
+    cursor.execute(f"""
+        SELECT {SONG_SELECT}
         FROM songs s
         JOIN playlists_songs ps on s.id = ps.song_id
         JOIN playlists p on ps.playlist_id = p.id
         WHERE p.name = ?
+        ORDER BY ps.position
       """, (playlist_title,))
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    return cursor.fetchall()
 
 
   def get_songs_by_playlist_id(
       self,
       playlist_id : int
-  ) -> List[Dict[str, Any]]:
-    cursor = self.get_connection().cursor()
-    cursor.execute("""
-        SELECT s.*
-        FROM songs s
-        JOIN playlists_songs ps on s.id = ps.song_id
-        JOIN playlists p on ps.playlist_id = p.id
-        WHERE p.id = ?
-      """, (playlist_id,))
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+  ) -> List[Song]:
+    cursor = self._cursor(Song)
+    cursor.execute(self._PLAYLIST_SONGS_QUERY, (playlist_id,))
+    return cursor.fetchall()
+
+
+  def iter_playlist_songs(
+      self,
+      playlist_id : int,
+      batch_size  : int = 500
+  ) -> Iterator[Song]:
+    """Same as get_songs_by_playlist_id(), but streamed in batches"""
+    cursor = self._cursor(Song)
+    cursor.execute(self._PLAYLIST_SONGS_QUERY, (playlist_id,))
+    yield from self._iter_cursor(cursor, batch_size)
+
 
   def get_songs_NOT_in_playlist_by_id(
       self,
       playlist_id : int
-  ) -> List[Dict[str, Any]]:
-    cursor = self.get_connection().cursor()
-    cursor.execute("""
-        SELECT s.*
+  ) -> List[Song]:
+    cursor = self._cursor(Song)
+    cursor.execute(f"""
+        SELECT {SONG_SELECT}
         FROM songs s
         WHERE NOT EXISTS (
           SELECT 1
@@ -161,59 +713,87 @@ class DatabaseConnection:
           AND ps.playlist_id = ?
         )
       """, (playlist_id,))
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    return cursor.fetchall()
 
 
-  def get_all_songs(self) -> List[Dict[str, Any]]:
-    cursor = self.get_connection().cursor()
-    cursor.execute("SELECT * from songs ORDER BY user_title")
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+  def get_all_songs(self) -> List[Song]:
+    cursor = self._cursor(Song)
+    cursor.execute(f"SELECT {SONG_SELECT} from songs s ORDER BY s.user_title")
+    return cursor.fetchall()
 
 
-  def update_song(self, song_id: int, **kwargs) -> bool:
-    """Update song fields. Returns True if updated, False if song not found."""
-    allowed_fields = {'original_title', 'user_title', 'duration', 'user_note', 'play_count'}
+  def iter_songs(self, batch_size : int = 500) -> Iterator[Song]:
+    """Same as get_all_songs(), but streamed in batches, so the caller can start on
+    the first songs without the whole table sitting in memory"""
+    cursor = self._cursor(Song)
+    cursor.execute(f"SELECT {SONG_SELECT} from songs s ORDER BY s.user_title")
+    yield from self._iter_cursor(cursor, batch_size)
+
+
+  def get_playlist_entries(self, playlist_id : int) -> List[PlaylistEntry]:
+    """The rows of playlists_songs for a playlist, in position order"""
+    cursor = self._cursor(PlaylistEntry)
+    cursor.execute(f"""
+        SELECT {PlaylistEntry.select_columns("ps")}
+        FROM playlists_songs ps
+        WHERE ps.playlist_id = ?
+        ORDER BY ps.position
+      """, (playlist_id,))
+    return cursor.fetchall()
+
+
+  @staticmethod
+  def _iter_cursor(cursor : sqlite3.Cursor, batch_size : int) -> Iterator[Any]:
+    try:
+      while (batch := cursor.fetchmany(batch_size)):
+        yield from batch
+    finally:
+      cursor.close()
+
+
+  def update_song(self, song_id: int, **kwargs) -> Future:
+    """Queue an update of song fields. The future resolves to True if updated,
+    False if song not found (or no valid fields were given)."""
+    allowed_fields = {'original_title', 'user_title', 'duration', 'user_note', 'play_count',
+                      'sample_rate', 'channels', 'frames'}
     updates = {k: v for k, v in kwargs.items() if k in allowed_fields}
     
     if not updates:
-      return False
-        
-    with self._lock:
-      set_clause = ", ".join([f"{k} = ?" for k in updates.keys()])
-      cursor = self.get_connection().cursor()
-      cursor.execute(f"UPDATE songs SET {set_clause} WHERE id = ?", 
-                     list(updates.values()) + [song_id])
-      self.get_connection().commit()
-      return cursor.rowcount > 0
+      future = Future()
+      future.set_result(False)
+      return future
+
+    return self._write_queue.update_song(song_id, updates)
   
 
   def delete_song(
       self,
       song_id : int) -> bool:
-     """Delete a song and remove from all playlists. Returns True if deleted."""
-     with self._lock:
+    """Delete a song and remove from all playlists. Returns True if deleted."""
+    # Queued writes to this song came in first, so they go in first.
+    # If they fail, that's on their own futures, not on this delete
+    self._write_queue.flush().exception()
+    with self._lock:
       cursor = self.get_connection().cursor()
       cursor.execute("DELETE FROM songs WHERE id = ?", (song_id,))
+      deleted = cursor.rowcount > 0
+      self._prune_hash_cache(cursor)
       self.get_connection().commit()
-      return cursor.rowcount > 0
-    
+      self._bump_generations("songs", "playlists", "playlists_songs")
+      return deleted
+
+
   # Since this will be one of the more often update operations,
   # I decided to put it in its own function
-  def increment_play_count(self, song_id: int) -> bool:
-    """Increment the play count for a song"""
-    with self._lock:
-      cursor = self.get_connection().cursor()
-      cursor.execute("UPDATE songs SET play_count = play_count + 1 WHERE id = ?", (song_id,))
-      self.get_connection().commit()
-      return cursor.rowcount > 0
+  def increment_play_count(self, song_id: int) -> Future:
+    """Queue a play count increment for a song. The future resolves to True once written."""
+    return self._write_queue.increment_play_count(song_id)
 
 
   # To be used later with self.delete_song()
-  def find_duplicates(self) -> List[List[Dict[str, Any]]]:
+  def find_duplicates(self) -> List[List[Song]]:
     """Find songs with the same file hash (potential duplicates)"""
-    cursor = self.get_connection().cursor()
+    cursor = self._cursor()
     cursor.execute("""
         SELECT file_hash, COUNT(*) as count 
         FROM songs 
@@ -223,11 +803,10 @@ class DatabaseConnection:
     """)
     
     duplicate_groups = []
+    song_cursor = self._cursor(Song)
     for hash_value, _ in cursor.fetchall():
-      cursor.execute("SELECT * FROM songs WHERE file_hash = ?", (hash_value,))
-      columns = [desc[0] for desc in cursor.description]
-      group = [dict(zip(columns, row)) for row in cursor.fetchall()]
-      duplicate_groups.append(group)
+      song_cursor.execute(f"SELECT {SONG_SELECT} FROM songs s WHERE s.file_hash = ?", (hash_value,))
+      duplicate_groups.append(song_cursor.fetchall())
   
     return duplicate_groups
 
@@ -240,14 +819,17 @@ class DatabaseConnection:
       print(f"New path ({new_path}) doesn't exist")
       return
     
-    cursor = self.get_connection().cursor()
+    with self._lock:
+      cursor = self.get_connection().cursor()
 
-    # Assume to change all paths:
-    if old_path is None:
-      cursor.execute("UPDATE songs SET file_path = ?", (new_path))
-    
-    else:
-      cursor.execute("UPDATE songs SET file_path = ? WHERE file_path = ?", (new_path, old_path))
+      # Assume to change all paths:
+      if old_path is None:
+        cursor.execute("UPDATE songs SET file_path = ?", (new_path,))
+      
+      else:
+        cursor.execute("UPDATE songs SET file_path = ? WHERE file_path = ?", (new_path, old_path))
+      self.get_connection().commit()
+      self._bump_generations("songs")
 
 
   def create_playlist(
@@ -260,102 +842,274 @@ class DatabaseConnection:
       cursor = self.get_connection().cursor()
       cursor.execute("INSERT INTO playlists (name, description) VALUES (?, ?)", (name, description))
       self.get_connection().commit()
+      self._bump_generations("playlists")
       return cursor.lastrowid
 
 
   def get_playlist(
     self,
     playlist_id : int
-  ) -> Optional[Dict[str, Any]]:
-    cursor = self.get_connection().cursor()
-    cursor.execute("SELECT * FROM playlists WHERE id = ?", (playlist_id,))
-    row = cursor.fetchone()
+  ) -> Optional[Playlist]:
+    cursor = self._cursor(Playlist)
+    cursor.execute(f"SELECT {PLAYLIST_SELECT} FROM playlists p WHERE p.id = ?", (playlist_id,))
+    return cursor.fetchone()
 
-    if row:
-      columns = [desc[0] for desc in cursor.description]
-      return dict(zip(columns, row))
-    return None
 
-
-  def get_all_playlists(self) -> List[Dict[str, Any]]:
-    cursor = self.get_connection().cursor()
-    cursor.execute("SELECT * from playlists ORDER BY name")
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+  def get_all_playlists(self) -> List[Playlist]:
+    cursor = self._cursor(Playlist)
+    cursor.execute(f"SELECT {PLAYLIST_SELECT} from playlists p ORDER BY p.name")
+    return cursor.fetchall()
 
   
   def update_playlist(self, playlist_id: int, **kwargs) -> bool:
     """Update playlist fields. Returns True if updated, False if playlist not found."""
-    allowed_fields = {'name', 'description', 'total_duration', 'song_count'}
+    # total_duration and song_count are kept up to date by triggers, see recompute_playlist_aggregates()
+    allowed_fields = {'name', 'description'}
     updates = {k: v for k, v in kwargs.items() if k in allowed_fields}
-    
+
     if not updates:
       return False
-        
+
     with self._lock:
       set_clause = ", ".join([f"{k} = ?" for k in updates.keys()])
       cursor = self.get_connection().cursor()
-      cursor.execute(f"UPDATE songs SET {set_clause} WHERE id = ?", 
+      cursor.execute(f"UPDATE playlists SET {set_clause}, date_modified = CURRENT_TIMESTAMP WHERE id = ?",
                      list(updates.values()) + [playlist_id])
       self.get_connection().commit()
+      self._bump_generations("playlists")
       return cursor.rowcount > 0
 
 
+  def recompute_playlist_aggregates(self) -> int:
+    """Recount song_count and total_duration of every playlist from scratch. Returns how many playlists were updated."""
+    with self._lock:
+      cursor = self.get_connection().cursor()
+      cursor.execute(migrations.RECOMPUTE_PLAYLIST_AGGREGATES)
+      self.get_connection().commit()
+      self._bump_generations("playlists")
+      return cursor.rowcount
+
+
+  def verify_playlist_aggregates(self) -> Dict[int, Tuple[Tuple[int, int], Tuple[int, int]]]:
+    """Check the stored aggregates against the real ones.
+    Returns playlist ID -> ((stored count, stored duration), (actual count, actual duration)) for every mismatch."""
+    cursor = self._cursor()
+    cursor.execute("SELECT id, song_count, total_duration FROM playlists")
+    stored = {row[0] : (row[1] or 0, row[2] or 0) for row in cursor.fetchall()}
+    cursor.execute(self._PLAYLIST_AGGREGATES_QUERY)
+    mismatches = {}
+    for playlist_id, count, duration in cursor.fetchall():
+      if stored.get(playlist_id) != (count, duration):
+        mismatches[playlist_id] = (stored.get(playlist_id), (count, duration))
+    return mismatches
+
+
+  # Positions in a playlist are spaced out by this much, so a song can be put between two
+  # others by giving it the key in the middle, without touching any other row. Once two
+  # neighbours run out of room the playlist gets renumbered, which should be rare.
+  POSITION_GAP = 1024
+
   def add_song_to_playlist(
       self,
       playlist_id : int,
       song_id     : int,
       position    : int = -1
+  ) -> Future:
+    """Queue adding a song to a playlist, before the song at index `position` (or at the end if -1).
+    The future resolves to True if added."""
+    return self._write_queue.submit(lambda cursor: self._add_song_to_playlist(cursor, playlist_id, song_id, position),
+                                    tables=("playlists_songs", "playlists"))
+
+
+  def _add_song_to_playlist(
+      self,
+      cursor      : sqlite3.Cursor,
+      playlist_id : int,
+      song_id     : int,
+      position    : int
   ) -> bool:
-    """Add song to playlist at specified position (or end if -1). Returns True if added."""
-    with self._lock:
-      cursor = self.get_connection().cursor()
-      
-      # Verify playlist and song exist
-      cursor.execute("SELECT id FROM playlists WHERE id = ?", (playlist_id,))
-      if not cursor.fetchone():
+    # Verify playlist and song exist
+    cursor.execute("SELECT id FROM playlists WHERE id = ?", (playlist_id,))
+    if not cursor.fetchone():
+      return False
+    cursor.execute("SELECT id FROM songs WHERE id = ?", (song_id,))
+    if not cursor.fetchone():
+      return False
+    
+    # Get current max position if no position specified
+    if position == -1:
+      cursor.execute("SELECT COALESCE(MAX(position), 0) FROM playlists_songs WHERE playlist_id = ?", 
+                    (playlist_id,))
+      key = cursor.fetchone()[0] + self.POSITION_GAP
+    else:
+      key = self._position_key_at(cursor, playlist_id, position)
+    
+    # A duplicate song in the playlist raises IntegrityError, which the queue turns into False
+    cursor.execute("""
+        INSERT INTO playlists_songs (playlist_id, song_id, position) 
+        VALUES (?, ?, ?)
+    """, (playlist_id, song_id, key))
+    return True
+
+
+  def move_song(
+      self,
+      playlist_id : int,
+      song_id     : int,
+      new_index   : int
+  ) -> Future:
+    """Queue moving a song so it ends up at `new_index` in the playlist. Only the moved
+    row gets written. The future resolves to True if the song was in the playlist."""
+    def move(cursor : sqlite3.Cursor) -> bool:
+      cursor.execute("SELECT position FROM playlists_songs WHERE playlist_id = ? AND song_id = ?",
+                     (playlist_id, song_id))
+      if cursor.fetchone() is None:
         return False
-      cursor.execute("SELECT id FROM songs WHERE id = ?", (song_id,))
-      if not cursor.fetchone():
+
+      # The key is worked out as if the song was already taken out of the playlist
+      key = self._position_key_at(cursor, playlist_id, new_index, skip_song_id=song_id)
+      cursor.execute("UPDATE playlists_songs SET position = ? WHERE playlist_id = ? AND song_id = ?",
+                     (key, playlist_id, song_id))
+      return True
+
+    return self._write_queue.submit(move, tables=("playlists_songs",))
+
+
+  def reorder_playlist(
+      self,
+      playlist_id : int,
+      song_ids    : List[int]
+  ) -> Future:
+    """Queue putting a playlist in the order of `song_ids` (which should be every song in it).
+    The longest run of songs that are already in order stays put, and only the rest are given new
+    positions. The future resolves to True if the order was applied."""
+    def reorder(cursor : sqlite3.Cursor) -> bool:
+      cursor.execute("SELECT song_id, position FROM playlists_songs WHERE playlist_id = ?", (playlist_id,))
+      current = dict(cursor.fetchall())
+      if set(song_ids) != set(current.keys()) or len(song_ids) != len(current):
         return False
-      
-      # Get current max position if no position specified
-      if position == -1:
-        cursor.execute("SELECT COALESCE(MAX(position), 0) FROM playlists_songs WHERE playlist_id = ?", 
-                      (playlist_id,))
-        position = cursor.fetchone()[0] + 1
+
+      keys = [current[song_id] for song_id in song_ids]
+      keep = self._longest_increasing_run(keys)
+
+      new_keys = list(keys)
+      i = 0
+      while i < len(keys):
+        if i in keep:
+          i += 1
+          continue
+        # Spread a run of moved songs evenly between the two kept songs around it
+        run_end = i
+        while run_end < len(keys) and run_end not in keep:
+          run_end += 1
+        low  = new_keys[i - 1] if i > 0 else 0
+        high = keys[run_end] if run_end < len(keys) else low + self.POSITION_GAP * (run_end - i + 1)
+        step = (high - low) // (run_end - i + 1)
+        if step < 1:
+          # No room left, so everything gets renumbered in the new order
+          self._renumber_playlist(cursor, playlist_id, song_ids)
+          return True
+        for j in range(i, run_end):
+          new_keys[j] = low + step * (j - i + 1)
+        i = run_end
+
+      moved = [(new_keys[i], playlist_id, song_ids[i]) for i in range(len(song_ids)) if new_keys[i] != keys[i]]
+      if len(moved) > 0:
+        # Park the moved rows on negative keys first, so none of them clash with each other on the way
+        cursor.executemany("UPDATE playlists_songs SET position = -? WHERE playlist_id = ? AND song_id = ?", moved)
+        cursor.executemany("UPDATE playlists_songs SET position = ? WHERE playlist_id = ? AND song_id = ?", moved)
+      return True
+
+    return self._write_queue.submit(reorder, tables=("playlists_songs",))
+
+
+  def _position_key_at(
+      self,
+      cursor       : sqlite3.Cursor,
+      playlist_id  : int,
+      index        : int,
+      skip_song_id : int = -1
+  ) -> int:
+    # Position key that sorts right before the song currently at `index` (ignoring `skip_song_id`).
+    # Keys are always > 0, so there is room below the first song
+    before, after = 0, None
+    if index > 0:
+      cursor.execute("""
+          SELECT position FROM playlists_songs
+          WHERE playlist_id = ? AND song_id != ?
+          ORDER BY position
+          LIMIT 2 OFFSET ?
+        """, (playlist_id, skip_song_id, index - 1))
+      neighbours = [row[0] for row in cursor.fetchall()]
+      if len(neighbours) == 0:
+        # Past the end, so it just goes last
+        cursor.execute("SELECT COALESCE(MAX(position), 0) FROM playlists_songs WHERE playlist_id = ? AND song_id != ?",
+                       (playlist_id, skip_song_id))
+        neighbours = [cursor.fetchone()[0]]
+      before = neighbours[0]
+      after  = neighbours[1] if len(neighbours) > 1 else None
+    else:
+      cursor.execute("""
+          SELECT MIN(position) FROM playlists_songs
+          WHERE playlist_id = ? AND song_id != ?
+        """, (playlist_id, skip_song_id))
+      after = cursor.fetchone()[0]
+
+    if after is None:
+      return before + self.POSITION_GAP
+    if after - before > 1:
+      return (before + after) // 2
+
+    # Out of room between these two, renumber and try again
+    cursor.execute("SELECT song_id FROM playlists_songs WHERE playlist_id = ? ORDER BY position", (playlist_id,))
+    self._renumber_playlist(cursor, playlist_id, [row[0] for row in cursor.fetchall()])
+    return self._position_key_at(cursor, playlist_id, index, skip_song_id)
+
+
+  def _renumber_playlist(self, cursor : sqlite3.Cursor, playlist_id : int, song_ids : List[int]):
+    # Negative first, so the UNIQUE(playlist_id, position) constraint holds at every step
+    cursor.executemany("UPDATE playlists_songs SET position = ? WHERE playlist_id = ? AND song_id = ?",
+                       [(-(i + 1), playlist_id, song_id) for i, song_id in enumerate(song_ids)])
+    cursor.executemany("UPDATE playlists_songs SET position = ? WHERE playlist_id = ? AND song_id = ?",
+                       [((i + 1) * self.POSITION_GAP, playlist_id, song_id) for i, song_id in enumerate(song_ids)])
+
+
+  @staticmethod
+  def _longest_increasing_run(keys : List[int]) -> set[int]:
+    # Indices of a longest strictly increasing subsequence of `keys` (patience sorting)
+    tails    : List[int] = []  # index in `keys` of the smallest tail for each length
+    previous : List[int] = [-1] * len(keys)
+    for i, key in enumerate(keys):
+      low, high = 0, len(tails)
+      while low < high:
+        mid = (low + high) // 2
+        if keys[tails[mid]] < key:
+          low = mid + 1
+        else:
+          high = mid
+      previous[i] = tails[low - 1] if low > 0 else -1
+      if low == len(tails):
+        tails.append(i)
       else:
-        # Shift existing songs down to make room
-        cursor.execute("""
-            UPDATE playlists_songs 
-            SET position = position + 1 
-            WHERE playlist_id = ? AND position >= ?
-        """, (playlist_id, position))
-      
-      try:
-        cursor.execute("""
-            INSERT INTO playlists_songs (playlist_id, song_id, position) 
-            VALUES (?, ?, ?)
-        """, (playlist_id, song_id, position))
-        self.get_connection().commit()
-        return True
-      
-      except sqlite3.IntegrityError:
-        self.get_connection().rollback()
-        return False  # Duplicate song in playlist
+        tails[low] = i
+
+    run = set()
+    i = tails[-1] if len(tails) > 0 else -1
+    while i != -1:
+      run.add(i)
+      i = previous[i]
+    return run
+
 
   def remove_song_from_playlist(
       self,
       song_id : int,
-  ) -> bool:
-    with self._lock:
-      cursor = self.get_connection().cursor()
+  ) -> Future:
+    """Queue removing a song from playlists. The future resolves to True if anything was removed."""
+    def remove(cursor : sqlite3.Cursor) -> bool:
       cursor.execute("DELETE FROM playlists_songs WHERE song_id = ?", (song_id,))
-      self.get_connection().commit()
-      
-      if cursor.lastrowid:
-        return cursor.lastrowid > 0
-      return False
+      return cursor.rowcount > 0
+    return self._write_queue.submit(remove, tables=("playlists_songs", "playlists"))
 
   def delete_playlist(
     self,
@@ -365,22 +1119,61 @@ class DatabaseConnection:
       cursor = self.get_connection().cursor()
       cursor.execute("DELETE FROM playlists WHERE id = ?", (playlist_id,))
       self.get_connection().commit()
+      self._bump_generations("playlists", "playlists_songs")
       
       if cursor.lastrowid:
         return cursor.lastrowid > 0
       return False
 
 
-  def create_tables(self):
+  def add_download(self, url : str, source : str, priority : int = 0) -> int:
+    """Put a download in the persistent queue. Returns its ID."""
     with self._lock:
-      try:
-        cursor = self.get_connection().cursor()
-        with open(os.path.join(util.DATA_LOCATION, 'table_init.sql')) as f:
-          cursor.execute(f.read())
-          self.get_connection().commit()
-          f.close()
-      except Exception as e:
-        raise e
+      cursor = self.get_connection().cursor()
+      cursor.execute("INSERT INTO download_queue (url, source, priority) VALUES (?, ?, ?)", (url, source, priority))
+      self.get_connection().commit()
+      return cursor.lastrowid
+
+
+  def get_queued_downloads(self) -> List[DownloadItem]:
+    """Every download that still has to happen, highest priority first.
+    Ones that were mid-download when the app closed come back as pending."""
+    with self._lock:
+      self.get_connection().execute("UPDATE download_queue SET status = 'pending' WHERE status = 'downloading'")
+      # Left behind by versions that kept downloads that ran out of attempts
+      self.get_connection().execute("DELETE FROM download_queue WHERE status = 'failed'")
+      self.get_connection().commit()
+    cursor = self._cursor(DownloadItem)
+    cursor.execute(f"""
+        SELECT {DownloadItem.select_columns("d")}
+        FROM download_queue d
+        WHERE d.status = 'pending'
+        ORDER BY d.priority DESC, d.id
+      """)
+    return cursor.fetchall()
+
+
+  def update_download(self, download_id : int, **kwargs) -> bool:
+    """Update the status, attempts or last_error of a queued download"""
+    allowed_fields = {'status', 'attempts', 'last_error'}
+    updates = {k: v for k, v in kwargs.items() if k in allowed_fields}
+    if not updates:
+      return False
+
+    with self._lock:
+      set_clause = ", ".join([f"{k} = ?" for k in updates.keys()])
+      cursor = self.get_connection().cursor()
+      cursor.execute(f"UPDATE download_queue SET {set_clause} WHERE id = ?", list(updates.values()) + [download_id])
+      self.get_connection().commit()
+      return cursor.rowcount > 0
+
+
+  def remove_download(self, download_id : int) -> bool:
+    with self._lock:
+      cursor = self.get_connection().cursor()
+      cursor.execute("DELETE FROM download_queue WHERE id = ?", (download_id,))
+      self.get_connection().commit()
+      return cursor.rowcount > 0
 
 
   def clear_all(self):
@@ -391,30 +1184,6 @@ class DatabaseConnection:
         cursor.execute("DELETE FROM playlists")
         cursor.execute("DELETE FROM playlists_songs")
         self.get_connection().commit()
+        self._bump_generations("songs", "playlists", "playlists_songs")
       except Exception as e:
         raise e
-
-
-  def _get_song_hash(self, path_to_song : str) -> str | None:
-    if not os.path.exists(path_to_song):
-        print(f"Cannot locate {path_to_song}!")
-        return
-    md5_hash = hashlib.md5()
-    try:
-      with open(path_to_song, "rb") as f:
-        # Read first and last 8 KB
-        md5_hash.update(f.read(8192))
-        f.seek(-8192, 2)
-        md5_hash.update(f.read(8192))
-        
-    except (OSError, IOError):
-      # Try to open regardless, no limitations
-      try:  
-        md5_hash.update(f.read())
-      except (OSError, IOError) as e:
-        # welp, we tried
-        print(f"Could not read {path_to_song}!\nError: {e}")
-        return
-      
-    return md5_hash.hexdigest() 
-          
\ No newline at end of file
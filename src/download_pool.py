@@ -0,0 +1,245 @@
+import os
+import sys
+import signal
+import itertools
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import Future, InvalidStateError
+from contextlib import contextmanager
+from multiprocessing.connection import wait
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import download_worker
+from mylogger import global_logger
+
+
+@contextmanager
+def _worker_main_module():
+  # A spawned child re-imports the parent's __main__ before anything else, and the app's pulls in
+  # Qt, spotdl and the logger. Processes started in here see download_worker as __main__ instead
+  main = sys.modules["__main__"]
+  sys.modules["__main__"] = download_worker
+  try:
+    yield
+  finally:
+    sys.modules["__main__"] = main
+
+
+class _Worker:
+  def __init__(self, context):
+    # Every worker gets its own pipe, so killing one mid message can't wedge the others
+    self.connection, child_connection = context.Pipe()
+    self.process   = context.Process(target=download_worker.worker_main, args=(child_connection,), daemon=True)
+    with _worker_main_module():
+      self.process.start()
+    child_connection.close()
+    self.job_id    : Optional[int] = None
+    self.job_count = 0
+
+
+def _resolve(future : Future, result : Tuple[int, str, List[Dict[str, Any]]]):
+  # The awaiting side may have cancelled it in the meantime
+  try:
+    future.set_result(result)
+  except InvalidStateError:
+    pass
+
+
+def _kill_process_tree(process : multiprocessing.Process):
+  """Kill a worker, and whatever it started (ffmpeg)"""
+  if process.pid is None or not process.is_alive():
+    return
+  try:
+    if sys.platform == "win32":
+      subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True)
+    else:
+      os.killpg(process.pid, signal.SIGKILL)
+  except (OSError, subprocess.SubprocessError) as e:
+    global_logger.warning(f"Could not kill download worker {process.pid}: {e}")
+    process.kill()
+  process.join(timeout=5)
+
+
+class DownloadProcessPool:
+  """
+  Runs yt-dlp downloads in up to `max_workers` worker processes, so extraction and
+  postprocessing never hold the GIL the UI needs, and a download can be killed outright.
+
+  A listener thread reads what the workers send back. Progress goes to each job's callbacks
+  (from that thread), and the job's Future resolves to (result code, error message, downloaded files).
+  Each file is a dict with its final `filepath`, and what its song row needs (see download_worker._file_info).
+  Every worker is replaced after `jobs_per_worker` downloads, so nothing yt-dlp leaks piles up.
+  """
+
+  def __init__(self, max_workers : int = 2, jobs_per_worker : int = 20):
+    self._context         = multiprocessing.get_context("spawn")
+    self._max_workers     = max(1, max_workers)
+    self._jobs_per_worker = jobs_per_worker
+
+    self._lock     = threading.Lock()
+    self._job_ids  = itertools.count()
+    self._workers  : List[_Worker] = []
+    self._waiting  : List[Tuple[int, str, Dict[str, Any], FrozenSet[str]]] = []
+    # Job ID -> (future, progress callback, converting callback)
+    self._jobs     : Dict[int, Tuple[Future, Callable[[dict], None], Callable[[str], None]]] = {}
+    self._closed   = False
+
+    # Wakes the listener up when the workers change
+    self._wakeup_receiver, self._wakeup_sender = multiprocessing.Pipe(duplex=False)
+    self._listener = threading.Thread(target=self._listen, name="DownloadProcessPool", daemon=True)
+    self._listener.start()
+
+
+  def submit(
+      self,
+      url                 : str,
+      options             : Dict[str, Any],
+      progress_callback   : Callable[[dict], None],
+      converting_callback : Callable[[str], None],
+      skip_ids            : Iterable[str] = ()) -> Future:
+    """Queue a download. `options` are YoutubeDL options, without any hooks (they can't be sent to another process).
+    `progress_callback` gets trimmed yt-dlp progress dicts, `converting_callback` the URL once ffmpeg starts.
+    Videos whose ID is in `skip_ids` aren't downloaded."""
+    future = Future()
+    with self._lock:
+      if self._closed:
+        raise RuntimeError("DownloadProcessPool is closed")
+      job_id = next(self._job_ids)
+      future.job_id = job_id
+      self._jobs[job_id] = (future, progress_callback, converting_callback)
+      self._waiting.append((job_id, url, options, frozenset(skip_ids)))
+      self._dispatch()
+    return future
+
+
+  def cancel(self, future : Future):
+    """Stop a download. If it already started, its worker (and ffmpeg) get killed."""
+    job_id = future.job_id
+    with self._lock:
+      if self._jobs.pop(job_id, None) is None:
+        return
+      self._waiting = [job for job in self._waiting if job[0] != job_id]
+      worker = next((w for w in self._workers if w.job_id == job_id), None)
+      if worker is not None:
+        self._workers.remove(worker)
+        self._wake_listener()
+
+    if worker is not None:
+      _kill_process_tree(worker.process)
+      worker.connection.close()
+    future.cancel()
+    with self._lock:
+      self._dispatch()
+
+
+  def close(self):
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+      workers, self._workers = self._workers, []
+      jobs, self._jobs = self._jobs, {}
+      self._waiting = []
+      self._wake_listener()
+    self._listener.join(timeout=5)
+
+    for worker in workers:
+      _kill_process_tree(worker.process)
+      worker.connection.close()
+    for future, _, _ in jobs.values():
+      future.cancel()
+
+
+  def _wake_listener(self):
+    self._wakeup_sender.send(None)
+
+
+  def _dispatch(self):
+    # Called with the lock held. Hands waiting jobs to idle workers, starting new ones up to the limit
+    while len(self._waiting) > 0:
+      worker = next((w for w in self._workers if w.job_id is None), None)
+      if worker is None:
+        if len(self._workers) >= self._max_workers:
+          return
+        worker = _Worker(self._context)
+        self._workers.append(worker)
+        self._wake_listener()
+
+      job = self._waiting.pop(0)
+      worker.job_id = job[0]
+      worker.job_count += 1
+      worker.connection.send(job)
+
+
+  def _listen(self):
+    while True:
+      with self._lock:
+        if self._closed:
+          return
+        workers = {worker.connection : worker for worker in self._workers}
+
+      try:
+        ready = wait([self._wakeup_receiver, *workers])
+      except (OSError, ValueError):
+        continue  # cancel() closed a worker's pipe while we were waiting on it
+      for connection in ready:
+        if connection is self._wakeup_receiver:
+          self._wakeup_receiver.recv()
+          continue
+        try:
+          event = connection.recv()
+        except (EOFError, OSError):
+          self._worker_died(workers[connection])
+          continue
+        self._handle(event)
+
+
+  def _handle(self, event : tuple):
+    kind, job_id = event[0], event[1]
+    if kind == "log":
+      global_logger.log(event[2], f"Download {job_id}: {event[3]}")
+      return
+    with self._lock:
+      job = self._jobs.get(job_id)
+    if job is None:
+      return  # Cancelled
+    future, progress_callback, converting_callback = job
+
+    if kind == "progress":
+      progress_callback(event[2])
+    elif kind == "converting":
+      converting_callback(event[2])
+    elif kind == "done":
+      with self._lock:
+        self._jobs.pop(job_id, None)
+        self._finish_job(job_id)
+      _resolve(future, (event[2], event[3], event[4]))
+
+
+  def _finish_job(self, job_id : int):
+    # Called with the lock held
+    worker = next((w for w in self._workers if w.job_id == job_id), None)
+    if worker is None:
+      return
+    worker.job_id = None
+    if worker.job_count >= self._jobs_per_worker:
+      self._workers.remove(worker)
+      worker.connection.send(None)
+      worker.connection.close()
+    self._dispatch()
+
+
+  def _worker_died(self, worker : _Worker):
+    # Crashed, ran out of memory, or got killed by cancel()
+    with self._lock:
+      if worker not in self._workers:
+        return
+      self._workers.remove(worker)
+      job = self._jobs.pop(worker.job_id, None) if worker.job_id is not None else None
+      self._dispatch()
+    worker.connection.close()
+    worker.process.join(timeout=5)
+    global_logger.warning(f"Download worker {worker.process.pid} exited unexpectedly ({worker.process.exitcode})")
+    if job is not None:
+      _resolve(job[0], (-3, "The download worker died", []))
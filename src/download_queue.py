@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import random
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple, TYPE_CHECKING
+
+from database import DownloadItem
+from downloader import DownloadTracker
+from mylogger import global_logger
+
+if TYPE_CHECKING:
+  from async_database import AsyncDatabase
+
+
+# Runs one download. Gets the queue item and a callback for its progress, raises if it failed
+DownloadFunction = Callable[[DownloadItem, Callable[[DownloadTracker], None]], Awaitable[None]]
+
+
+class DownloadQueue:
+  """
+  Downloads queued URLs with up to `max_workers` running at once, highest priority first.
+
+  Every item is kept in the download_queue table until it finishes (or fails for good), so anything
+  still pending when the app closes is picked up again by start(). Failed downloads are retried
+  `max_attempts` times, waiting `retry_delay` seconds (doubled for every failed attempt,
+  plus some jitter) in between. Progress of every item goes out through `progress_callback`
+  as a DownloadTracker, and `finished_callback` gets (item, succeeded) once it's done for good.
+  """
+
+  def __init__(
+      self,
+      async_db          : AsyncDatabase,
+      download          : DownloadFunction,
+      progress_callback : Callable[[DownloadTracker], None],
+      finished_callback : Optional[Callable[[DownloadItem, bool], None]] = None,
+      max_workers       : int = 2,
+      max_attempts      : int = 4,
+      retry_delay       : float = 2.0):
+    self._async_db          = async_db
+    self._download          = download
+    self._progress_callback = progress_callback
+    self._finished_callback = finished_callback
+    self._max_workers       = max(1, max_workers)
+    self._max_attempts      = max_attempts
+    self._retry_delay       = retry_delay
+
+    # (-priority, id, item). The ID keeps equal priorities in the order they were added
+    self._heap      : List[Tuple[int, int, DownloadItem]] = []
+    self._available : asyncio.Condition | None = None
+    self._items     : Dict[int, DownloadItem] = {}          # Every item that isn't finished yet
+    self._running   : Dict[int, asyncio.Task] = {}          # Item ID -> its download
+    self._cancelled : Set[int] = set()
+    self._adding    : Set[str] = set()                      # URLs on their way into the database
+    self._workers   : List[asyncio.Task] = []
+    self._tasks     : Set[asyncio.Task] = set()             # Additions and retries waiting on their delay
+
+
+  def start(self):
+    """Start the workers, and load whatever was left in the queue last time. Needs a running event loop."""
+    if len(self._workers) > 0:
+      return
+    self._available = asyncio.Condition()
+    self._workers = [asyncio.create_task(self._worker()) for _ in range(self._max_workers)]
+    self._spawn(self._load_persisted())
+
+
+  def add(self, url : str, source : str, priority : int = 0) -> bool:
+    """Queue a download. Returns False if the URL is already queued or downloading."""
+    if url in self._adding or any(item.url == url for item in self._items.values()):
+      return False
+    self._adding.add(url)
+    self._spawn(self._add(url, source, priority))
+    return True
+
+
+  def cancel(self, download_id : int) -> bool:
+    """Cancel a queued or running download. Returns False if there is no such download."""
+    if download_id not in self._items:
+      return False
+    self._cancelled.add(download_id)
+    task = self._running.get(download_id)
+    if task is not None:
+      task.cancel()
+    else:
+      self._spawn(self._finish(self._items[download_id], "cancelled"))
+    return True
+
+
+  def pending_count(self) -> int:
+    return len(self._items)
+
+
+  async def close(self):
+    for task in self._workers + list(self._tasks):
+      task.cancel()
+    await asyncio.gather(*self._workers, *self._tasks, return_exceptions=True)
+    self._workers = []
+
+
+  def _spawn(self, coroutine):
+    task = asyncio.create_task(coroutine)
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+
+
+  async def _load_persisted(self):
+    for item in await self._async_db.get_queued_downloads():
+      if item.id not in self._items:
+        await self._push(item)
+
+
+  async def _add(self, url : str, source : str, priority : int):
+    try:
+      download_id = await self._async_db.add_download(url, source, priority)
+      item = DownloadItem(download_id, url, source, priority, "pending", 0, None, None)
+      self._items[item.id] = item
+    finally:
+      self._adding.discard(url)
+    self._report(item, "queued")
+    await self._push(item)
+
+
+  async def _push(self, item : DownloadItem):
+    self._items[item.id] = item
+    async with self._available:
+      heapq.heappush(self._heap, (-item.priority, item.id, item))
+      self._available.notify()
+
+
+  async def _worker(self):
+    while True:
+      async with self._available:
+        await self._available.wait_for(lambda: len(self._heap) > 0)
+        _, _, item = heapq.heappop(self._heap)
+
+      # Cancelled while it was waiting
+      if item.id in self._cancelled or item.id not in self._items:
+        continue
+
+      task = asyncio.create_task(self._attempt(item))
+      self._running[item.id] = task
+      try:
+        await task
+      except asyncio.CancelledError:
+        # Either this item got cancelled, or the whole queue is closing
+        if item.id not in self._cancelled:
+          raise
+        await self._finish(item, "cancelled")
+      finally:
+        self._running.pop(item.id, None)
+
+
+  async def _attempt(self, item : DownloadItem):
+    attempt = item.attempts + 1
+    await self._async_db.update_download(item.id, status="downloading", attempts=attempt)
+    self._report(item, "starting")
+
+    try:
+      await self._download(item, self._progress_callback)
+
+    except asyncio.CancelledError:
+      raise
+
+    except Exception as e:
+      global_logger.warning(f"Download of {item.url} failed (attempt {attempt}/{self._max_attempts}): {e}")
+      item = item._replace(attempts=attempt, last_error=str(e))
+
+      if attempt >= self._max_attempts:
+        # Given up on, nothing would ever pick the row up again
+        await self._finish(item, "error")
+        return
+
+      await self._async_db.update_download(item.id, status="pending", last_error=str(e))
+      self._items[item.id] = item
+      self._report(item, "retrying")
+      # 2s, 4s, 8s... with jitter, so a bunch of downloads that failed together don't all come back together
+      delay = self._retry_delay * (2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+      self._spawn(self._retry_later(item, delay))
+      return
+
+    await self._finish(item, "finished")
+
+
+  async def _retry_later(self, item : DownloadItem, delay : float):
+    await asyncio.sleep(delay)
+    if item.id in self._items and item.id not in self._cancelled:
+      await self._push(item)
+
+
+  async def _finish(self, item : DownloadItem, status : str):
+    await self._async_db.remove_download(item.id)
+    self._items.pop(item.id, None)
+    self._cancelled.discard(item.id)
+    self._report(item, status)
+    if self._finished_callback is not None:
+      self._finished_callback(item, status == "finished")
+
+
+  def _report(self, item : DownloadItem, status : str):
+    tracker = DownloadTracker(item.url)
+    tracker.status = status
+    if status == "finished":
+      tracker.percent = 100.0
+    self._progress_callback(tracker)
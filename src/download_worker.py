@@ -0,0 +1,132 @@
+"""
+What runs inside DownloadProcessPool's worker processes.
+
+Workers are spawned, not forked (forking a process running Qt isn't safe), so they start from
+a clean interpreter. This module is all they import: yt-dlp and the standard library, nothing
+from the app. Whatever they want logged goes back over the pipe, and the app logs it.
+"""
+import os
+import time
+import logging
+import threading
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, FrozenSet, List, Tuple
+
+
+# yt-dlp reports every chunk, workers only pass it on this often (status changes always go through)
+PROGRESS_INTERVAL = 0.1
+
+# Only these make it over to the app, the full info_dict is far too big to send every chunk
+_PROGRESS_FIELDS = ("status", "filename", "downloaded_bytes", "total_bytes", "total_bytes_estimate", "speed", "eta")
+
+
+class _PipeLogger:
+  """yt-dlp logger that sends warnings and errors to the app as ("log", job ID, level, message)"""
+
+  def __init__(self, job_id : int, send : Callable[[tuple], None]):
+    self._job_id = job_id
+    self._send   = send
+
+  def debug(self, message : str):
+    pass  # Every line yt-dlp would print, way too chatty
+
+  def info(self, message : str):
+    pass
+
+  def warning(self, message : str):
+    self._send(("log", self._job_id, logging.WARNING, message))
+
+  def error(self, message : str):
+    self._send(("log", self._job_id, logging.ERROR, message))
+
+
+def worker_main(connection : Connection):
+  # Its own process group, so cancelling can kill the ffmpeg processes yt-dlp started along with it
+  if hasattr(os, "setpgrp"):
+    os.setpgrp()
+  import yt_dlp
+
+  # Hooks can be called from yt-dlp's fragment threads
+  lock = threading.Lock()
+  def send(event : tuple):
+    with lock:
+      connection.send(event)
+
+  while True:
+    job = connection.recv()
+    if job is None:
+      return
+    job_id, url, options, skip_ids = job
+    send(("done", job_id, *_download(yt_dlp, job_id, url, options, skip_ids, send)))
+
+
+def _download(
+    yt_dlp,
+    job_id   : int,
+    url      : str,
+    options  : Dict[str, Any],
+    skip_ids : FrozenSet[str],
+    send     : Callable[[tuple], None]) -> Tuple[int, str, List[Dict[str, Any]]]:
+  last_sent = [0.0, None]  # time, status
+
+  def progress_hook(info : dict):
+    now = time.monotonic()
+    if info.get("status") == last_sent[1] and now - last_sent[0] < PROGRESS_INTERVAL:
+      return
+    last_sent[0], last_sent[1] = now, info.get("status")
+    progress = {key : info.get(key) for key in _PROGRESS_FIELDS}
+    progress["info_dict"] = {"webpage_url" : info.get("info_dict", {}).get("webpage_url", url)}
+    send(("progress", job_id, progress))
+
+  def postprocessor_hook(info : dict):
+    if info.get("status") == "started":
+      send(("converting", job_id, info.get("info_dict", {}).get("webpage_url", url)))
+
+  # Playlist entries already in the library get skipped from the playlist listing alone,
+  # before yt-dlp fetches anything about the video itself
+  def match_filter(info : dict, *, incomplete : bool = False):
+    if info.get("id") in skip_ids:
+      return "Already in the library"
+    return None
+
+  files = []
+  class RecordFile(yt_dlp.postprocessor.PostProcessor):
+    # Runs once yt-dlp is completely done with a file, so `filepath` is final
+    def run(self, info : dict):
+      files.append(_file_info(info, url))
+      return [], info
+
+  options = dict(options,
+                 progress_hooks=[progress_hook],
+                 postprocessor_hooks=[postprocessor_hook],
+                 match_filter=match_filter,
+                 logger=_PipeLogger(job_id, send))
+  try:
+    with yt_dlp.YoutubeDL(options) as ydl:
+      ydl.add_post_processor(RecordFile(), when="after_move")
+      return ydl.download([url]), "", files
+
+  except yt_dlp.utils.DownloadError as err:
+    error_msg = str(err)
+    if "sign in" in error_msg or "unable to extract" in error_msg:
+      return -1, error_msg, files # Youtube asking you if you're a bot
+    return -2, error_msg, files   # Some other error
+
+  except Exception as err:
+    return -3, str(err), files    # heebee jeebies
+
+
+def _file_info(info : dict, url : str) -> Dict[str, Any]:
+  # Everything the song row needs that yt-dlp already knows, so nothing has to be read back from the file
+  return {
+    "filepath"         : info["filepath"],
+    "source_url"       : info.get("webpage_url", url),
+    "source_extractor" : (info.get("extractor_key") or "").lower() or None,
+    "source_id"        : info.get("id"),
+    "title"            : info.get("title") or "",
+    "duration"         : round(info.get("duration") or 0),
+    "uploader"         : info.get("uploader") or info.get("channel"),
+    "thumbnail_url"    : info.get("thumbnail"),
+    "sample_rate"      : info.get("asr") or 0,
+    "channels"         : info.get("audio_channels") or 0,
+  }
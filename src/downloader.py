@@ -1,8 +1,10 @@
-import json, yt_dlp, os, asyncio
+import json, yt_dlp, os, asyncio, re, threading, atexit
 
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from typing import Callable, Optional, Dict, Any, Tuple
+from collections import namedtuple
+from typing import Callable, Optional, Dict, Any, Tuple, List, Iterable
+from urllib.parse import urlsplit, parse_qs
 from dotenv import load_dotenv
 
 from PySide6.QtCore import (QDateTime, QDir, QLibraryInfo, QSysInfo, Qt,
@@ -27,6 +29,10 @@ import spotdl
 from spotdl.types.song     import Song
 from spotdl.types.playlist import Playlist
 import config 
+from download_pool import DownloadProcessPool
+from match_cache import MatchCache
+from transcode import STORAGE_FORMATS, TRANSCODE_SAMPLE_RATE, TRANSCODE_CHANNELS, Transcoder, TranscodeError
+from mylogger import global_logger
 
 
 
@@ -70,11 +76,13 @@ class DownloadTracker:
     self.url = url
     self.status : str = "starting"
     self.percent : float = 0.0
-    self.speed : str
+    self.speed : str | None = None
+    self.speed_bytes : float = 0.0   # Unformatted speed, in bytes per second
     self.eta   : float | None = 0
     self.total_bytes : int | None = 0
     self.downloaded_bytes : int = 0
     self.filename : str = ""
+    self.files : List[Dict[str, Any]] = []  # Every file the download produced once it's done, see DownloadProcessPool
 
   def __str__(self):
     match self.status:
@@ -105,13 +113,189 @@ def format_bytes(bytes_value : float) -> str:
 
 
 
-class ProgressSignalEmitter(QObject):
-  progress_updated = Signal(object)
+class BatchProgress:
+  """Combined speed and ETA of every download that's running, built from their DownloadTrackers"""
+
+  def __init__(self):
+    self._active : Dict[str, DownloadTracker] = {}
+
+  def update(self, tracker : DownloadTracker):
+    if tracker.status in ("finished", "error", "Error", "cancelled"):
+      self._active.pop(tracker.url, None)
+    else:
+      self._active[tracker.url] = tracker
+
+  @property
+  def speed(self) -> float:
+    return sum(t.speed_bytes for t in self._active.values() if t.status == "downloading")
+
+  @property
+  def eta(self) -> float | None:
+    remaining = sum(max(0, (t.total_bytes or 0) - t.downloaded_bytes)
+                    for t in self._active.values() if t.status == "downloading")
+    speed = self.speed
+    return remaining / speed if speed > 0 else None
+
+  def __str__(self):
+    downloading = sum(1 for t in self._active.values() if t.status == "downloading")
+    converting  = sum(1 for t in self._active.values() if t.status == "converting")
+    waiting     = len(self._active) - downloading - converting
+    eta = self.eta
+    eta_text = f"{int(eta) // 60}:{int(eta) % 60:02d}" if eta is not None else "N/A"
+    converting_text = f"{converting} converting, " if converting > 0 else ""
+    return f"{downloading} downloading, {converting_text}{waiting} waiting | {format_bytes(self.speed)} | ETA: {eta_text}"
+
+
+
+# ------ Links ------
+# What kind of thing a link points at. The kind is what the download queue stores as the source
+YOUTUBE_VIDEO    = "youtube_video"
+YOUTUBE_PLAYLIST = "youtube_playlist"
+SPOTIFY_TRACK    = "spotify_track"
+SPOTIFY_PLAYLIST = "spotify_playlist"
+
+# `url` is rewritten into one canonical form, and `key` is (kind, ID),
+# so the same song pasted as two different looking links is only downloaded once
+DownloadLink = namedtuple("DownloadLink", ["kind", "url", "key"])
+
+_YOUTUBE_HOSTS   = {"youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com"}
+_YOUTUBE_ID      = re.compile(r"^[\w-]{11}$")
+_SPOTIFY_URI     = re.compile(r"^spotify:(track|playlist):(\w+)$")
+_LINK_IN_TEXT    = re.compile(r"(https?://\S+|spotify:(?:track|playlist):\w+)")
+
+
+def classify_url(url : str) -> DownloadLink | None:
+  """Work out what `url` points at. Returns None for anything that isn't a supported YouTube/Spotify link."""
+  url = url.strip().rstrip(".,;)>]\"'")
+
+  if (match := _SPOTIFY_URI.match(url)) is not None:
+    kind = SPOTIFY_TRACK if match.group(1) == "track" else SPOTIFY_PLAYLIST
+    return DownloadLink(kind, f"https://open.spotify.com/{match.group(1)}/{match.group(2)}", (kind, match.group(2)))
+
+  parts = urlsplit(url if "://" in url else "https://" + url)
+  host  = parts.netloc.lower().split(":")[0]
+  path  = [segment for segment in parts.path.split("/") if segment]
+  query = parse_qs(parts.query)
+
+  if host in _YOUTUBE_HOSTS:
+    if len(path) > 0 and path[0] == "playlist" and "list" in query:
+      playlist_id = query["list"][0]
+      return DownloadLink(YOUTUBE_PLAYLIST, f"https://www.youtube.com/playlist?list={playlist_id}", (YOUTUBE_PLAYLIST, playlist_id))
+    if len(path) > 0 and path[0] == "watch" and "v" in query:
+      video_id = query["v"][0]
+    elif len(path) > 1 and path[0] in ("shorts", "embed", "live", "v"):
+      video_id = path[1]
+    else:
+      return None
+  elif host == "youtu.be" and len(path) > 0:
+    video_id = path[0]
+  elif host in ("open.spotify.com", "play.spotify.com"):
+    # Localized links look like open.spotify.com/intl-de/track/...
+    if len(path) > 0 and path[0].startswith("intl-"):
+      path = path[1:]
+    if len(path) < 2 or path[0] not in ("track", "playlist"):
+      return None
+    kind = SPOTIFY_TRACK if path[0] == "track" else SPOTIFY_PLAYLIST
+    return DownloadLink(kind, f"https://open.spotify.com/{path[0]}/{path[1]}", (kind, path[1]))
+  else:
+    return None
+
+  if not _YOUTUBE_ID.match(video_id):
+    return None
+  # A watch link with a &list= on it would make yt-dlp grab the whole playlist, the canonical one doesn't
+  return DownloadLink(YOUTUBE_VIDEO, f"https://www.youtube.com/watch?v={video_id}", (YOUTUBE_VIDEO, video_id))
+
+
+# What songs.source_extractor holds for each site
+SOURCE_YOUTUBE = "youtube"
+SOURCE_SPOTIFY = "spotify"
+
+def link_source(link : DownloadLink) -> Tuple[str, str | None]:
+  """(source_extractor, source_id) a song downloaded from `link` gets.
+  The ID is None for playlists, those only get checked entry by entry."""
+  extractor = SOURCE_SPOTIFY if link.kind in (SPOTIFY_TRACK, SPOTIFY_PLAYLIST) else SOURCE_YOUTUBE
+  if link.kind in (YOUTUBE_VIDEO, SPOTIFY_TRACK):
+    return extractor, link.key[1]
+  return extractor, None
+
+
+def parse_links(text : str) -> Tuple[List[DownloadLink], List[str]]:
+  """Pull every link out of `text`, which can be links separated by anything, or lines naming
+  text files with links in them. Returns (unique supported links in order, things that weren't supported)."""
+  candidates : List[str] = []
+  for line in text.splitlines():
+    line = line.strip()
+    if len(line) == 0:
+      continue
+    if os.path.isfile(line):
+      with open(line, "r", encoding="utf-8", errors="replace") as f:
+        candidates.extend(_LINK_IN_TEXT.findall(f.read()))
+      continue
+    found = _LINK_IN_TEXT.findall(line)
+    # Bare links without the https:// still count, as long as they're the whole line
+    candidates.extend(found if len(found) > 0 else line.split())
+
+  links       : List[DownloadLink] = []
+  unsupported : List[str] = []
+  seen = set()
+  for candidate in candidates:
+    link = classify_url(candidate)
+    if link is None:
+      unsupported.append(candidate)
+    elif link.key not in seen:
+      seen.add(link.key)
+      links.append(link)
+  return links, unsupported
+
+
+
+# What ProgressBus publishes: the downloads that changed since the last one, and the totals over all of them
+ProgressSnapshot = namedtuple("ProgressSnapshot", ["trackers", "speed", "eta", "summary"])
+
+
+class ProgressBus(QObject):
+  """
+  Collects DownloadTrackers from any number of downloads, on any thread, and publishes them
+  at most `rate` times a second. In between, only the latest state of each download is kept,
+  so a download reporting every chunk costs a dict assignment instead of a trip through the event loop.
+  """
+  snapshot_ready = Signal(object)  # ProgressSnapshot
+
+  def __init__(self, rate : float = 10.0):
+    super().__init__()
+    self._lock    = threading.Lock()
+    self._pending : Dict[str, DownloadTracker] = {}
+    self.batch    = BatchProgress()
+
+    # Lives on the GUI thread, so snapshots are always emitted from there
+    self._timer = QTimer(self)
+    self._timer.setInterval(int(1000 / rate))
+    self._timer.timeout.connect(self._publish)
+    self._timer.start()
+
+  def publish(self, tracker : DownloadTracker):
+    """Thread safe, and cheap enough to call for every chunk"""
+    with self._lock:
+      self._pending[tracker.url] = tracker
+
+  def _publish(self):
+    with self._lock:
+      if len(self._pending) == 0:
+        return
+      changed, self._pending = list(self._pending.values()), {}
+
+    for tracker in changed:
+      self.batch.update(tracker)
+    self.snapshot_ready.emit(ProgressSnapshot(changed, self.batch.speed, self.batch.eta, str(self.batch)))
 
     
 class YoutubeDownloader:
+  # One pool for every YoutubeDownloader, started on the first download
+  _pool : Optional[DownloadProcessPool] = None
+
   def __init__(self):
-    pass
+    self._transcoder = Transcoder(config.get_storage_format(), config.get_transcode_workers())
+    atexit.register(self._transcoder.close)
 
 
   def _format_info_dict(self, info : dict):
@@ -135,16 +319,20 @@ class YoutubeDownloader:
     if info["status"] == "downloading":
       progress_object.status = 'downloading'
       
+      # The progress numbers are next to info_dict, not in it
+      progress_object.filename = info.get('filename', progress_object.filename)
+
       # Get the total bytes downloaded if provided
-      progress_object.total_bytes     = info_dict.get('total_bytes', 0)
+      progress_object.total_bytes     = info.get('total_bytes') or 0
       if progress_object.total_bytes == 0:
-        progress_object.total_bytes   = info_dict.get('total_bytes_estimate', 0)        
+        progress_object.total_bytes   = info.get('total_bytes_estimate') or 0
 
       # Get the rest of the download info
-      progress_object.speed            = format_bytes(info_dict.get('speed', 0))
-      progress_object.eta              = info_dict.get('eta')
-      progress_object.downloaded_bytes = info_dict.get('downloaded_bytes', 0)
-      progress_object.percent          = int(progress_object.downloaded_bytes) / int(progress_object.total_bytes) if progress_object.downloaded_bytes and progress_object.total_bytes else 0.0
+      progress_object.speed_bytes      = info.get('speed') or 0.0
+      progress_object.speed            = format_bytes(progress_object.speed_bytes)
+      progress_object.eta              = info.get('eta')
+      progress_object.downloaded_bytes = info.get('downloaded_bytes') or 0
+      progress_object.percent          = 100 * int(progress_object.downloaded_bytes) / int(progress_object.total_bytes) if progress_object.downloaded_bytes and progress_object.total_bytes else 0.0
       
     # Format the data once it's finished
     elif info['status'] == 'finished':
@@ -155,10 +343,9 @@ class YoutubeDownloader:
     
     return progress_object
 
-  def _download_progress_hook(self, emitter: ProgressSignalEmitter, info : dict):
-    progress_obj = self._format_info_dict(info)  
-    # Emit information in a TS way
-    emitter.progress_updated.emit(progress_obj)
+  def _download_progress_hook(self, progress_callback : Callable[[DownloadTracker], None], info : dict):
+    # Runs on the download's thread, for every chunk. progress_callback has to be thread safe (see ProgressBus.publish)
+    progress_callback(self._format_info_dict(info))
 
   def _get_percent_from_download_log(self, log_str : str) -> float:
    # Example string
@@ -167,69 +354,83 @@ class YoutubeDownloader:
       return 0
    return float(log_str[10:15].strip())
   
-  async def download_yt_video_with_hook(self, url: str, output_dir: str, progress_callback: Callable[[DownloadTracker], None]) -> tuple[int, DownloadTracker]:
+  def _build_ydl_options(self, output_dir : str) -> Dict[str, Any]:
+    # No hooks in here, these get sent to a worker process (see DownloadProcessPool).
+    # No postprocessing either, the Transcoder converts what comes out
+    return {
+      'format': 'bestaudio/best',
+      "quiet" : True,
+      "no_warnings" : True,
+      'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
+    }
 
-    # Create signal emitter
-    signal_emitter = ProgressSignalEmitter()
-    signal_emitter.progress_updated.connect(progress_callback)
-    
-    # Create progress hook with the signal emitter
-    progress_hook = partial(self._download_progress_hook, signal_emitter)
-    
+  def _converting_hook(self, progress_callback : Callable[[DownloadTracker], None], url : str):
+    tracker = DownloadTracker(url)
+    tracker.status  = 'converting'
+    tracker.percent = 100.0
+    progress_callback(tracker)
+
+  async def download_yt_video_with_hook(
+      self,
+      url               : str,
+      output_dir        : str,
+      progress_callback : Callable[[DownloadTracker], None],
+      skip_ids          : Iterable[str] = ()) -> tuple[int, DownloadTracker]:
+    """
+    Downloads `url` in one of the download worker processes, then converts it to the storage format.
+    Videos whose ID is in `skip_ids` (playlist entries already in the library) are left out.
+    Cancelling this kills the download (or ffmpeg) outright. The final files end up in the tracker's `files`,
+    even when the result isn't 0 (the playlist entries that did make it).
+    """
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
 
-    ydl_opts = {
-    'format': 'wav/bestaudio/best',
-    'extractaudio': True,
-      'postprocessors': [{
-          'key': 'FFmpegExtractAudio',
-          'preferredcodec': 'wav',
-          'preferredquality': '192',        
-      },
-      {
-        'key': 'FFmpegVideoConvertor',
-        'preferedformat': 'wav',
-      }
-      ],
-      # Trying to strongarm a palletable format so QtMediaOutput doesn't shit itself
-      'postprocessor_args': [
-        '-ar', '48000',      # Sample rate: 48kHz
-        '-ac', '2',          # Channels: stereo
-        '-sample_fmt', 's16' # Sample format: 16-bit signed integer
-      ],
-
-      'progress_hooks' : [progress_hook],
-      "quiet" : True,
-      "no_warnings" : True,
-      'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
-  }
-    
     tracker = DownloadTracker(url)
+    future  = YoutubeDownloader._get_pool().submit(
+      url,
+      self._build_ydl_options(output_dir),
+      partial(self._download_progress_hook, progress_callback),
+      partial(self._converting_hook, progress_callback),
+      skip_ids
+    )
 
     try:
-        
-      loop = asyncio.get_event_loop()
-
-      def download():
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-          return ydl.download([url])
-
-      result = await loop.run_in_executor(None, download)
-      return result, tracker
-
-    except yt_dlp.utils.DownloadError as err:
-        error_msg = str(err)
-        tracker.status = "error"
-
-        if "sign in" in error_msg or "unable to extract" in error_msg:
-          return -1, tracker # Youtube asking you if you're a bot
-        else :
-          return -2, tracker # Some other error
-        
-    except Exception as err:
-        tracker.status = "error"
-        return -3, tracker # heebee jeebies
+      result, error_msg, files = await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+      YoutubeDownloader._get_pool().cancel(future)
+      raise
+
+    if result != 0:
+      tracker.status = "error"
+      global_logger.warning(f"Download of {url} failed ({result}): {error_msg}")
+      # A playlist can fail partway, the entries that did finish are still kept
+
+    if any(self._transcoder.needs_transcode(file["filepath"]) for file in files):
+      self._converting_hook(progress_callback, url)
+    results = await self._transcoder.transcode_all([file["filepath"] for file in files])
+    tracker.files = [self._converted_file_info(file, path)
+                     for file, path in zip(files, results) if not isinstance(path, TranscodeError)]
+
+    failed = [error for error in results if isinstance(error, TranscodeError)]
+    for error in failed:
+      global_logger.warning(f"Converting a file from {url} failed: {error}")
+    if result == 0 and len(failed) > 0:
+      tracker.status = "error"
+      return -3, tracker
+    return result, tracker
+
+  def _converted_file_info(self, file : Dict[str, Any], path : str) -> Dict[str, Any]:
+    if path == file["filepath"]:
+      return file
+    # The stream yt-dlp described isn't the one that got stored anymore
+    return dict(file, filepath=path, sample_rate=TRANSCODE_SAMPLE_RATE, channels=TRANSCODE_CHANNELS)
+
+  @staticmethod
+  def _get_pool() -> DownloadProcessPool:
+    if YoutubeDownloader._pool is None:
+      YoutubeDownloader._pool = DownloadProcessPool(max_workers=config.get_download_workers())
+      atexit.register(YoutubeDownloader._pool.close)
+    return YoutubeDownloader._pool
 
 
 
@@ -238,10 +439,13 @@ class SpotifyDownloaderException(Exception):
   def __str__(self):
     return "[SpotifyDownloaderException]: " + super().__str__()
 
+class SpotifyDownloadCancelled(SpotifyDownloaderException):
+  pass
+
 class SpotifyDownloader:
 
 
-  def __init__(self):
+  def __init__(self, match_cache : MatchCache | None = None):
 
     # -- Initialize global spotify client --
     load_dotenv()
@@ -256,12 +460,27 @@ class SpotifyDownloader:
     spotdl.SpotifyClient.init(client_id=client_id, client_secret=client_sec)
     
     # -- Initialize the downloader object --
-    self._downloader = spotdl.Downloader()
-    self._downloader.settings['format'] = 'wav'
+    # spotdl is blocking (and runs its own event loop), so every job runs on this thread instead of
+    # the Qt one. One at a time, spotdl's own threads are what download the tracks of a playlist in parallel
+    self._executor   = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Spotify")
+    # Made on that thread too, so spotdl's event loop belongs to it
+    self._downloader = self._executor.submit(spotdl.Downloader, {"threads" : config.get_spotify_threads()}).result()
+    storage_format = STORAGE_FORMATS[config.get_storage_format()]
+    self._downloader.settings['format'] = storage_format.spotdl
+    if storage_format.args is None:
+      # No bitrate is what makes spotdl stream copy the audio, rather than encode it again
+      self._downloader.settings['bitrate'] = "disable"
     self._downloader.settings['output'] = ""
+    self._progress_callback : Callable[[DownloadTracker], None] | None = None
+    self._playlist          : Tuple[str, int, Dict[str, bool]] | None = None  # (link, track count, track link -> succeeded)
+    self._playlist_lock     = threading.Lock()
+    self._stop              : threading.Event | None = None  # Set to cancel the running job
+    self._downloader.progress_handler.update_callback = self._song_progress
+    # Spotify track -> YouTube video matches from earlier downloads
+    self._match_cache = match_cache
 
  
-  def download_song_from_url( self, url : str ):
+  def download_song_from_url( self, url : str ) -> List[Dict[str, Any]]:
     """  
     Downloads a track from the provided link. If you are unsure if your
     url links to a single track - use`download_link()`instead.
@@ -274,8 +493,11 @@ class SpotifyDownloader:
       raise SpotifyDownloaderException("No valid output path provided")
 
 
-    song_object = Song.from_url(url)
-    self._downloader.download_song(song_object)
+    # A cached match skips the Spotify API and the YouTube search
+    song_object = self._cached_song(url) or Song.from_url(url)
+    results = [self._downloader.download_song(song_object)]
+    self._remember_matches(results)
+    return self._file_infos(results)
   
 
   def set_download_dir(self, path : str):
@@ -285,30 +507,178 @@ class SpotifyDownloader:
       raise SpotifyDownloaderException("The provided path doesn't exist")
 
 
-  def download_playlist_from_url(self, playlist_url : str):
+  def download_playlist_from_url(self, playlist_url : str, skip_ids : Iterable[str] = ()) -> List[Dict[str, Any]]:
     """  
     Downloads a playlist from the provided link. If you are unsure if your
     url links to a playlist - use `download_link()` instead.
 
     Arguments:
       url {str} -- A valid Spotify link to a single track
+      skip_ids {Iterable[str]} -- IDs of tracks that are already in the library
     """
 
     if self._downloader.settings['output'] == '':
       raise SpotifyDownloaderException("No valid output path provided")
 
     playlist_object = Playlist.from_url(playlist_url)
-    self._downloader.download_multiple_songs(playlist_object.songs)
+    skip_ids = set(skip_ids)
+    songs = [song for song in playlist_object.songs if song.song_id not in skip_ids]
+    if len(songs) < len(playlist_object.songs):
+      global_logger.info(f"Skipping {len(playlist_object.songs) - len(songs)} tracks of {playlist_url} already in the library")
+
+    # The listing already came with fresh metadata, the cache only saves the YouTube searches
+    self._apply_cached_matches(songs)
+
+    if self._progress_callback is not None:
+      self._playlist = (playlist_url, len(songs), {})
+      self._report_playlist()
+    try:
+      results = self._downloader.download_multiple_songs(songs)
+      # The results are what counts, spotdl doesn't always report every track's last update
+      if self._playlist is not None:
+        self._report_playlist({song.url : path is not None for song, path in results})
+    finally:
+      self._playlist = None
+    self._remember_matches(results)
+    return self._file_infos(results)
   
+  async def download(
+      self,
+      link              : str,
+      skip_ids          : Iterable[str] = (),
+      progress_callback : Callable[[DownloadTracker], None] | None = None) -> List[Dict[str, Any]]:
+    """
+    download_link(), on the Spotify thread. Every track reports through `progress_callback`
+    (from spotdl's threads, so it has to be thread safe), and a playlist also reports how many
+    of its tracks are done under its own link.
+
+    Cancelling this stops the job at its tracks' next progress update, and only goes through
+    once the job has actually returned.
+    """
+    loop = asyncio.get_running_loop()
+    stop = threading.Event()
+    job  = loop.run_in_executor(self._executor, self._download_with_progress, link, skip_ids, progress_callback, stop)
+    try:
+      return await asyncio.shield(job)
+    except asyncio.CancelledError:
+      stop.set()
+      await asyncio.wait([job])
+      raise
+
+
+  def _download_with_progress(self, link : str, skip_ids : Iterable[str], progress_callback, stop : threading.Event) -> List[Dict[str, Any]]:
+    if stop.is_set():
+      raise SpotifyDownloadCancelled(f"Download of {link} was cancelled")  # Before it even got its turn
+    self._progress_callback = progress_callback
+    self._playlist          = None
+    self._stop              = stop
+    try:
+      return self.download_link(link, skip_ids)
+    finally:
+      self._progress_callback = None
+      self._stop              = None
+
+
+  def _song_progress(self, song_tracker, message : str):
+    # spotdl's ProgressHandler calls this for every update of every track.
+    # Raising in here fails the track, which is how a cancelled job gets through the rest of them quickly.
+    # Not on "Error" though, that's spotdl already failing it
+    if self._stop is not None and self._stop.is_set() and message != "Error":
+      raise SpotifyDownloadCancelled(f"Download of {song_tracker.song.url} was cancelled")
+    if self._progress_callback is None:
+      return
+    song = song_tracker.song
+    tracker = DownloadTracker(song.url)
+    tracker.filename = song.display_name
+    tracker.percent  = float(song_tracker.progress)
+
+    lowered = message.lower()
+    if "error" in lowered or "failed" in lowered:
+      tracker.status = "error"
+    elif song_tracker.progress >= 100 or lowered in ("done", "skipped"):
+      tracker.status  = "finished"
+      tracker.percent = 100.0
+    elif "convert" in lowered or "embedding" in lowered:
+      tracker.status = "converting"
+    else:
+      tracker.status = "downloading"
+    self._progress_callback(tracker)
+
+    if self._playlist is not None and tracker.status in ("finished", "error"):
+      self._report_playlist({song.url : tracker.status == "finished"})
+
+
+  def _report_playlist(self, outcomes : Dict[str, bool] = {}):
+    # Called from spotdl's threads, the counting has to be atomic
+    with self._playlist_lock:
+      playlist_url, total, done = self._playlist
+      done.update(outcomes)
+      finished = sum(done.values())
+      failed   = len(done) - finished
+
+    tracker = DownloadTracker(playlist_url)
+    if finished + failed < total:
+      tracker.status = "downloading"
+    else:
+      tracker.status = "error" if failed > 0 else "finished"
+    tracker.filename = f"{finished}/{total} tracks" + (f", {failed} failed" if failed > 0 else "")
+    tracker.percent  = 100 * (finished + failed) / total if total > 0 else 100.0
+    self._progress_callback(tracker)
+
   # 
-  def download_link(self, link : str):
+  def download_link(self, link : str, skip_ids : Iterable[str] = ()) -> List[Dict[str, Any]]:
      # Figure out if this is le playlist oder le song link
      # Playlists look like this: https://open.spotify.com/playlist/...
      # Songs look like this:     https://open.spotify.com/track/...
+     # Returns the downloaded files, in the same shape the YouTube downloads have them
 
     if "/playlist/" in link:
-      self.download_playlist_from_url(link)
+      return self.download_playlist_from_url(link, skip_ids)
     else:
-       self.download_song_from_url(link)
-
-
+       return self.download_song_from_url(link)
+
+
+  def _cached_song(self, url : str) -> Song | None:
+    if self._match_cache is None:
+      return None
+    track_id = urlsplit(url).path.rstrip("/").rsplit("/", 1)[-1]
+    cached = self._match_cache.get(track_id)
+    if cached is None:
+      return None
+    download_url, metadata = cached
+    song = Song.from_dict(metadata)
+    song.download_url = download_url  # spotdl skips its search for songs that already have one
+    return song
+
+
+  def _apply_cached_matches(self, songs : List[Song]):
+    if self._match_cache is None:
+      return
+    cached = self._match_cache.get_many([song.song_id for song in songs if song.download_url is None])
+    for song in songs:
+      if song.song_id in cached:
+        song.download_url = cached[song.song_id][0]
+
+
+  def _remember_matches(self, results : List[Tuple[Song, Any]]):
+    # spotdl leaves the link it picked on the song. Failed downloads aren't cached, the match might be why
+    if self._match_cache is None:
+      return
+    self._match_cache.put_many([(song.song_id, song.download_url, song.json)
+                                for song, path in results if path is not None and song.download_url])
+
+
+  def _file_infos(self, results : List[Tuple[Song, Any]]) -> List[Dict[str, Any]]:
+    # spotdl gives back (song, path or None if it failed)
+    return [{
+        "filepath"         : str(path),
+        "source_url"       : song.url,
+        "source_extractor" : SOURCE_SPOTIFY,
+        "source_id"        : song.song_id,
+        "title"            : song.name,
+        "duration"         : round(song.duration or 0),
+        "uploader"         : song.artist,
+        "thumbnail_url"    : song.cover_url,
+        "sample_rate"      : 0,   # spotdl converts it itself, so this has to be read from the file
+        "channels"         : 0,
+      } for song, path in results if path is not None]
@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import os
+import hashlib
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
+
+from mylogger import global_logger
+
+if TYPE_CHECKING:
+  from database import DatabaseConnection
+
+
+# "full"  hashes every byte of the file, so two files only collide if they're actually identical
+# "fast"  hashes the size plus the first and last FAST_BLOCK_SIZE bytes. Way cheaper for big files,
+#         and the blocks are big enough to be well into the audio data, not just the (mostly identical) headers
+HASH_MODES = ("full", "fast")
+
+CHUNK_SIZE      = 1024 * 1024  # 1 MB reads, hashlib drops the GIL while hashing these
+FAST_BLOCK_SIZE = 1024 * 1024
+
+
+def hash_file(path : str, mode : str = "full") -> str | None:
+  """Hash the contents of `path` with BLAKE2b. Returns None if the file can't be read."""
+  if mode not in HASH_MODES:
+    raise ValueError(f"Unknown hash mode: {mode}")
+
+  digest = hashlib.blake2b(digest_size=16)
+  buffer = bytearray(CHUNK_SIZE)
+  view   = memoryview(buffer)
+  try:
+    with open(path, "rb", buffering=0) as f:
+      size = os.fstat(f.fileno()).st_size
+
+      # Small enough files are always hashed in full, so there's no partial read weirdness
+      if mode == "full" or size <= 2 * FAST_BLOCK_SIZE:
+        while (read := f.readinto(buffer)):
+          digest.update(view[:read])
+      else:
+        digest.update(size.to_bytes(8, "little"))
+        read = f.readinto(buffer)
+        digest.update(view[:read])
+        f.seek(-FAST_BLOCK_SIZE, os.SEEK_END)
+        read = f.readinto(buffer)
+        digest.update(view[:read])
+
+  except OSError as e:
+    global_logger.warning(f"Could not hash {path}: {e}")
+    return None
+
+  return digest.hexdigest()
+
+
+class FileHasher:
+  """
+  Hashes files, and remembers the results by (device, inode, size, mtime) in the hash_cache table,
+  so a file that didn't change is never read twice.
+  """
+
+  def __init__(self, db_connection : DatabaseConnection, mode : str = "full"):
+    if mode not in HASH_MODES:
+      raise ValueError(f"Unknown hash mode: {mode}")
+    self._db_connection = db_connection
+    self.mode = mode
+
+
+  def hash_file(self, path : str) -> str | None:
+    return self.hash_files([path])[0]
+
+
+  def hash_files(self, paths : List[str], pool : Optional[Executor] = None) -> List[str | None]:
+    """Hash every file in `paths`, reusing cached results. Uncached files are hashed on `pool`
+    (or a temporary thread pool). Results are in the same order as `paths`."""
+    keys : List[Tuple[int, int, int, int] | None] = []
+    for path in paths:
+      try:
+        stat = os.stat(path)
+        keys.append((stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+      except OSError:
+        keys.append(None)
+
+    cached  = self._db_connection.get_cached_hashes([k for k in keys if k is not None], self.mode)
+    results : List[str | None] = [cached.get(k) if k is not None else None for k in keys]
+    misses  = [i for i, k in enumerate(keys) if k is not None and results[i] is None]
+    if len(misses) == 0:
+      return results
+
+    miss_paths = [paths[i] for i in misses]
+    modes      = [self.mode] * len(miss_paths)
+    if pool is not None:
+      hashes = list(pool.map(hash_file, miss_paths, modes))
+    elif len(miss_paths) == 1:
+      hashes = [hash_file(miss_paths[0], self.mode)]
+    else:
+      with ThreadPoolExecutor() as temp_pool:
+        hashes = list(temp_pool.map(hash_file, miss_paths, modes))
+
+    new_entries : List[Tuple[int, int, int, int, str, str]] = []
+    for i, file_hash in zip(misses, hashes):
+      results[i] = file_hash
+      if file_hash is not None:
+        new_entries.append((*keys[i], self.mode, file_hash))
+    self._db_connection.cache_hashes(new_entries)
+
+    return results
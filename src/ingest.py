@@ -0,0 +1,319 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, Any, Iterable, Iterator, List, Optional, Tuple
+
+import utility as util
+from async_database import AsyncDatabase
+from database import DatabaseConnection
+from mylogger import global_logger
+
+from PySide6.QtCore import QObject, QFileSystemWatcher, QTimer, Signal
+
+
+# Progress callback gets (files processed so far, songs added so far)
+IngestProgressCallback = Callable[[int, int], None]
+
+
+class LibraryIngest:
+  """
+  Adds audio files to the songs table in batches:
+    1. the folder is streamed with os.scandir, and files already in the table are skipped
+    2. each batch is hashed and probed on a thread pool
+    3. the batch is written with a single executemany transaction
+  """
+
+  def __init__(
+      self,
+      db_connection     : DatabaseConnection,
+      batch_size        : int = 500,
+      max_workers       : int | None = None,
+      progress_callback : Optional[IngestProgressCallback] = None):
+    self._db_connection = db_connection
+    self._batch_size    = batch_size
+    # hashlib and libsndfile both release the GIL while reading, so threads are enough here
+    self._max_workers   = max_workers if max_workers is not None else min(32, (os.cpu_count() or 1) + 4)
+    self._progress_callback = progress_callback
+
+
+  def ingest_directory(self, path : str) -> int:
+    """Add every audio file in `path` that isn't already in the library. Returns the amount added."""
+    return self.ingest_files(util.iter_audio_files(path))
+
+
+  def ingest_files(self, paths : Iterable[str]) -> int:
+    """Add the given files that aren't already in the library. Returns the amount added."""
+    known_paths = self._db_connection.get_all_song_paths()
+    new_paths   = (p for p in paths if p not in known_paths)
+
+    processed = 0
+    added     = 0
+    with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+      for batch in self._batched(new_paths):
+        rows = self._prepare_batch(batch, pool)
+        added     += self._db_connection.create_songs(rows)
+        processed += len(batch)
+
+        global_logger.debug(f"LibraryIngest processed {processed} files, added {added}")
+        if self._progress_callback is not None:
+          self._progress_callback(processed, added)
+
+    return added
+
+
+  def ingest_downloads(self, files : List[Dict[str, Any]]) -> int:
+    """
+    Add the files a download produced, using what the downloader already knew about them
+    (see DownloadProcessPool for the keys). Nothing else in the folder is looked at, so this
+    costs the same however big the library is. Returns the amount added.
+    """
+    if len(files) == 0:
+      return 0
+
+    with ThreadPoolExecutor(max_workers=min(self._max_workers, len(files))) as pool:
+      rows   = [row for row in pool.map(self._prepare_download, files) if row is not None]
+      hashes = self._db_connection.hasher.hash_files([row["file_path"] for row in rows], pool)
+    for row, file_hash in zip(rows, hashes):
+      row["file_hash"] = file_hash
+
+    added = self._db_connection.create_songs(rows)
+    global_logger.debug(f"LibraryIngest added {added} of {len(files)} downloaded files")
+    return added
+
+
+  def rescan_directory(self, path : str) -> Dict[str, int]:
+    """
+    Bring the songs in `path` up to date with what's on disk, using the stored fingerprints.
+    Only new, changed, moved, or removed files cause any hashing or DB writes.
+    Returns how many songs were added, updated, renamed, and removed.
+    """
+    directory    = os.path.normpath(path)
+    fingerprints = self._db_connection.get_song_fingerprints()
+
+    seen_paths   : set[str]                  = set()
+    new_files    : List[Tuple[str, os.stat_result]] = []
+    changed      : List[Tuple[int, str]]     = []
+    unrecorded   : List[Tuple[int, int, int, int]] = []
+
+    with os.scandir(path) as entries:
+      for entry in entries:
+        if not entry.is_file() or os.path.splitext(entry.name)[1][1:].lower() not in util.AUDIO_EXTENSIONS:
+          continue
+
+        stat = entry.stat()
+        fingerprint = fingerprints.get(entry.path)
+        if fingerprint is None:
+          new_files.append((entry.path, stat))
+          continue
+
+        seen_paths.add(entry.path)
+        song_id, inode, size, mtime_ns = fingerprint
+        if inode is None:
+          # Song was added before fingerprints existed, trust it and just remember what it looks like
+          unrecorded.append((song_id, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        elif (inode, size, mtime_ns) != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+          changed.append((song_id, entry.path))
+
+    # Anything from this folder that wasn't seen has either been moved or deleted
+    missing = {song_path : fingerprint for song_path, fingerprint in fingerprints.items()
+               if os.path.dirname(os.path.normpath(song_path)) == directory and song_path not in seen_paths}
+
+    # A new file with the same inode and size as a missing one is the same file, just renamed
+    missing_by_inode = {(fp[1], fp[2]) : song_path for song_path, fp in missing.items() if fp[1] is not None}
+    renames   : List[Tuple[int, str, int, int, int]] = []
+    new_paths : List[str] = []
+    for new_path, stat in new_files:
+      old_path = missing_by_inode.pop((stat.st_ino, stat.st_size), None)
+      if old_path is None:
+        new_paths.append(new_path)
+        continue
+      renames.append((missing.pop(old_path)[0], new_path, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+
+    result = {"added" : 0, "updated" : 0, "renamed" : 0, "removed" : 0}
+    if len(unrecorded) > 0:
+      self._db_connection.set_song_fingerprints(unrecorded)
+    if len(renames) > 0:
+      result["renamed"] = self._db_connection.rename_songs(renames)
+    if len(missing) > 0:
+      result["removed"] = self._db_connection.delete_songs([fp[0] for fp in missing.values()])
+    if len(changed) > 0:
+      ids_by_path = {song_path : song_id for song_id, song_path in changed}
+      with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+        rows = self._prepare_batch(list(ids_by_path.keys()), pool)
+      for row in rows:
+        row["id"] = ids_by_path[row["file_path"]]
+      result["updated"] = self._db_connection.update_songs_file_info(rows)
+      # The old contents' hashes aren't anyone's anymore
+      self._db_connection.prune_hash_cache()
+    if len(new_paths) > 0:
+      result["added"] = self.ingest_files(new_paths)
+
+    global_logger.debug(f"LibraryIngest rescanned {path}: {result}")
+    return result
+
+
+  def _batched(self, paths : Iterator[str]) -> Iterator[List[str]]:
+    while True:
+      batch = list(islice(paths, self._batch_size))
+      if len(batch) == 0:
+        return
+      yield batch
+
+
+  def _prepare_batch(self, paths : List[str], pool : ThreadPoolExecutor) -> List[Dict[str, Any]]:
+    rows   = list(pool.map(self._prepare_song, paths))
+    hashes = self._db_connection.hasher.hash_files(paths, pool)
+    for row, file_hash in zip(rows, hashes):
+      if row is not None:
+        row["file_hash"] = file_hash
+    return [row for row in rows if row is not None]
+
+
+  def _prepare_song(self, path : str) -> Dict[str, Any] | None:
+    # Runs on the worker threads, so this must not touch the DB connection
+    try:
+      stat = os.stat(path)
+    except OSError as e:
+      global_logger.warning(f"LibraryIngest skipping {path}: {e}")
+      return None
+
+    title = os.path.basename(path)
+    stream_info = util.probe_audio_file(path)
+    return {
+      "file_path"      : path,
+      "original_title" : title,
+      "user_title"     : title,
+      "duration"       : stream_info["duration"],
+      "file_size"      : stat.st_size,
+      "file_hash"      : None,  # Filled in by _prepare_batch, so the hash cache can be used
+      "user_note"      : "",
+      "sample_rate"    : stream_info["sample_rate"],
+      "channels"       : stream_info["channels"],
+      "frames"         : stream_info["frames"],
+      "inode"          : stat.st_ino,
+      "mtime_ns"       : stat.st_mtime_ns,
+    }
+
+
+
+  def _prepare_download(self, file : Dict[str, Any]) -> Dict[str, Any] | None:
+    # Runs on the worker threads. The file only gets probed if the downloader didn't know its stream
+    try:
+      stat = os.stat(file["filepath"])
+    except OSError as e:
+      global_logger.warning(f"LibraryIngest skipping download {file['filepath']}: {e}")
+      return None
+
+    if file["duration"] > 0 and file["sample_rate"] > 0:
+      stream_info = {
+        "duration"    : file["duration"],
+        "sample_rate" : file["sample_rate"],
+        "channels"    : file["channels"],
+        "frames"      : None,  # Unknown until something reads the file, nobody reports the exact count
+      }
+    else:
+      stream_info = util.probe_audio_file(file["filepath"])
+      if file["duration"] > 0:
+        stream_info["duration"] = file["duration"]
+
+    title = file["title"] or os.path.basename(file["filepath"])
+    return {
+      "file_path"        : file["filepath"],
+      "original_title"   : title,
+      "user_title"       : title,
+      "duration"         : stream_info["duration"],
+      "file_size"        : stat.st_size,
+      "file_hash"        : None,
+      "user_note"        : "",
+      "sample_rate"      : stream_info["sample_rate"],
+      "channels"         : stream_info["channels"],
+      "frames"           : stream_info["frames"],
+      "source_url"       : file["source_url"],
+      "source_extractor" : file["source_extractor"],
+      "source_id"        : file["source_id"],
+      "uploader"         : file["uploader"],
+      "thumbnail_url"    : file["thumbnail_url"],
+      "inode"            : stat.st_ino,
+      "mtime_ns"         : stat.st_mtime_ns,
+    }
+
+
+
+class LibraryWatcher(QObject):
+  """
+  Watches the download folder (inotify/ReadDirectoryChangesW through QFileSystemWatcher)
+  and runs an incremental rescan once things settle down. The rescan itself (hashing,
+  probing, writing) runs on the database's background thread, never on the Qt one.
+  """
+
+  library_changed = Signal(dict)  # The result of LibraryIngest.rescan_directory()
+
+  # Downloads write a bunch of temporary files, so wait for a quiet moment before rescanning
+  SETTLE_DELAY_MS = 750
+
+  def __init__(self, library_ingest : LibraryIngest, async_db : AsyncDatabase):
+    super().__init__()
+    self._library_ingest = library_ingest
+    self._async_db       = async_db
+    self._rescan_tasks : set[asyncio.Task] = set()
+    self._pending_dirs : set[str] = set()
+    self._paused       = 0
+
+    self._watcher = QFileSystemWatcher()
+    self._watcher.directoryChanged.connect(self._handle_directory_changed)
+
+    self._settle_timer = QTimer()
+    self._settle_timer.setSingleShot(True)
+    self._settle_timer.setInterval(LibraryWatcher.SETTLE_DELAY_MS)
+    self._settle_timer.timeout.connect(self._rescan_pending)
+
+
+  def watch_directory(self, path : str):
+    """Stop watching whatever was watched before, and watch `path` instead"""
+    if len(self._watcher.directories()) > 0:
+      self._watcher.removePaths(self._watcher.directories())
+    self._pending_dirs.clear()
+    if os.path.isdir(path):
+      self._watcher.addPath(path)
+
+
+  def pause(self):
+    """Hold off rescanning until resume(). Downloads add their own files (see LibraryIngest.ingest_downloads),
+    so the folder doesn't have to be rescanned for every one of them. Changes in the meantime still get
+    one rescan afterwards, which also picks up whatever a failed download left behind."""
+    self._paused += 1
+    self._settle_timer.stop()
+
+
+  def resume(self):
+    self._paused = max(0, self._paused - 1)
+    if self._paused == 0 and len(self._pending_dirs) > 0:
+      self._settle_timer.start()
+
+
+  def _handle_directory_changed(self, path : str):
+    self._pending_dirs.add(path)
+    if self._paused == 0:
+      self._settle_timer.start()
+
+
+  def _rescan_pending(self):
+    pending, self._pending_dirs = self._pending_dirs, set()
+    task = asyncio.ensure_future(self._rescan(pending))
+    # The event loop only keeps weak references to tasks
+    self._rescan_tasks.add(task)
+    task.add_done_callback(self._rescan_tasks.discard)
+
+
+  async def _rescan(self, paths : Iterable[str]):
+    for path in paths:
+      if not os.path.isdir(path):
+        continue
+      try:
+        result = await self._async_db.run_background(self._library_ingest.rescan_directory, path)
+      except Exception as e:
+        global_logger.error(f"Rescanning {path} failed: {e}")
+        continue
+      if any(result.values()):
+        self.library_changed.emit(result)
@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import threading
+from typing import Any, Callable, Dict, FrozenSet, Hashable, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from database import DatabaseConnection, Song, Playlist
+
+
+class LibraryCache:
+  """
+  Keeps the song and playlist lists the UI asks for over and over in memory.
+
+  Every entry remembers the write generations (see DatabaseConnection.generations()) of the
+  tables it was read from. As long as those haven't moved, the entry is handed back without
+  touching sqlite. Entries are tuples of records, so they're immutable snapshots and can be
+  shared between callers and threads.
+  """
+
+  def __init__(self, db_connection : DatabaseConnection):
+    self._db_connection = db_connection
+    self._lock = threading.Lock()
+    # key -> (generations when it was read, value)
+    self._entries : Dict[Hashable, Tuple[Tuple[int, ...], Any]] = {}
+
+
+  def _get(self, key : Hashable, tables : Tuple[str, ...], load : Callable[[], Any]) -> Any:
+    # The generations are read before the data, so if a write lands in between,
+    # the entry just looks out of date next time instead of stale data looking current
+    generations = self._db_connection.generations(*tables)
+    with self._lock:
+      entry = self._entries.get(key)
+    if entry is not None and entry[0] == generations:
+      return entry[1]
+
+    value = load()
+    with self._lock:
+      self._entries[key] = (generations, value)
+    return value
+
+
+  def get_all_songs(self) -> Tuple[Song, ...]:
+    return self._get("songs", ("songs",), lambda: tuple(self._db_connection.get_all_songs()))
+
+
+  def get_all_playlists(self) -> Tuple[Playlist, ...]:
+    return self._get("playlists", ("playlists",), lambda: tuple(self._db_connection.get_all_playlists()))
+
+
+  def get_songs_by_playlist_id(self, playlist_id : int) -> Tuple[Song, ...]:
+    return self._get(("playlist_songs", playlist_id), ("songs", "playlists_songs"),
+                     lambda: tuple(self._db_connection.get_songs_by_playlist_id(playlist_id)))
+
+
+  def get_song_titles(self) -> FrozenSet[str]:
+    return self._get("song_titles", ("songs",),
+                     lambda: frozenset(song.user_title for song in self.get_all_songs()))
+
+
+  def get_playlist_names(self) -> FrozenSet[str]:
+    return self._get("playlist_names", ("playlists",),
+                     lambda: frozenset(playlist.name for playlist in self.get_all_playlists()))
+
+
+  def invalidate(self):
+    """Drop everything, e.g. after the database was changed by something other than DatabaseConnection"""
+    with self._lock:
+      self._entries.clear()
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import json
+import time
+from typing import Any, Callable, Dict, List, Tuple, TYPE_CHECKING
+
+from mylogger import global_logger
+
+if TYPE_CHECKING:
+  from database import DatabaseConnection
+
+
+class MatchCache:
+  """
+  Remembers which YouTube video each Spotify track was matched to, along with the track's
+  metadata, in the spotify_matches table. A hit means spotdl can skip both the Spotify API
+  lookup and the YouTube search.
+
+  Entries older than `ttl` seconds are treated as missing (videos get taken down, better
+  matches show up), and only the `max_entries` most recently used ones are kept.
+  Nothing in here knows about spotdl, entries are plain JSON-able dicts. `clock` is there
+  so time can be faked.
+  """
+
+  def __init__(
+      self,
+      db_connection : DatabaseConnection,
+      ttl           : float = 30 * 24 * 60 * 60,
+      max_entries   : int = 5000,
+      clock         : Callable[[], float] = time.time):
+    self._db_connection = db_connection
+    self._ttl           = ttl
+    self._max_entries   = max_entries
+    self._clock         = clock
+
+
+  def get_many(self, track_ids : List[str]) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+    """track_id -> (download_url, metadata) for every track with a fresh entry"""
+    if len(track_ids) == 0:
+      return {}
+    now = int(self._clock())
+    found = self._db_connection.get_spotify_matches(track_ids, int(now - self._ttl), now)
+    return {track_id : (download_url, json.loads(song_json)) for track_id, (download_url, song_json) in found.items()}
+
+
+  def get(self, track_id : str) -> Tuple[str, Dict[str, Any]] | None:
+    return self.get_many([track_id]).get(track_id)
+
+
+  def put_many(self, entries : List[Tuple[str, str, Dict[str, Any]]]):
+    """Store (track_id, download_url, metadata) entries"""
+    if len(entries) == 0:
+      return
+    now = int(self._clock())
+    self._db_connection.cache_spotify_matches(
+      [(track_id, download_url, json.dumps(metadata)) for track_id, download_url, metadata in entries],
+      now, self._max_entries, int(now - self._ttl))
+    global_logger.debug(f"MatchCache stored {len(entries)} Spotify matches")
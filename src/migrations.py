@@ -0,0 +1,335 @@
+import sqlite3
+from typing import Callable, Dict, List, Tuple
+
+from mylogger import global_logger
+
+
+# ------ Schema Migrations ------
+# Every entry of MIGRATIONS upgrades the database by one version, and the version a database
+# is at is kept in PRAGMA user_version. Version 0 is an empty file, or a database from before
+# migrations existed. Those may already have some of what the early migrations add, so
+# everything up to version 6 is written to be safe to run again.
+#
+# Never edit a migration that already shipped, append a new one instead.
+
+Migration = Callable[[sqlite3.Cursor], None]
+
+
+def _add_columns(cursor : sqlite3.Cursor, table : str, columns : Dict[str, str]):
+  cursor.execute(f"PRAGMA table_info({table})")
+  existing = {row[1] for row in cursor.fetchall()}
+  for name, definition in columns.items():
+    if name not in existing:
+      cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+def _v1_baseline(cursor : sqlite3.Cursor):
+  """The schema data/schema.db was first shipped with"""
+  for statement in [
+    """CREATE TABLE IF NOT EXISTS songs (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      file_path TEXT NOT NULL UNIQUE,
+      original_title TEXT,
+      user_title TEXT,
+      duration INTEGER,  -- seconds
+      file_size INTEGER, -- bytes
+      file_hash TEXT,    -- detect file moves
+      user_note TEXT,
+      date_added DATETIME DEFAULT CURRENT_TIMESTAMP,
+      date_modified DATETIME DEFAULT CURRENT_TIMESTAMP,
+      play_count INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS playlists (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      name TEXT NOT NULL,
+      description TEXT,
+      date_created DATETIME DEFAULT CURRENT_TIMESTAMP,
+      date_modified DATETIME DEFAULT CURRENT_TIMESTAMP,
+      total_duration INTEGER DEFAULT 0,  -- seconds
+      song_count INTEGER DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS playlists_songs (
+      id          INTEGER PRIMARY KEY AUTOINCREMENT,
+      playlist_id INTEGER NOT NULL,
+      song_id     INTEGER NOT NULL,
+      position    INTEGER NOT NULL, -- Position of song within a playlist
+      date_added  DATETIME DEFAULT CURRENT_TIMESTAMP,
+      FOREIGN KEY (playlist_id) REFERENCES playlists(id) ON DELETE CASCADE,
+      FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE,
+      UNIQUE(playlist_id, song_id),  -- Prevent dupes
+      UNIQUE(playlist_id, position)  -- Unique positions within playlist
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_songs_title ON songs(user_title, original_title)",
+    "CREATE INDEX IF NOT EXISTS idx_songs_file_path ON songs(file_path)",
+    "CREATE INDEX IF NOT EXISTS idx_songs_file_hash ON songs(file_hash)",
+    "CREATE INDEX IF NOT EXISTS idx_playlists_name ON playlists(name)",
+    "CREATE INDEX IF NOT EXISTS idx_playlist_songs_playlist ON playlists_songs(playlist_id)",
+    "CREATE INDEX IF NOT EXISTS idx_playlist_songs_position ON playlists_songs(playlist_id, position)",
+    """CREATE TRIGGER IF NOT EXISTS update_playlist_modified_date AFTER INSERT ON playlists_songs BEGIN
+      UPDATE playlists
+      SET date_modified = CURRENT_TIMESTAMP,
+          song_count = (SELECT COUNT(*) FROM playlists_songs WHERE playlist_id = NEW.playlist_id)
+      WHERE id = NEW.playlist_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS update_playlist_modified_date_delete AFTER DELETE ON playlists_songs BEGIN
+      UPDATE playlists
+      SET date_modified = CURRENT_TIMESTAMP,
+          song_count = (SELECT COUNT(*) FROM playlists_songs WHERE playlist_id = OLD.playlist_id)
+      WHERE id = OLD.playlist_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS update_song_modified_date AFTER UPDATE ON songs BEGIN
+      UPDATE songs SET date_modified = CURRENT_TIMESTAMP WHERE id = NEW.id;
+    END""",
+  ]:
+    cursor.execute(statement)
+
+
+def _v2_file_tracking(cursor : sqlite3.Cursor):
+  # Last seen (inode, size, mtime) of each song's file, so rescans only touch files that changed
+  cursor.execute("""CREATE TABLE IF NOT EXISTS file_fingerprints (
+    song_id   INTEGER PRIMARY KEY,
+    inode     INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    FOREIGN KEY (song_id) REFERENCES songs(id) ON DELETE CASCADE
+  )""")
+  # Content hashes keyed by what the file looked like when it was hashed
+  cursor.execute("""CREATE TABLE IF NOT EXISTS hash_cache (
+    inode     INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    mode      TEXT    NOT NULL,
+    file_hash TEXT    NOT NULL,
+    PRIMARY KEY (inode, file_size, mtime_ns, mode)
+  ) WITHOUT ROWID""")
+
+
+def _v3_full_text_search(cursor : sqlite3.Cursor):
+  # External content tables, so they only store the index, and the triggers keep them in sync
+  for statement in [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(
+      user_title, original_title, user_note,
+      content='songs', content_rowid='id',
+      tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS songs_fts_insert AFTER INSERT ON songs BEGIN
+      INSERT INTO songs_fts (rowid, user_title, original_title, user_note)
+      VALUES (NEW.id, NEW.user_title, NEW.original_title, NEW.user_note);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS songs_fts_delete AFTER DELETE ON songs BEGIN
+      INSERT INTO songs_fts (songs_fts, rowid, user_title, original_title, user_note)
+      VALUES ('delete', OLD.id, OLD.user_title, OLD.original_title, OLD.user_note);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS songs_fts_update AFTER UPDATE OF user_title, original_title, user_note ON songs BEGIN
+      INSERT INTO songs_fts (songs_fts, rowid, user_title, original_title, user_note)
+      VALUES ('delete', OLD.id, OLD.user_title, OLD.original_title, OLD.user_note);
+      INSERT INTO songs_fts (rowid, user_title, original_title, user_note)
+      VALUES (NEW.id, NEW.user_title, NEW.original_title, NEW.user_note);
+    END""",
+
+    """CREATE VIRTUAL TABLE IF NOT EXISTS playlists_fts USING fts5(
+      name,
+      content='playlists', content_rowid='id',
+      tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS playlists_fts_insert AFTER INSERT ON playlists BEGIN
+      INSERT INTO playlists_fts (rowid, name) VALUES (NEW.id, NEW.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS playlists_fts_delete AFTER DELETE ON playlists BEGIN
+      INSERT INTO playlists_fts (playlists_fts, rowid, name) VALUES ('delete', OLD.id, OLD.name);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS playlists_fts_update AFTER UPDATE OF name ON playlists BEGIN
+      INSERT INTO playlists_fts (playlists_fts, rowid, name) VALUES ('delete', OLD.id, OLD.name);
+      INSERT INTO playlists_fts (rowid, name) VALUES (NEW.id, NEW.name);
+    END""",
+
+    # Index whatever was already in the tables
+    "INSERT INTO songs_fts (songs_fts) VALUES ('rebuild')",
+    "INSERT INTO playlists_fts (playlists_fts) VALUES ('rebuild')",
+  ]:
+    cursor.execute(statement)
+
+
+def _v4_stream_info(cursor : sqlite3.Cursor):
+  _add_columns(cursor, "songs", {
+    "sample_rate" : "INTEGER DEFAULT 0",
+    "channels"    : "INTEGER DEFAULT 0",
+    "frames"      : "INTEGER DEFAULT 0",
+  })
+
+
+# Counts and durations of every playlist, worked out from scratch
+RECOMPUTE_PLAYLIST_AGGREGATES = """
+  UPDATE playlists SET
+    song_count     = (SELECT COUNT(*) FROM playlists_songs ps WHERE ps.playlist_id = playlists.id),
+    total_duration = (SELECT COALESCE(SUM(s.duration), 0) FROM playlists_songs ps
+                      JOIN songs s ON s.id = ps.song_id WHERE ps.playlist_id = playlists.id)
+"""
+
+def _v5_playlist_aggregates(cursor : sqlite3.Cursor):
+  # song_count and total_duration are kept up to date by deltas,
+  # instead of recounting the whole playlist every time a song goes in or out
+  for statement in [
+    "DROP TRIGGER IF EXISTS update_playlist_modified_date",
+    "DROP TRIGGER IF EXISTS update_playlist_modified_date_delete",
+    """CREATE TRIGGER IF NOT EXISTS playlists_songs_aggregate_insert AFTER INSERT ON playlists_songs BEGIN
+      UPDATE playlists
+      SET date_modified  = CURRENT_TIMESTAMP,
+          song_count     = song_count + 1,
+          total_duration = total_duration + COALESCE((SELECT duration FROM songs WHERE id = NEW.song_id), 0)
+      WHERE id = NEW.playlist_id;
+    END""",
+    # When this runs because a song got deleted, the song row is already gone and its
+    # duration comes out as 0. songs_aggregate_delete below takes it off beforehand.
+    """CREATE TRIGGER IF NOT EXISTS playlists_songs_aggregate_delete AFTER DELETE ON playlists_songs BEGIN
+      UPDATE playlists
+      SET date_modified  = CURRENT_TIMESTAMP,
+          song_count     = song_count - 1,
+          total_duration = total_duration - COALESCE((SELECT duration FROM songs WHERE id = OLD.song_id), 0)
+      WHERE id = OLD.playlist_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS songs_aggregate_delete BEFORE DELETE ON songs BEGIN
+      UPDATE playlists
+      SET total_duration = total_duration - COALESCE(OLD.duration, 0)
+      WHERE id IN (SELECT playlist_id FROM playlists_songs WHERE song_id = OLD.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS songs_aggregate_duration AFTER UPDATE OF duration ON songs
+    WHEN OLD.duration IS NOT NEW.duration BEGIN
+      UPDATE playlists
+      SET total_duration = total_duration + COALESCE(NEW.duration, 0) - COALESCE(OLD.duration, 0)
+      WHERE id IN (SELECT playlist_id FROM playlists_songs WHERE song_id = NEW.id);
+    END""",
+    # Nothing kept total_duration up to date before this
+    RECOMPUTE_PLAYLIST_AGGREGATES,
+  ]:
+    cursor.execute(statement)
+
+
+def _v6_index_cleanup(cursor : sqlite3.Cursor):
+  # Looking up the playlists a song is in (removing it from them, the aggregate triggers,
+  # the ON DELETE CASCADE) had no index to use, since both UNIQUE indexes start with playlist_id
+  cursor.execute("CREATE INDEX IF NOT EXISTS idx_playlist_songs_song ON playlists_songs(song_id)")
+  # These are exact copies (or prefixes) of the indexes the UNIQUE constraints already made,
+  # so all they did was slow down writes
+  cursor.execute("DROP INDEX IF EXISTS idx_songs_file_path")
+  cursor.execute("DROP INDEX IF EXISTS idx_playlist_songs_playlist")
+  cursor.execute("DROP INDEX IF EXISTS idx_playlist_songs_position")
+  # Give the query planner statistics to work with
+  cursor.execute("ANALYZE")
+
+
+def _v7_download_queue(cursor : sqlite3.Cursor):
+  # Downloads waiting to happen (or being retried), so they survive a restart.
+  # Rows are removed once they finish, run out of attempts, or get cancelled
+  cursor.execute("""CREATE TABLE IF NOT EXISTS download_queue (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    url        TEXT    NOT NULL,
+    source     TEXT    NOT NULL,            -- 'youtube' or 'spotify'
+    priority   INTEGER NOT NULL DEFAULT 0,  -- Higher goes first
+    status     TEXT    NOT NULL DEFAULT 'pending',
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    date_added DATETIME DEFAULT CURRENT_TIMESTAMP
+  )""")
+  cursor.execute("CREATE INDEX IF NOT EXISTS idx_download_queue_status ON download_queue(status, priority DESC, id)")
+
+
+def _v8_song_sources(cursor : sqlite3.Cursor):
+  # Where a downloaded song came from, so the same link isn't downloaded twice.
+  # source_extractor is 'youtube' or 'spotify', source_id the video/track ID. Songs added from disk leave them NULL
+  _add_columns(cursor, "songs", {
+    "source_url"       : "TEXT",
+    "source_extractor" : "TEXT",
+    "source_id"        : "TEXT",
+  })
+  cursor.execute("""CREATE UNIQUE INDEX IF NOT EXISTS idx_songs_source
+    ON songs(source_extractor, source_id) WHERE source_id IS NOT NULL""")
+
+
+def _v9_download_metadata(cursor : sqlite3.Cursor):
+  # What the site said about a downloaded song, kept from the download instead of being worked out from the file
+  _add_columns(cursor, "songs", {
+    "uploader"      : "TEXT",
+    "thumbnail_url" : "TEXT",
+  })
+
+
+def _v10_spotify_matches(cursor : sqlite3.Cursor):
+  # Which YouTube video spotdl matched each Spotify track to, and the track's metadata, so a
+  # re-download skips both the Spotify API and the YouTube search. Times are unix seconds
+  cursor.execute("""CREATE TABLE IF NOT EXISTS spotify_matches (
+    track_id     TEXT    PRIMARY KEY,
+    download_url TEXT    NOT NULL,
+    song_json    TEXT    NOT NULL,
+    fetched_at   INTEGER NOT NULL,  -- For the TTL
+    last_used    INTEGER NOT NULL   -- For LRU eviction
+  ) WITHOUT ROWID""")
+  cursor.execute("CREATE INDEX IF NOT EXISTS idx_spotify_matches_last_used ON spotify_matches(last_used)")
+
+
+def _v11_spotify_match_lru(cursor : sqlite3.Cursor):
+  # Matches used at the same second get evicted oldest fetched first, the index covers that order too
+  cursor.execute("DROP INDEX IF EXISTS idx_spotify_matches_last_used")
+  cursor.execute("CREATE INDEX IF NOT EXISTS idx_spotify_matches_lru ON spotify_matches(last_used, fetched_at)")
+
+
+def _v12_hash_cache_device(cursor : sqlite3.Cursor):
+  # Inodes are only unique per filesystem, so the device is part of the key now. The old rows
+  # don't say which device they came from, they're dropped and get rebuilt as files are hashed
+  cursor.execute("DROP TABLE IF EXISTS hash_cache")
+  cursor.execute("""CREATE TABLE hash_cache (
+    device    INTEGER NOT NULL,
+    inode     INTEGER NOT NULL,
+    file_size INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    mode      TEXT    NOT NULL,
+    file_hash TEXT    NOT NULL,
+    PRIMARY KEY (device, inode, file_size, mtime_ns, mode)
+  ) WITHOUT ROWID""")
+
+
+MIGRATIONS : List[Migration] = [
+  _v1_baseline,
+  _v2_file_tracking,
+  _v3_full_text_search,
+  _v4_stream_info,
+  _v5_playlist_aggregates,
+  _v6_index_cleanup,
+  _v7_download_queue,
+  _v8_song_sources,
+  _v9_download_metadata,
+  _v10_spotify_matches,
+  _v11_spotify_match_lru,
+  _v12_hash_cache_device,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(connection : sqlite3.Connection) -> int:
+  return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(connection : sqlite3.Connection) -> Tuple[int, int]:
+  """Bring the database up to SCHEMA_VERSION. Each migration runs in its own transaction,
+  together with bumping the version, so a failed one leaves the database at the last good version.
+  Returns (version before, version after)."""
+  start_version = get_schema_version(connection)
+  if start_version > SCHEMA_VERSION:
+    global_logger.warning(f"Database schema is at version {start_version}, newer than this build knows about ({SCHEMA_VERSION})")
+    return start_version, start_version
+
+  cursor = connection.cursor()
+  for version in range(start_version + 1, SCHEMA_VERSION + 1):
+    try:
+      cursor.execute("BEGIN")
+      MIGRATIONS[version - 1](cursor)
+      cursor.execute(f"PRAGMA user_version = {version}")
+      connection.commit()
+    except Exception as e:
+      connection.rollback()
+      global_logger.error(f"Database migration to version {version} failed: {e}")
+      raise
+    global_logger.info(f"Migrated database to schema version {version}")
+
+  return start_version, SCHEMA_VERSION
@@ -0,0 +1,57 @@
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+# (song ID, path)
+QueuedSong = Tuple[int, str]
+
+
+def songs_after(songs : List[Dict[str, Any]], song_id : int) -> List[QueuedSong]:
+  """(song ID, path) of every song after `song_id` in `songs`, in order. Nothing if it isn't in there"""
+  ids = [song["id"] for song in songs]
+  if song_id not in ids:
+    return []
+  return [(song["id"], song["file_path"]) for song in songs[ids.index(song_id) + 1:]]
+
+
+def switch_delay(duration : int, position : int, window : int, lead : int) -> Optional[int]:
+  """Milliseconds until the next song should be started, once the current one is within `window` ms
+  of its end (None before that). It's started `lead` ms early, to cover the audio output starting up"""
+  remaining = duration - position
+  if 0 < remaining <= window:
+    return max(0, remaining - lead)
+  return None
+
+
+class PlayQueue:
+  """
+  The songs AudioPlayer plays once the current one is over, in order. Kept apart from
+  the players themselves, so there's no Qt in here.
+  """
+
+  def __init__(self, exists : Callable[[str], bool] = os.path.exists):
+    self._songs  : List[QueuedSong] = []
+    self._exists = exists
+
+
+  def set_songs(self, songs : List[QueuedSong], current_id : int):
+    # The current song showing up again would just play it twice
+    self._songs = [song for song in songs if song[0] != current_id]
+
+
+  def peek(self) -> Optional[QueuedSong]:
+    """The song that plays next. Songs whose file is gone are dropped on the way"""
+    while len(self._songs) > 0 and not self._exists(self._songs[0][1]):
+      self._songs.pop(0)
+    return self._songs[0] if len(self._songs) > 0 else None
+
+
+  def pop(self) -> Optional[QueuedSong]:
+    song = self.peek()
+    if song is not None:
+      self._songs.pop(0)
+    return song
+
+
+  def __len__(self) -> int:
+    return len(self._songs)
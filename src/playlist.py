@@ -2,11 +2,12 @@ from __future__ import annotations
 
 
 from PySide6.QtCore import (QDateTime, QDir, QLibraryInfo, QSysInfo, Qt,
-                            QTimer, Slot, qVersion, Signal, QUrl, QObject, )
+                            QTimer, Slot, qVersion, Signal, QUrl, QObject, QEvent,
+                            QAbstractListModel, QModelIndex, QRect, QSize)
 from PySide6.QtGui import (QCursor, QDesktopServices, QGuiApplication, QIcon,
                            QKeySequence, QShortcut, QStandardItem,
                            QStandardItemModel, QAction, QColor, QMouseEvent, QColorConstants,
-                           QPalette)
+                           QPalette, QPainter, QFont, QFontMetrics)
 
 from PySide6.QtWidgets import (QApplication, QCheckBox, QComboBox,
                                QCommandLinkButton, QDateTimeEdit, QDial,
@@ -19,7 +20,8 @@ from PySide6.QtWidgets import (QApplication, QCheckBox, QComboBox,
                                QTextBrowser, QTextEdit, QToolBox, QToolButton,
                                QTreeView, QVBoxLayout, QWidget, QMainWindow, QFileDialog, QFrame, QGraphicsItem, QGraphicsPixmapItem,
                                QGraphicsRectItem, QGraphicsScene, QGraphicsView,
-                               QGraphicsWidget, QStyle)
+                               QGraphicsWidget, QStyle, QStyledItemDelegate,
+                               QStyleOptionViewItem, QStyleOptionButton, QAbstractItemView)
 
 from PySide6.QtMultimedia import (QAudioDecoder, QAudioOutput, QMediaFormat, QAudio, QMediaPlayer)
 
@@ -30,9 +32,9 @@ import re
 from typing import Callable
 
 from downloader import DownloadTracker
+from play_queue import QueuedSong, songs_after
 from typing import Dict, Any, Optional, Tuple, List
 
-import soundfile as sf
 import utility as util
 from mylogger import global_logger
 
@@ -89,7 +91,8 @@ class SongSelection(QWidget):
 
 class AddSongWindow(QDialog):
 
-  _song_selected_signal = Signal(dict)
+  _song_selected_signal = Signal(object) # Song record
+  _search_requested     = Signal(str)  # Search text, answered with show_search_results()
 
   def __init__(self):
     super().__init__()
@@ -116,14 +119,24 @@ class AddSongWindow(QDialog):
 
 
   def _search_text_changed(self, text : str):
-     # Clear all visible choices
-    self._delete_layout_elements()
+    # The actual searching happens in the DB, show_search_results() gets called with the results
+    if len(text.strip()) == 0:
+      self.show_only(None)
+    else:
+      self._search_requested.emit(text)
 
-    # Add only the ones that match
-    for song in self._available_songs:
-      regex_match = re.match(text, song["user_title"])
-      if regex_match is not None:
-        self.add_element(song)
+
+  def show_search_results(self, text : str, song_ids : List[int]):
+    # Results for text that's been typed over (or cleared) since are dropped
+    if text == self._search_bar.text():
+      self.show_only(song_ids)
+
+
+  def show_only(self, song_ids : List[int] | None):
+    """Hide every song that isn't in `song_ids`. None shows everything again."""
+    visible = set(song_ids) if song_ids is not None else None
+    for selection in self._song_selections:
+      selection.setVisible(visible is None or selection._id in visible)
 
   
   def _delete_layout_elements(self):
@@ -137,7 +150,7 @@ class AddSongWindow(QDialog):
   def add_element(self, song_data : Dict[str, Any]):
     global_logger.debug(f"Added element in AddSongWindow: {song_data}")
     
-    song = SongSelection(song_id=song_data['id'], song_name=song_data['user_title'], song_length=song_data['duration'])
+    song = SongSelection(song_id=song_data['id'], song_name=song_data['user_title'], song_length=(song_data['duration'] or 0) * 1000)
     song._selected_signal.connect(self._handle_add_song_signal)
     self._song_selections.append(song)
     self._songs_layout.addWidget(song)
@@ -166,34 +179,287 @@ class AddSongWindow(QDialog):
 
 
 
+class PlaylistModel(QAbstractListModel):
+  # Backing model for the playlist view. Only holds the song rows themselves,
+  # the delegate is the one that actually draws them (and only the visible ones)
+
+  SongIdRole   = Qt.ItemDataRole.UserRole + 1
+  SongPathRole = Qt.ItemDataRole.UserRole + 2
+  SongDataRole = Qt.ItemDataRole.UserRole + 3
+  PlayingRole  = Qt.ItemDataRole.UserRole + 4
+
+  def __init__(self, songs : List[Dict[str, Any]] = []):
+    super().__init__()
+    self._songs   : List[Dict[str, Any]] = list(songs)
+    # Indices into self._songs that are currently shown (search filtering)
+    self._visible : List[int]            = list(range(len(self._songs)))
+    # Song IDs of the current search results, in ranked order. None when not searching
+    self._filter_ids : List[int] | None  = None
+
+    self._playing_id : int  = -1
+    self._is_playing : bool = False
+
+
+  def rowCount(self, parent : QModelIndex = QModelIndex()) -> int:
+    if parent.isValid():
+      return 0
+    return len(self._visible)
+
+
+  def data(self, index : QModelIndex, role : int = Qt.ItemDataRole.DisplayRole):
+    if not index.isValid() or index.row() >= len(self._visible):
+      return None
+
+    song = self._songs[self._visible[index.row()]]
+    match role:
+      case Qt.ItemDataRole.DisplayRole:
+        return song["user_title"]
+      case Qt.ItemDataRole.ToolTipRole:
+        return song["file_path"]
+      case PlaylistModel.SongIdRole:
+        return song["id"]
+      case PlaylistModel.SongPathRole:
+        return song["file_path"]
+      case PlaylistModel.SongDataRole:
+        return song
+      case PlaylistModel.PlayingRole:
+        return self._is_playing and song["id"] == self._playing_id
+    return None
+
+
+  def song_at(self, row : int) -> Dict[str, Any]:
+    return self._songs[self._visible[row]]
+
+  def songs(self) -> List[Dict[str, Any]]:
+    return self._songs
+
+
+  def set_songs(self, songs : List[Dict[str, Any]]):
+    self.beginResetModel()
+    self._songs = list(songs)
+    self._visible = self._matching_indices()
+    self.endResetModel()
+
+
+  def append_song(self, song : Dict[str, Any]):
+    self._songs.append(song)
+    if self._filter_ids is not None and song["id"] not in self._filter_ids:
+      return
+
+    row = len(self._visible)
+    self.beginInsertRows(QModelIndex(), row, row)
+    self._visible.append(len(self._songs) - 1)
+    self.endInsertRows()
+
+
+  def remove_song(self, song_id : int) -> bool:
+    for i, song in enumerate(self._songs):
+      if song["id"] != song_id:
+        continue
+
+      # Take it out of the view first, then shift the remaining indices down
+      if i in self._visible:
+        row = self._visible.index(i)
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self._visible.pop(row)
+        self._songs.pop(i)
+        self._visible = [idx - 1 if idx > i else idx for idx in self._visible]
+        self.endRemoveRows()
+      else:
+        self._songs.pop(i)
+        self._visible = [idx - 1 if idx > i else idx for idx in self._visible]
+      return True
+    return False
+
+
+  def set_filter_ids(self, song_ids : List[int] | None):
+    """Only show the songs in `song_ids`, in that order. None shows every song again."""
+    self.beginResetModel()
+    self._filter_ids = song_ids
+    self._visible = self._matching_indices()
+    self.endResetModel()
+
+
+  def set_playing(self, song_id : int, is_playing : bool = True):
+    self._playing_id = song_id
+    self._is_playing = is_playing
+    # Only the icons change, so there's no need to reset anything
+    if len(self._visible) > 0:
+      self.dataChanged.emit(self.index(0), self.index(len(self._visible) - 1), [PlaylistModel.PlayingRole])
+
+
+  def toggle_playing(self, song_id : int):
+    if self._playing_id == song_id:
+      self.set_playing(song_id, not self._is_playing)
+    else:
+      self.set_playing(song_id, True)
+
+
+  def _matching_indices(self) -> List[int]:
+    if self._filter_ids is None:
+      return list(range(len(self._songs)))
+
+    index_of = {song["id"] : i for i, song in enumerate(self._songs)}
+    return [index_of[song_id] for song_id in self._filter_ids if song_id in index_of]
+
+
+
+class PlaylistElementDelegate(QStyledItemDelegate):
+  # Paints a whole song row (title, length, play/delete buttons), but only for the rows
+  # the view actually asks for. Mouse clicks are hit tested against the button rects.
+  """
+          LEFT-HAND      SPACER                 RIGHT-HAND
+  |-----------------------|---|-----------------------------------------------------|
+  +--------------------------------------------------------------------------------+
+  |  SONG NAME             | |> (play/pause) ... (remove from playlist)            |
+  |  LENGTH [00:00]        |                                                       |
+  +--------------------------------------------------------------------------------+
+  """
+
+  _play_clicked_signal   = Signal(int, str)
+  _delete_clicked_signal = Signal(int)
+
+  ROW_HEIGHT  = 75
+  PADDING     = 8
+  BUTTON_SIZE = 30
+  TEXT_BUTTON_WIDTH = 70
+
+  def __init__(self, parent : QObject | None = None):
+    super().__init__(parent)
+
+    self._name_font = QFont()
+    self._name_font.setPixelSize(15)
+    self._name_font.setBold(True)
+
+    self._length_font = QFont()
+    self._length_font.setPixelSize(15)
+    self._length_font.setItalic(True)
+
+    self._border_color = QColor("#B0B0A5")
+    self._name_color   = QColor("#FFFFFF")
+    self._length_color = QColor("#8080A5")
+
+
+  def sizeHint(self, option : QStyleOptionViewItem, index : QModelIndex) -> QSize:
+    return QSize(400, PlaylistElementDelegate.ROW_HEIGHT)
+
+
+  def _button_rects(self, rect : QRect) -> Tuple[QRect, QRect]:
+    pad  = PlaylistElementDelegate.PADDING
+    size = PlaylistElementDelegate.BUTTON_SIZE
+    text_w = PlaylistElementDelegate.TEXT_BUTTON_WIDTH
+    top = rect.bottom() - pad - size
+
+    remove_rect = QRect(rect.right() - pad - text_w, top, text_w, size)
+    play_rect   = QRect(remove_rect.left() - pad - size, top, size, size)
+    return play_rect, remove_rect
+
+
+  def paint(self, painter : QPainter, option : QStyleOptionViewItem, index : QModelIndex):
+    painter.save()
+    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+
+    rect = option.rect.adjusted(2, 2, -2, -2)
+    if option.state & QStyle.StateFlag.State_MouseOver:
+      painter.fillRect(rect, option.palette.alternateBase())
+    painter.setPen(self._border_color)
+    painter.drawRoundedRect(rect, 5, 5)
+
+    song = index.data(PlaylistModel.SongDataRole)
+    pad  = PlaylistElementDelegate.PADDING
+    play_rect, remove_rect = self._button_rects(rect)
+
+    # Song name, elided so it never runs into the buttons
+    name_rect = QRect(rect.left() + pad, rect.top() + pad, rect.width() - 2 * pad, rect.height() // 2 - pad)
+    painter.setFont(self._name_font)
+    painter.setPen(self._name_color)
+    elided = QFontMetrics(self._name_font).elidedText(song["user_title"], Qt.TextElideMode.ElideRight, name_rect.width())
+    painter.drawText(name_rect, Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter, elided)
+
+    # Duration is stored in seconds
+    length_rect = QRect(rect.left() + pad, play_rect.top(), play_rect.left() - rect.left() - 2 * pad, play_rect.height())
+    painter.setFont(self._length_font)
+    painter.setPen(self._length_color)
+    painter.drawText(length_rect, Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignVCenter,
+                     util.ms_to_text((song["duration"] or 0) * 1000))
+
+    # Buttons
+    style = option.widget.style() if option.widget else QApplication.style()
+    for btn_rect, text, icon in ((play_rect,   "",       PAUSE_ICON if index.data(PlaylistModel.PlayingRole) else PLAY_ICON),
+                                 (remove_rect, "Remove", None)):
+      btn = QStyleOptionButton()
+      btn.rect = btn_rect
+      btn.text = text
+      btn.state = QStyle.StateFlag.State_Enabled
+      if icon is not None:
+        btn.icon = icon
+        btn.iconSize = QSize(btn_rect.width() - 10, btn_rect.height() - 10)
+      style.drawControl(QStyle.ControlElement.CE_PushButton, btn, painter, option.widget)
+
+    painter.restore()
+
+
+  def editorEvent(self, event : QEvent, model, option : QStyleOptionViewItem, index : QModelIndex) -> bool:
+    if event.type() != QEvent.Type.MouseButtonRelease or event.button() != Qt.MouseButton.LeftButton:
+      return super().editorEvent(event, model, option, index)
+
+    play_rect, remove_rect = self._button_rects(option.rect.adjusted(2, 2, -2, -2))
+    pos = event.position().toPoint()
+    song_id = index.data(PlaylistModel.SongIdRole)
+
+    if play_rect.contains(pos):
+      self._play_clicked_signal.emit(song_id, index.data(PlaylistModel.SongPathRole))
+      return True
+    if remove_rect.contains(pos):
+      global_logger.debug(f"PlaylistElementDelegate {song_id} delete button clicked")
+      self._delete_clicked_signal.emit(song_id)
+      return True
+
+    return super().editorEvent(event, model, option, index)
+
+
+
+
 class PlayListContainer(QWidget):
 
   _play_button_clicked      = Signal(int, str)
   _request_every_song       = Signal()
   _update_db_with_new_song_in_playlist = Signal(int, int) # Playlist ID, Song ID
   _request_every_song_not_in_playlist = Signal(int)
-  
+  _request_song_search                = Signal(int, str, bool) # Playlist ID, search text, True to search inside the playlist/False for outside
+
   _delete_element_clicked_signal = Signal(int,  name="Delete Element Clicked")
   _delete_playlist_clicked_signal = Signal(int, name="Delete Playlist Clicked")
-  
+
 
   def __init__(self, playlist_data : Dict[str, Any] = {}, songs_query : List[Dict[str, Any]] = []):
-    
+
 
     super().__init__()
 
     self.general_layout = QVBoxLayout(self)
-    
+
    # self.setStyleSheet(open(os.path.join(util.STYLE_LOCATION, 'PlaylistStyle.qss')).read())
 
     self._current_index = 0
-    self._songs = []
     self._playlist_data = playlist_data
     self._initialized = playlist_data != {} and songs_query != []
 
-    # List of UI objects
-    self._playlist : list[PlaylistElement] = []
-    self._playlist_layout = QVBoxLayout()
+    # Songs are only drawn for the rows that are on screen, so the cost
+    # of switching playlists doesn't grow with the amount of songs in it
+    self._model    = PlaylistModel(songs_query)
+    self._delegate = PlaylistElementDelegate(self)
+    self._delegate._play_clicked_signal.connect(self._handle_play_clicked)
+    self._delegate._delete_clicked_signal.connect(self._delete_element)
+
+    self._playlist_view = QListView()
+    self._playlist_view.setModel(self._model)
+    self._playlist_view.setItemDelegate(self._delegate)
+    self._playlist_view.setUniformItemSizes(True)
+    self._playlist_view.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+    self._playlist_view.setSelectionMode(QAbstractItemView.SelectionMode.NoSelection)
+    self._playlist_view.setMouseTracking(True)
+    self._playlist_view.setMinimumWidth(400)
 
     self._search_bar = QLineEdit(placeholderText="Search for songs... ")
     self._search_bar.textChanged.connect(self._search_text_changed)
@@ -214,22 +480,15 @@ class PlayListContainer(QWidget):
     self._add_song_btn = QPushButton()
     self._add_song_btn.setText("Add song")
     self._add_song_btn.clicked.connect(self.handle_add_song_clicked)
-  
-    self.refresh_playlist_elements(self._songs)
-
 
 
     # This is set for when there isn't anything selected
-    if self._playlist_data == {}:
-      self._no_playlist_text = QLabel()
-      self._no_playlist_text.setText("You don't currently have a playlist selected.")
-      self._playlist_layout.addWidget(self._no_playlist_text)
-
-    else:
-      self._update_playlist_data(playlist_data)
+    self._no_playlist_text = QLabel()
+    self._no_playlist_text.setText("You don't currently have a playlist selected.")
+    self.general_layout.addWidget(self._no_playlist_text)
 
     self._header_layout  = QHBoxLayout()
-    
+
     self._title_layout   = QVBoxLayout()
     self._title_layout.addWidget(self._name)
     self._title_layout.addWidget(self._desc)
@@ -241,35 +500,35 @@ class PlayListContainer(QWidget):
     self._header_layout.addLayout(self._title_layout)
     self._header_layout.addLayout(self._buttons_layout)
 
-    self._playlist_layout.setAlignment(Qt.AlignmentFlag.AlignTop)
-
-    if self._initialized:
-      self.general_layout.addLayout(self._header_layout)
-      self.general_layout.addWidget(self._search_bar)
-      self.general_layout.addLayout(self._playlist_layout)
-
+    self._layout_built = False
+    self._add_song_window : AddSongWindow | None = None
+    if self._playlist_data != {}:
+      self._update_playlist_data(playlist_data)
 
-    self.refresh_playlist_elements(self._songs)
-    
-    
-    
     self.setMinimumWidth(400)
 
-  
+
 
   def _update_playlist_data(self, playlist_data : Dict[str, Any]):
     self._playlist_data = playlist_data
     self._initialized = True
+    # Whatever was searched for belongs to the previous playlist
+    self._search_bar.clear()
     self._name.setText(self._playlist_data["name"])
     self._desc.setText(self._playlist_data["description"])
-    self.general_layout.addLayout(self._header_layout)
-    self.general_layout.addWidget(self._search_bar)
-    self.general_layout.addLayout(self._playlist_layout)
+
+    # The header and the view only need to be put in once
+    if not self._layout_built:
+      self._no_playlist_text.setVisible(False)
+      self.general_layout.addLayout(self._header_layout)
+      self.general_layout.addWidget(self._search_bar)
+      self.general_layout.addWidget(self._playlist_view)
+      self._layout_built = True
 
 
   def handle_add_song_clicked(self):
-    
-    self._request_every_song_not_in_playlist.emit(self._playlist_data['id'])    
+
+    self._request_every_song_not_in_playlist.emit(self._playlist_data['id'])
 
 
   def _handle_add_song_clicked_callback(self, all_songs : List[Dict[str, Any]]):
@@ -277,311 +536,91 @@ class PlayListContainer(QWidget):
     add_song_window._set_available_songs(all_songs)
 
     add_song_window._song_selected_signal.connect(self._handle_add_song_song_data)
+    add_song_window._search_requested.connect(lambda text: self._request_song_search.emit(self._playlist_data['id'], text, False))
+    self._add_song_window = add_song_window
     add_song_window.exec_()
-  
+    self._add_song_window = None
+
 
   def _handle_add_song_song_data(self, song_data : Dict[str, Any]):
     self.add_element(song_data)
     self._update_db_with_new_song_in_playlist.emit(self._playlist_data['id'], song_data['id'])
-    
+
+
+  def _handle_play_clicked(self, song_id : int, song_path : str):
+    self._model.toggle_playing(song_id)
+    self._play_button_clicked.emit(song_id, song_path)
 
 
   def play_song(self, idx : int):
     self._current_index = idx
-    self._play_button_clicked.emit(self.get_current_song_path(), self._current_index)
-  
+    song = self._model.song_at(idx)
+    self._model.set_playing(song["id"])
+    self._play_button_clicked.emit(song["id"], song["file_path"])
+
+
+  def current_playlist_id(self) -> int | None:
+    """ID of the playlist that's shown, None before one gets picked"""
+    return self._playlist_data.get("id") if self._initialized else None
+
+
+  def upcoming_songs(self, song_id : int) -> List[QueuedSong]:
+    """Every shown song after `song_id`, in order. What plays next once it's over"""
+    return songs_after([self._model.song_at(row) for row in range(self._model.rowCount())], song_id)
+
 
   def _search_text_changed(self, text : str):
     # Update selection with all of the songs that match the text
-    
-    # Clear all visible choices
-    self._delete_layout_elements()
-    self._delete_elements()
+    # The search itself runs against the FTS index, and comes back through show_search_results()
+    if len(text.strip()) == 0 or not self._initialized:
+      self._model.set_filter_ids(None)
+    else:
+      self._request_song_search.emit(self._playlist_data['id'], text, True)
 
-    # Add only the ones that match
-    for song in self._songs:
-      regex_match = re.match(text, song["user_title"])
-      if regex_match is not None:
-        self.add_layout_element(PlaylistElement(song))
 
-  
+  def show_search_results(self, playlist_id : int, text : str, song_ids : List[int], in_playlist : bool):
+    # A search can still come back after the text changed, or another playlist got picked. Those are dropped
+    if playlist_id != self.current_playlist_id():
+      return
+    if in_playlist:
+      if text == self._search_bar.text():
+        self._model.set_filter_ids(song_ids)
+    elif self._add_song_window is not None:
+      self._add_song_window.show_search_results(text, song_ids)
 
 
   def get_current_song_name(self):
-    return self._playlist[self._current_index]._song_name
+    return self._model.song_at(self._current_index)["user_title"]
   def get_current_song_path(self):
-    return self._playlist[self._current_index]._song_path
-  
-
-  def add_layout_element( self, new_element : PlaylistElement ):
-
-     # Quick check if this is the text prompting to make a playlist is still there:
-    # Because if so - it needs to be deleted
-    if len(self._playlist) == 0:
-      self._delete_layout_elements()
+    return self._model.song_at(self._current_index)["file_path"]
 
-    new_element._play_clicked_signal.connect(self._play_button_clicked)
-    new_element._delete_clicked_signal.connect(self._delete_element)
-    self._playlist_layout.addWidget( new_element )
-    self._playlist.append( new_element )
-    self.update()
-    
-    
-  
 
   def add_element(self, song : Dict[str, Any]):
     # TODO: Change this so it orders itself with the propper playlist positions in 'playlists' table
-    global_logger.debug(f"Adding Element to PlaylistContainer: {song}")
-    
-    self._songs.append(song)
-    self.add_layout_element(PlaylistElement(song))
-    
-
-    self.updateGeometry()
+    global_logger.debug(f"Adding Element to PlaylistContainer: {song['id']}")
+    self._model.append_song(song)
 
 
   def _delete_element(self, song_id : int):
     global_logger.debug(f"Deleting element with ID: {song_id} from PlaylistContainer")
-    # Find the element with the ID
-    for i, element in enumerate(self._playlist):
-      if element._id == song_id:
-        # Remove it from the layout
-        self._playlist_layout.removeWidget(element)
-        # Remove it from the list
-        self._playlist.pop(i)
-        # Delete the element
-        element.deleteLater()
-        # Remove it from the songs list
-        self._songs = [s for s in self._songs if s['id'] != song_id]
-        # Emit a signal to delete it from the DB
-        self._delete_element_clicked_signal.emit(song_id)
-        return
-
-    pass
+    if self._model.remove_song(song_id):
+      # Emit a signal to delete it from the DB
+      self._delete_element_clicked_signal.emit(song_id)
+
 
   # Whenever you start playing a different song, this function sends out a notification
   # To every  element, an example would be to toggle back the 'PLAY_ICON'
-  def _toggle_off_every_element(self, index_to_skip : int = -1):
-    for i, element in enumerate(self._playlist):
-      if i != index_to_skip:
-        element.toggle_off()
-
-
-  def _delete_layout_elements(self):
-    for i in range(self._playlist_layout.count()):
-      try:
-        # For whatever reason, deleting elements like the spec says doesn't work
-        # It only results in the objects being misaligned, and doesn't even remove
-        # all of them. Anyway, this is a miserable, but working solution for the time being
-        self._playlist_layout.takeAt(i).widget().deleteLater()
-      except Exception as e:
-        pass
-    
-  def _delete_elements(self):
-    if len(self._playlist) > 0:
-      for i in range(len(self._playlist), 0, -1):
-        self._playlist[i-1].deleteLater()
-    self._playlist = []
-
-
+  def _toggle_off_every_element(self, song_id_to_skip : int = -1):
+    self._model.set_playing(song_id_to_skip, song_id_to_skip != -1)
 
 
   def refresh_playlist_elements(self, new_songs : List[Dict[str, Any]] | None = None):
-    global_logger.debug(f"Refreshing PlaylistContainer with: {new_songs} ")
-    self._delete_layout_elements()
-    self._delete_elements()
-
-    for song in (new_songs if new_songs is not None else self._songs):
-      self.add_element(song)
-
-
-
-
+    global_logger.debug(f"Refreshing PlaylistContainer with {len(new_songs) if new_songs is not None else 'existing'} songs")
+    if new_songs is not None:
+      self._model.set_songs(new_songs)
+    else:
+      self._model.set_songs(self._model.songs())
 
 
 PLAY_ICON  = QIcon(util.ICON_LOCATION + 'PLAY_ICON.svg')
 PAUSE_ICON = QIcon(util.ICON_LOCATION + 'PAUSE_ICON.svg')
-
-# Singular tab element of a playlist
-# Multiple playlist elements make up a Playlist UI
-class PlaylistElement(QFrame):
-  
-  _clicked_signal        = Signal(int, name="Mouse Click")
-  _play_clicked_signal   = Signal(int, str)
-  _delete_clicked_signal = Signal(int, name="Delete Clicked")
-  
-  def __init__(self, song_data : Dict[str, Any] ):
-    super().__init__()
-
-    self.setObjectName("PlaylistElement")
-    self.setStyleSheet(open(os.path.join(util.STYLE_LOCATION, 'PlaylistStyle.qss')).read())
-
-    # Data
-    self._data      : Dict[str, Any] = song_data
-    self._id        : int            = self._data["id"]
-    self._song_name : str            = self._data["user_title"]
-    self._song_path : str            = self._data["file_path"]
-    self.set_song(self._song_path)
-
-    # Saving in milliseconds simply to avoid carrying floats around
-    # and it's easy to convert back into seconds, or work with pydub
-    self._length_ms : int = self._data["duration"] * 1000
-    # Mainly used as a debug tool, enabled once set_song() has been called
-    # This is to prevent anything from trying to play a non-existent file
-    self._song_is_set : bool = False
-
-
-    self._is_playing = False
-
-    
-
-    # Layouts
-    self._song_data_layout           = QVBoxLayout()
-    self._song_length_and_btn_layout = QHBoxLayout()
-    self._button_layout     = QHBoxLayout()
-    self._right_hand_layout = QVBoxLayout()
-    main_layout             = QHBoxLayout(self)
-
-    # Layout and Labels for the left side of the element
-    self._song_name_label   = QLabel()
-    self._song_name_label.setObjectName("SongName")
-
-    MAX_SONG_NAME_LENGTH = 60
-    if len(self._song_name) > MAX_SONG_NAME_LENGTH:
-      self._song_name_label.setText(self._song_name[:MAX_SONG_NAME_LENGTH - 3] + '...') 
-    else:
-      self._song_name_label.setText(self._song_name) 
-
-
-    self._song_length_label = QLabel()
-    self._song_length_label.setObjectName("SongLength")
-    self._song_length_label.setText(util.ms_to_text(self._length_ms))
-
-
-    self._song_data_layout.addWidget(self._song_name_label)
-    self._song_data_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
-    
-    self._song_length_and_btn_layout.addWidget(self._song_length_label)
-    self._song_length_and_btn_layout.setAlignment(Qt.AlignmentFlag.AlignLeft)
-
-
-
-    # Buttons for the right side:
-    # TODO: add icons!
-    self._play_btn                 = QPushButton() 
-    self._remove_from_playlist_btn = QPushButton()
-    self._other_options_btn        = QPushButton()
-
-    
-    self._play_btn.setIcon(PLAY_ICON)
-    self._play_btn.setAutoFillBackground(False)
-    self._play_btn.setObjectName("PlayButton")
-    self._play_btn.clicked.connect(self.on_play_btn_click)
-
-    self._remove_from_playlist_btn.setText("Remove")
-    self._remove_from_playlist_btn.setObjectName("RemoveButton")
-    self._remove_from_playlist_btn.clicked.connect(self.on_delete_btn_click)
-
-    self._other_options_btn.setText("More")
-
-    
-    # Button Layout
-    self._button_layout.addWidget(self._play_btn)
-    self._button_layout.addWidget(self._remove_from_playlist_btn)
-    self._button_layout.addWidget(self._other_options_btn)
-    self._button_layout.setAlignment(Qt.AlignmentFlag.AlignRight)
-
-    self._song_length_and_btn_layout.addLayout(self._button_layout)
-    self._song_data_layout.addLayout(self._song_length_and_btn_layout)
-
-
-    # Note area?
-    self._note_textedit = QTextEdit()
-    self._note_textedit.setVisible(False)    # Will stay invisible, unless enabled in the [...] menu
-    self._note_textedit.setPlaceholderText("Add a personal note...")
-    
-    
-    self._right_hand_layout.addWidget(self._note_textedit)
-
-    # Layout of the whole item
-    main_layout.addLayout(self._song_data_layout)
-    main_layout.addLayout(self._right_hand_layout)
-
-
-    
-    """
-            LEFT-HAND      SPACER                 RIGHT-HAND    
-    |-----------------------|---|-----------------------------------------------------|
-    +--------------------------------------------------------------------------------+
-    |  SONG NAME             | |> (play/pause) ... (rename) X (remove from playlist) | 
-    |  LENGTH [00:00]        | [ note area :                                       ] |
-    +--------------------------------------------------------------------------------+
-    """ 
-
-
-    self.setMaximumSize(600, 100)
-    self.setMinimumSize(400, 60)
-
-    self.setObjectName('playlist-elem')
-    # self.setStyleSheet('#playlist-elem {background-color: gray ;}')
-
-    self.setAttribute(Qt.WidgetAttribute.WA_Hover, True)
-    
-
-
-    
-
-
-  def set_song(self, filepath : str):
-    # Assert this file even exists:
-    # This should be done in PlaylistContainer or even above, but I'd rather be safe than sorry
-    if not os.path.exists(filepath):
-      raise Exception(f"{filepath} does not exist!")
-    # This is so FFmpeg doesn't cry
-    filepath = filepath.replace('\\', '/')
-    # Get the filename
-    file_name = os.path.basename(filepath)
-    # Strip the last ending .*
-    file_name = file_name[:file_name.rfind('.')]
-    self._song_name = file_name
-    self._song_path = filepath
-
-    # Get the length of the sound:
-    loaded_soundfile = sf.SoundFile(filepath)
-    self._length_ms = int(1000 * (loaded_soundfile.frames / loaded_soundfile.samplerate))
-    self._song_is_set = True
-  
-
-
-  def toggle_off(self):
-    self._play_btn.setIcon(PLAY_ICON)
-
-  @Slot()
-  def on_play_btn_click(self):
-
-    self._is_playing = not self._is_playing
-    if self._is_playing:
-      self._play_btn.setIcon(PAUSE_ICON)
-    else:
-      self._play_btn.setIcon(PLAY_ICON)
-    
-    self._play_clicked_signal.emit(self._id, self._song_path)
-  
-  @Slot()
-  def on_delete_btn_click(self):
-    global_logger.debug(f"PlaylistElement {self._id} delete button clicked")
-    self._delete_clicked_signal.emit(self._id)
-
-  @Slot()
-  def connect_play_button(self, function : Callable):
-    self._play_clicked_signal.connect(function)
-
-  
-
-  @Slot()
-  def connect_other_options_button(self, function : Callable):
-    self._other_options_btn.clicked.connect(function)
-
-  @Slot()
-  def connect_clicked_signal(self, function : Callable):
-    self._clicked_signal.connect(function)
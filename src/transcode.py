@@ -0,0 +1,141 @@
+import os
+import asyncio
+import subprocess
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from mylogger import global_logger
+
+
+# How downloads get stored. `args` go to ffmpeg after the input, `spotdl` is the format spotdl gets told to use
+StorageFormat = namedtuple("StorageFormat", ["extension", "args", "spotdl"])
+
+# Everything is resampled to 48kHz stereo, same as the old WAV only downloads,
+# since that's what QMediaPlayer has been happiest with
+TRANSCODE_SAMPLE_RATE = 48000
+TRANSCODE_CHANNELS    = 2
+_RESAMPLE = ["-ar", str(TRANSCODE_SAMPLE_RATE), "-ac", str(TRANSCODE_CHANNELS)]
+
+STORAGE_FORMATS : Dict[str, StorageFormat] = {
+  "wav"  : StorageFormat("wav",  ["-c:a", "pcm_s16le", *_RESAMPLE],            "wav"),
+  "flac" : StorageFormat("flac", ["-c:a", "flac", "-sample_fmt", "s16", *_RESAMPLE], "flac"),
+  "opus" : StorageFormat("opus", ["-c:a", "libopus", "-b:a", "160k", *_RESAMPLE],   "opus"),
+  "aac"  : StorageFormat("m4a",  ["-c:a", "aac", "-b:a", "192k", *_RESAMPLE],       "m4a"),
+  # Keep whatever stream the site served (opus or aac for Youtube), no ffmpeg at all.
+  # spotdl gets the audio as webm/opus, with its bitrate disabled that's only remuxed into .opus (see SpotifyDownloader)
+  "copy" : StorageFormat(None,   None,                                              "opus"),
+}
+
+
+class TranscodeError(Exception):
+  def __str__(self):
+    return "[TranscodeError]: " + super().__str__()
+
+
+class Transcoder:
+  """
+  Converts downloaded files into the library's storage format, with at most `max_workers`
+  ffmpeg processes running at once. The original file is replaced by the converted one.
+
+  Downloads hand their files over here and are done, so a download worker never sits
+  waiting on ffmpeg, and a batch of downloads doesn't start a batch of ffmpegs.
+  """
+
+  def __init__(self, storage_format : str = "wav", max_workers : int = 2):
+    if storage_format not in STORAGE_FORMATS:
+      raise ValueError(f"Unknown storage format {storage_format!r}, expected one of {', '.join(STORAGE_FORMATS)}")
+    self.storage_format = storage_format
+    self._format        = STORAGE_FORMATS[storage_format]
+    # The threads only wait on ffmpeg, so these are effectively the ffmpeg process slots
+    self._executor      = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="Transcode")
+    self._processes     : Dict[str, subprocess.Popen] = {}
+    self._lock          = threading.Lock()
+
+
+  def needs_transcode(self, path : str) -> bool:
+    if self._format.args is None:
+      return False
+    return os.path.splitext(path)[1][1:].lower() != self._format.extension
+
+
+  async def transcode(self, path : str) -> str:
+    """Convert `path`, and return the path of the converted file. Cancelling this kills its ffmpeg."""
+    if not self.needs_transcode(path):
+      return path
+
+    cancelled = threading.Event()
+    try:
+      return await asyncio.wrap_future(self._executor.submit(self._transcode, path, cancelled))
+    except asyncio.CancelledError:
+      cancelled.set()
+      self._kill(path)
+      raise
+
+
+  async def transcode_all(self, paths : List[str]) -> List[str | TranscodeError]:
+    """Convert every one of `paths`. Each result is the converted path, or the TranscodeError
+    that file failed with, so one bad file doesn't take the rest of a playlist down with it."""
+    results = await asyncio.gather(*(self.transcode(path) for path in paths), return_exceptions=True)
+    for result in results:
+      if isinstance(result, BaseException) and not isinstance(result, TranscodeError):
+        raise result
+    return results
+
+
+  def close(self):
+    with self._lock:
+      processes = list(self._processes.values())
+    for process in processes:
+      process.kill()
+    self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+  def _transcode(self, path : str, cancelled : threading.Event) -> str:
+    output_path = os.path.splitext(path)[0] + "." + self._format.extension
+    # Written next to the output first, so a half converted file never shows up in the library
+    temp_path   = output_path + ".part"
+
+    command = ["ffmpeg", "-nostdin", "-y", "-loglevel", "error", "-i", path,
+               "-vn", "-map_metadata", "0", *self._format.args, "-f", self._muxer(), temp_path]
+    try:
+      process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError as e:
+      raise TranscodeError(f"Could not start ffmpeg: {e}")
+
+    with self._lock:
+      self._processes[path] = process
+      # A cancel that came in before the process was registered couldn't kill it
+      if cancelled.is_set():
+        process.kill()
+    try:
+      _, stderr = process.communicate()
+    finally:
+      with self._lock:
+        self._processes.pop(path, None)
+
+    if process.returncode != 0:
+      if os.path.exists(temp_path):
+        os.remove(temp_path)
+      raise TranscodeError(f"ffmpeg failed on {path} ({process.returncode}): {stderr.decode(errors='replace').strip()}")
+
+    try:
+      os.replace(temp_path, output_path)
+      os.remove(path)
+    except OSError as e:
+      raise TranscodeError(f"Could not replace {path} with {output_path}: {e}")
+    global_logger.info(f"Transcoded {path} -> {output_path}")
+    return output_path
+
+
+  def _muxer(self) -> str:
+    # The .part extension hides the format from ffmpeg, so it has to be spelled out
+    return {"wav" : "wav", "flac" : "flac", "opus" : "opus", "m4a" : "ipod"}[self._format.extension]
+
+
+  def _kill(self, path : str):
+    with self._lock:
+      process = self._processes.get(path)
+    if process is not None:
+      process.kill()
@@ -1,4 +1,7 @@
 import os
+from typing import Dict, Any, Iterator
+
+import soundfile as sf
 
 PROJECT_PATH   = os.path.split(os.path.dirname(os.path.realpath(__file__)))[0]
 SOURCE_PATH    = os.path.join(PROJECT_PATH, 'src\\')
@@ -17,16 +20,17 @@ def get_dir_filenames( dir : str ) -> list[str]:
   return files
 
 
+# some random encodings I found, should probably double check these
+# since you can probably make some nasty stuff but eh. genuinely have never seen half of these
+AUDIO_EXTENSIONS = ["mp3", "adts", "3gp", "mov", "ogg", "wav", "rtp", "webm", "aac", "wma", "flac", "alac", "m4a", "opus"]
+
+
 def get_audio_file_names(dir : str) -> list[str]:
   audio_files = []
   all_files = get_dir_filenames(dir)
 
-  # some random encodings I found, should probably double check these
-  # since you can probably make some nasty stuff but eh. genuinely have never seen half of these
-  valid_encodings = ["mp3", "adts", "3gp", "mov", "ogg", "wav", "rtp", "webm", "aac", "wma", "flac", "alac"]
-
   for file in all_files:
-    for enc in valid_encodings:
+    for enc in AUDIO_EXTENSIONS:
       if file.endswith('.' + enc):
         audio_files.append(file)
 
@@ -38,6 +42,35 @@ def get_audio_file_names(dir : str) -> list[str]:
   # this is also like a small project for a friend, so I don't give a shit
   return audio_files
 
+def iter_audio_files(dir : str) -> Iterator[str]:
+  """Lazily yield the full path of every audio file in `dir`, without listing the whole folder first."""
+  with os.scandir(dir) as entries:
+    for entry in entries:
+      if entry.is_file() and os.path.splitext(entry.name)[1][1:].lower() in AUDIO_EXTENSIONS:
+        yield entry.path
+
+
 def ms_to_text(ms : int) -> str:
   seconds = ms // 1000
-  return f"{(seconds // 60):02d}:{(seconds % 60):02d}"
\ No newline at end of file
+  return f"{(seconds // 60):02d}:{(seconds % 60):02d}"
+
+def seconds_to_length_text(seconds : int) -> str:
+  minutes = seconds // 60
+  return f"{(minutes // 60):02d}h {(minutes % 60):02d}m"
+
+
+def probe_audio_file(path : str) -> Dict[str, Any]:
+  """Read the stream info of an audio file. Duration is in whole seconds."""
+  info = {"duration" : 0, "sample_rate" : 0, "channels" : 0, "frames" : 0}
+  try:
+    # Only the header gets read here, not the actual audio
+    stream = sf.info(path)
+    info["sample_rate"] = stream.samplerate
+    info["channels"]    = stream.channels
+    info["frames"]      = stream.frames
+    if stream.samplerate > 0:
+      info["duration"]  = round(stream.frames / stream.samplerate)
+  except (RuntimeError, OSError):
+    # libsndfile can't open everything (webm for example), those just stay at 0
+    pass
+  return info
@@ -22,7 +22,13 @@ from PySide6.QtMultimedia import (QAudioDecoder, QAudioOutput, QMediaFormat, QAu
 import PySide6.QtAsyncio as QtAsyncio
 
 import sys, random, os, asyncio, json, io
-from downloader import (DownloadTracker, YoutubeDownloader,  SpotifyDownloader, SpotifyDownloaderException)
+from downloader import (DownloadTracker, YoutubeDownloader,  SpotifyDownloader, SpotifyDownloaderException,
+                        ProgressBus, ProgressSnapshot, parse_links, classify_url, link_source)
+from download_queue import DownloadQueue
+from play_queue import PlayQueue, QueuedSong, switch_delay
+from match_cache import MatchCache
+from async_database import AsyncDatabase
+from database import DownloadItem
 
 import utility as util
 from typing import Dict, Any, Optional, Tuple, List
@@ -34,83 +40,126 @@ from PlaylistSelectionList import PlaylistSelectionList
 
 class MusicDownloader(QObject):
   progress_updated_signal   = Signal(object)
-  download_completed_signal = Signal()
+  download_completed_signal = Signal(object)  # The files one download produced, see DownloadProcessPool
+  downloads_running_signal  = Signal(bool)    # True when the first download starts, False once none are left
   
 
-  def __init__(self, callback_handler):
+  def __init__(self, callback_handler, async_db : AsyncDatabase):
 
     super().__init__()
 
     self.output_dir : str = ""
+    self._async_db  = async_db
+    self._running_downloads = 0
 
-    self.spotify_downloader = SpotifyDownloader()
+    self.spotify_downloader = SpotifyDownloader(MatchCache(
+      async_db.connection,
+      ttl=config.get_spotify_match_ttl(),
+      max_entries=config.get_spotify_match_cache_size()))
     self.yt_downloader      = YoutubeDownloader()
 
     self.progress_updated_signal.connect(callback_handler)
+    # Every download reports here, and the UI hears about it 10 times a second at most
+    self.progress_bus = ProgressBus()
+    self.progress_bus.snapshot_ready.connect(self.progress_updated_signal)
 
-    self.current_download_task = None
+    # Downloads wait in here (and in the database, so they survive a restart) until a worker is free
+    self.download_queue = DownloadQueue(
+      async_db,
+      self._download_item,
+      self.progress_bus.publish,
+      max_workers=config.get_download_workers())
+    # Starts once the event loop is running
+    QTimer.singleShot(0, self.download_queue.start)
 
 
-  def start_download(self, url : str) -> Tuple[str, bool]:
+  def start_download(self, text : str, priority : int = 0) -> Tuple[str, bool]:
+    """Queue every link in `text`. It can hold any number of YouTube/Spotify links,
+    or lines that name text files full of them."""
 
-    if self.current_download_task is not None and not self.current_download_task.done():
-      return ("Download already in progress...", False)
-
-    if len(url) == 0:
+    if len(text) == 0:
       return ("you didn't add no text???", False)
 
-    # YOUTUBE LINK:
-    # Note to self: maybe add some other form of link validation in the future
-    if (link in url for link in ["youtube.", "youtu.be"]):
-      self.current_download_task = asyncio.create_task(self.yt_download_url(url))
-      return ("Started Download", True)
+    links, unsupported = parse_links(text)
+    if len(links) == 0:
+      return ("Please enter in a valid Youtube/Spotify track URL", False)
 
-    elif (link in url for link in ["play.spotify", "open.spotify"]):
-      self.current_download_task = asyncio.create_task(self.spotify_download_url(url))
-      return ("Started Download", True)
-    
-    elif "spotify:" in url:
-       return ("This app currently doesn't support URIs :/\nTry with a regular URL instead", False)
-    
+    # The link kind (youtube_video, spotify_playlist, ...) is what the queue keeps as the source
+    queued = sum(1 for link in links if self.download_queue.add(link.url, link.kind, priority))
+
+    message = f"Queued {queued} download{'s' if queued != 1 else ''}"
+    if queued < len(links):
+      message += f"\n{len(links) - queued} already queued"
+    if len(unsupported) > 0:
+      message += f"\nSkipped {len(unsupported)} unsupported link{'s' if len(unsupported) != 1 else ''}"
+    return (message, queued > 0)
+
+
+  async def _download_item(self, item : DownloadItem, progress_callback):
+    # Called by the download queue, raising makes it retry
+    self._running_downloads += 1
+    if self._running_downloads == 1:
+      self.downloads_running_signal.emit(True)
+    try:
+      await self._download_link(item)
+    finally:
+      self._running_downloads -= 1
+      if self._running_downloads == 0:
+        self.downloads_running_signal.emit(False)
+
+
+  async def _download_link(self, item : DownloadItem):
+    link = classify_url(item.url)
+    extractor, source_id = link_source(link) if link is not None else (None, None)
+
+    # Already downloaded once, checked before anything touches the network
+    if source_id is not None:
+      if len(await self._async_db.get_song_ids_by_source([(extractor, source_id)])) > 0:
+        global_logger.info(f"Skipping {item.url}, it's already in the library")
+        return
+      skip_ids = ()
     else:
-      return ("Please enter in a valid Youtube/Spotify track URL", False)
+      # A playlist, its entries get checked against everything from the same site in one go
+      skip_ids = await self._async_db.get_source_ids(extractor) if extractor is not None else ()
 
+    if item.source.startswith("spotify"):
+      files = await self.spotify_download_url(item.url, skip_ids)
+    else:
+      files = await self.yt_download_url(item.url, skip_ids)
 
-  def youtube_audio_download_callback(self, tracker : DownloadTracker):
-    QTimer.singleShot(0, lambda: self.update_progress_display(tracker))
-  
+    # Exactly these get added to the library, the rest of the folder doesn't need looking at
+    if len(files) > 0:
+      self.download_completed_signal.emit(files)
 
-  def update_progress_display(self, tracker : DownloadTracker):
-    
-    QApplication.processEvents()
-    self.progress_updated_signal.emit(tracker)
-  
 
-  async def spotify_download_url(self, url : str):
+  async def spotify_download_url(self, url : str, skip_ids = ()) -> List[Dict[str, Any]]:
     try:
-      self.spotify_downloader.download_link(url)
+      return await self.spotify_downloader.download(url, skip_ids, self.progress_bus.publish)
     except SpotifyDownloaderException as e:
-      print(e)
-    finally:
-       return   
+      global_logger.error(e)
+      raise
     
   
-  async def yt_download_url(self, url: str) -> bool:
+  async def yt_download_url(self, url: str, skip_ids = ()) -> List[Dict[str, Any]]:
     try:
         
       task = asyncio.create_task(self.yt_downloader.download_yt_video_with_hook(
           url, 
           config.get_audio_download_dir(), 
-          self.youtube_audio_download_callback
+          self.progress_bus.publish,
+          skip_ids
       ))
         
       error_code, progress = await task 
+      # Whatever did finish goes in now, so it's source-indexed and the retry skips it
+      if error_code != 0 and len(progress.files) > 0:
+        self.download_completed_signal.emit(progress.files)
       #TODO: change these error codes to simply be exceptions
       match error_code:
           case -1:
             raise RuntimeError(f"Failed download, because Youtube thought this is a bot.\nTurn off any VPNs or update your cookies in the settings")
           case 0:
-            return True
+            return progress.files
           case _:
             raise RuntimeError(f"An error occured with your download! Try again later")
               
@@ -120,11 +169,6 @@ class MusicDownloader(QObject):
     except Exception as e:
       raise e
 
-    finally:
-      self.current_download_task = None
-      # Emit signal to inform that a download is done
-      self.download_completed_signal.emit()
-
 
   def update_output_dir(self, path: str):
     if not os.path.exists(path):
@@ -137,21 +181,23 @@ class MusicDownloader(QObject):
 class MusicDownloadWidget(QWidget):
 
   progress_updated_signal   = Signal(object)
-  download_completed_signal = Signal()
+  download_completed_signal = Signal(object)
+  downloads_running_signal  = Signal(bool)
   
 
-  def __init__(self):
+  def __init__(self, async_db : AsyncDatabase):
     super().__init__()
     layout = QVBoxLayout(self)
     
-    self.downloader = MusicDownloader(self.update_progress_display)
+    self.downloader = MusicDownloader(self.update_progress_display, async_db)
     self.downloader.download_completed_signal.connect(self.download_completed_signal)
+    self.downloader.downloads_running_signal.connect(self.downloads_running_signal)
     
     self.label = QLabel("Music Downloader", alignment=Qt.AlignmentFlag.AlignCenter)
 
     # Create tex input for the URL
     self.text_input = QPlainTextEdit()
-    self.text_input.setPlaceholderText("Enter in a valid Youtube/Spotify URL")
+    self.text_input.setPlaceholderText("Enter in Youtube/Spotify URLs, one or more")
 
 
     self.download_button = QPushButton("Download Music!")
@@ -163,7 +209,6 @@ class MusicDownloadWidget(QWidget):
     layout.addWidget(self.download_button)
     
     layout.setAlignment(Qt.AlignmentFlag.AlignCenter)
-    self.current_download_task = None
 
 
   def start_download(self):
@@ -176,13 +221,8 @@ class MusicDownloadWidget(QWidget):
     self.label.setText(text)
 
 
-  def youtube_audio_download_callback(self, tracker : DownloadTracker):
-    QTimer.singleShot(0, lambda: self.update_progress_display(tracker))
-  
-
-  def update_progress_display(self, tracker : DownloadTracker):
-    self.label.setText(str(tracker))
-    QApplication.processEvents()
+  def update_progress_display(self, snapshot : ProgressSnapshot):
+    self.label.setText(f"{snapshot.trackers[-1]}\n{snapshot.summary}")
   
 
 
@@ -191,28 +231,66 @@ class MusicDownloadWidget(QWidget):
 
 
 
-class AudioPlayer:
+class AudioPlayer(QObject):
+  """
+  Plays songs gaplessly, with two QMediaPlayers taking turns. While one plays, the next song
+  in the queue is already loaded (and paused) on the other, and gets started right as the
+  current one ends, so there's no stop/setSource/load in between songs.
+  """
+  track_changed = Signal(int)  # Song ID, whenever playback moved on to the next song by itself
+
+  # Once a song is this close to its end, the switch to the next one is timed precisely.
+  # It starts a little early, which covers the audio output starting up
+  SWITCH_WINDOW_MS = 300
+  SWITCH_LEAD_MS   = 5
+
   def __init__(self):
+    super().__init__()
     # Initialize the media playback stuff
-    self._audio_output = QAudioOutput()
-    self._audio_output.setProperty("bufferSize", 1024 * 1024)  # Set buffer size to 1MB, to prevent audio stuttering
-    self._player       = QMediaPlayer()
+    self._audio_outputs : List[QAudioOutput] = []
+    self._players       : List[QMediaPlayer] = [self._create_player(), self._create_player()]
+    self._active        = 0
     self._curr_path    : str = ""
     self._curr_song_id : int = 0
-    self._player.setAudioOutput(self._audio_output)
-      
-    self._debounce_timer = QTimer()
-    self._debounce_timer.setSingleShot(True)
-    self._debounce_timer.setInterval(500)  # Millisecond delay to prevent double clicks, and the audio resampler from failing
-        
+
+    # Songs to play after the current one. The first one is kept loaded on the standby player
+    self._queue     = PlayQueue()
+    self._preloaded : QueuedSong | None = None
+
+    self._switch_timer = QTimer()
+    self._switch_timer.setSingleShot(True)
+    self._switch_timer.setTimerType(Qt.TimerType.PreciseTimer)
+    self._switch_timer.timeout.connect(self._switch_to_next)
+
     # Add state tracking
     self._is_transitioning = False
     # Add playback state tracking
-    self._player.playbackStateChanged.connect(self._handle_playback_state_change)
     self._current_state = QMediaPlayer.PlaybackState.StoppedState
     self._waiting_for_state = False
 
-  def _handle_playback_state_change(self, state):
+  def _create_player(self) -> QMediaPlayer:
+    audio_output = QAudioOutput()
+    audio_output.setProperty("bufferSize", 1024 * 1024)  # Set buffer size to 1MB, to prevent audio stuttering
+    player = QMediaPlayer()
+    player.setAudioOutput(audio_output)
+    player.playbackStateChanged.connect(lambda state: self._handle_playback_state_change(player, state))
+    player.mediaStatusChanged.connect(lambda status: self._handle_media_status_change(player, status))
+    player.positionChanged.connect(lambda position: self._handle_position_change(player, position))
+    self._audio_outputs.append(audio_output)
+    return player
+
+  @property
+  def _player(self) -> QMediaPlayer:
+    # The one that's audible
+    return self._players[self._active]
+
+  @property
+  def _standby(self) -> QMediaPlayer:
+    return self._players[1 - self._active]
+
+  def _handle_playback_state_change(self, player : QMediaPlayer, state):
+    if player is not self._player:
+      return
     print(f"Playback state changed to: {state}")
     self._current_state = state
     self._waiting_for_state = False
@@ -221,10 +299,72 @@ class AudioPlayer:
   @Slot()
   def set_source(self, song_id : int, path_to_song : str):
     print(f"setting id: {song_id}\npath: {path_to_song}")
-    if self._curr_song_id != song_id and os.path.exists(path_to_song):
+    if self._curr_song_id == song_id or not os.path.exists(path_to_song):
+      return
+
+    self._switch_timer.stop()
+    if self._preloaded is not None and self._preloaded[0] == song_id:
+      # Skipping to the song that's already loaded
       self._player.stop()
-      self._player.setSource(path_to_song)
-      self._curr_song_id = song_id
+      self._active = 1 - self._active
+      self._preloaded = None
+    else:
+      self._player.stop()
+      self._player.setSource(QUrl.fromLocalFile(path_to_song))
+    self._curr_song_id = song_id
+    self._curr_path    = path_to_song
+
+  def set_queue(self, songs : List[QueuedSong]):
+    """Songs to play after the current one, in order, as (song ID, path)"""
+    self._queue.set_songs(songs, self._curr_song_id)
+    self._preload_next()
+
+  def _preload_next(self):
+    upcoming = self._queue.peek()
+    if upcoming == self._preloaded:
+      return
+    self._preloaded = None
+    self._standby.stop()
+    if upcoming is None:
+      return
+    self._standby.setSource(QUrl.fromLocalFile(upcoming[1]))
+    # Pausing opens the file and starts the decoder, without making a sound
+    self._standby.pause()
+    self._preloaded = upcoming
+
+  def _handle_position_change(self, player : QMediaPlayer, position : int):
+    if player is not self._player or self._preloaded is None or self._switch_timer.isActive():
+      return
+    delay = switch_delay(player.duration(), position, AudioPlayer.SWITCH_WINDOW_MS, AudioPlayer.SWITCH_LEAD_MS)
+    if delay is not None:
+      self._switch_timer.start(delay)
+
+  def _handle_media_status_change(self, player : QMediaPlayer, status):
+    # In case the timer didn't get armed (a very short song, or a seek right to the end)
+    if player is self._player and status == QMediaPlayer.MediaStatus.EndOfMedia:
+      self._switch_to_next(at_end=True)
+
+  def _switch_to_next(self, at_end : bool = False):
+    self._switch_timer.stop()
+    if self._preloaded is None:
+      return
+    # Paused right before the end, the switch waits until it's actually over
+    if not at_end and self._player.playbackState() != QMediaPlayer.PlaybackState.PlayingState:
+      return
+
+    # Swapped first, so the new player's state changes are the ones that get tracked
+    finished = self._player
+    self._active = 1 - self._active
+    self._player.play()
+    finished.stop()
+
+    song_id, path = self._preloaded
+    self._preloaded    = None
+    self._queue.pop()
+    self._curr_song_id = song_id
+    self._curr_path    = path
+    self.track_changed.emit(song_id)
+    self._preload_next()
 
   @Slot()
   def play_song(self):
@@ -246,27 +386,37 @@ class AudioPlayer:
 
   @Slot()
   def _ensure_stopped(self):
+    self._switch_timer.stop()
     if self._player.playbackState() != QMediaPlayer.PlaybackState.StoppedState:
       self._waiting_for_state = True
       self._is_transitioning = True
       self._player.stop()
 
+  def close(self):
+    """Stop both players, the preloaded one holds on to its file and audio device too"""
+    self._switch_timer.stop()
+    for player in self._players:
+      player.stop()
+
 
 class UIContainer(QWidget):
 
   _play_song_signal              = Signal(int, str) # Song ID and Song path
   _play_specific_playlist_signal = Signal()         
   _update_songs_dir              = Signal(str)      # Directory where downloads should be placed
-  _new_songs_downloaded          = Signal(str)      # Directory where to look for new songs
-  _request_songs_for_refresh     = Signal(dict)     # Signal up to MainApplication to callback with songs table.
+  _new_songs_downloaded          = Signal(object)   # The files a download produced, to add to the library
+  _downloads_running             = Signal(bool)     # Whether any downloads are running
+  _request_songs_for_refresh     = Signal(object)   # Signal up to MainApplication to callback with songs table. Playlist record
   _create_new_playlist_in_db     = Signal()         # Signal up to MainApplication to create a new playlist.
   _update_db_with_new_song_in_playlist = Signal(int, int) # Signal up to MainApplication to join playlist ID and song ID in the joint table
   _request_all_songs_to_add_to_playlist = Signal(int)  # Request every available song, that isn't already in the playlist to add. Playlist ID
   _remove_song_from_playlist_signal     = Signal(int) # Song ID to remove from the playlist
+  _request_playlist_search              = Signal(str) # Search text for the playlist selection
+  _request_song_search                  = Signal(int, str, bool) # Playlist ID, search text, search inside (True) or outside of the playlist
 
   
 
-  def __init__(self, parent, list_of_playlists : List[Dict[str, Any]]):
+  def __init__(self, parent, list_of_playlists : List[Dict[str, Any]], async_db : AsyncDatabase):
 
     super().__init__()
 
@@ -278,7 +428,7 @@ class UIContainer(QWidget):
     self._playlist_selection_list._play_specific_playlist.connect(self._handle_playing_playlist)
 
     self._search_bar = QLineEdit(placeholderText="Search for playlists... ")
-    self._search_bar.textChanged.connect(self._playlist_selection_list._search_text_changed)
+    self._search_bar.textChanged.connect(self._playlist_search_text_changed)
     self._search_bar.setMaximumHeight(40)
 
     self._create_new_playlist_btn = QPushButton()
@@ -291,11 +441,13 @@ class UIContainer(QWidget):
     self._playlist_container._update_db_with_new_song_in_playlist.connect(self._update_db_with_new_song_in_playlist.emit)
     self._playlist_container._request_every_song_not_in_playlist.connect(self._request_all_songs_to_add_to_playlist.emit)
     self._playlist_container._delete_element_clicked_signal.connect(self._remove_song_from_playlist)
+    self._playlist_container._request_song_search.connect(self._request_song_search.emit)
 
     # Widget to facilitate downloading from yt/spotify
-    self._music_downloader = MusicDownloadWidget()
+    self._music_downloader = MusicDownloadWidget(async_db)
     self._music_downloader.setMaximumWidth(150)
-    self._music_downloader.download_completed_signal.connect(self.send_out_download_dir_signal)
+    self._music_downloader.download_completed_signal.connect(self._new_songs_downloaded)
+    self._music_downloader.downloads_running_signal.connect(self._downloads_running)
     self._music_downloader.update_output_dir(config.get_audio_download_dir())
 
     # Will be deteled, but I want to keep this, just so I would remember that I made it
@@ -336,14 +488,35 @@ class UIContainer(QWidget):
     self._playlist_container._toggle_off_every_element(index_to_ignore)
 
 
-  def send_out_download_dir_signal(self):
-    self._new_songs_downloaded.emit(self._music_downloader.downloader.output_dir)
+  def upcoming_songs(self, song_id : int) -> List[QueuedSong]:
+    return self._playlist_container.upcoming_songs(song_id)
 
 
   def refresh_playlist(self, songs : List[Dict[str, Any]]):
     self._playlist_container.refresh_playlist_elements(songs)
 
 
+  def current_playlist_id(self) -> int | None:
+    return self._playlist_container.current_playlist_id()
+
+
+  def _playlist_search_text_changed(self, text : str):
+    if len(text.strip()) == 0:
+      self._playlist_selection_list.show_only(None)
+    else:
+      self._request_playlist_search.emit(text)
+
+
+  def show_playlist_search_results(self, text : str, playlist_ids : List[int]):
+    # Results for text that's been typed over (or cleared) since are dropped
+    if text == self._search_bar.text():
+      self._playlist_selection_list.show_only(playlist_ids)
+
+
+  def show_song_search_results(self, playlist_id : int, text : str, song_ids : List[int], in_playlist : bool):
+    self._playlist_container.show_search_results(playlist_id, text, song_ids, in_playlist)
+
+
   def send_all_songs_to_playlist_container_for_addSongWindow(self, all_songs : List[Dict[str, Any]]):
     self._playlist_container._handle_add_song_clicked_callback(all_songs)
 
@@ -361,9 +534,6 @@ class UIContainer(QWidget):
     self._music_downloader.update_output_dir(config.get_audio_download_dir())
     # Update directory where the database points
     self._update_songs_dir.emit(selected_dir)
-    
-    self.send_out_download_dir_signal()
-    pass
 
 
   
@@ -386,6 +556,7 @@ class UIContainer(QWidget):
     self._playlist_selection_list.add_element(playlist_data)
     
     # AND making the new playlist the current "Active" one
+    self._playlist_container._update_playlist_data(playlist_data)
     self._request_songs_for_refresh.emit(playlist_data)
     pass
 
@@ -0,0 +1,257 @@
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from mylogger import global_logger
+
+
+# A queued write. Gets a cursor inside the batch's transaction, and returns the result for its future
+WriteOperation = Callable[[sqlite3.Cursor], bool]
+
+
+class _MergedWrites:
+  """Play count bumps and song updates that sit next to each other in the queue, merged per song"""
+
+  def __init__(self):
+    # song ID -> [amount of plays, futures]
+    self.play_counts  : Dict[int, Tuple[List[int], List[Future]]] = {}
+    # song ID -> [column updates, futures]
+    self.song_updates : Dict[int, Tuple[Dict[str, Any], List[Future]]] = {}
+
+  def futures(self) -> List[Future]:
+    return [f for _, fs in self.play_counts.values() for f in fs] \
+         + [f for _, fs in self.song_updates.values() for f in fs]
+
+
+class WriteBehindQueue:
+  """
+  Collects small writes and applies them all in a single transaction, either every
+  `interval` seconds or as soon as `max_pending` writes have piled up.
+
+  Writes are applied in the order they came in. Play count bumps and song updates are merged
+  per song with the ones right next to them in the queue, until some other operation comes
+  in between (that one might depend on them, or they on it).
+
+  Every write returns a Future that resolves once its transaction is committed,
+  so `.result()` on it is the durability acknowledgement. Once the queue is closed,
+  writes get a future that already failed with a RuntimeError.
+  `on_commit` gets the names of the tables a batch wrote to, after the commit and before any future resolves.
+  """
+
+  def __init__(
+      self,
+      connection  : sqlite3.Connection,
+      lock        : threading.Lock,
+      interval    : float = 0.25,
+      max_pending : int = 256,
+      on_commit   : Optional[Callable[[Set[str]], None]] = None):
+    self._connection  = connection
+    self._write_lock  = lock  # The DatabaseConnection's writer lock
+    self._interval    = interval
+    self._max_pending = max_pending
+    self._on_commit   = on_commit
+
+    self._condition = threading.Condition()
+    self._closed    = False
+
+    # Merged writes and operations, in the order they came in
+    self._entries : List[_MergedWrites | Tuple[WriteOperation, Future]] = []
+    # Tables the queued operations write to, on top of songs for the merged writes
+    self._tables  : Set[str] = set()
+    self._pending_count = 0
+    self._in_flight     = False  # A batch is being written right now
+    # Futures of flush() calls, resolved after the batch they were waiting on
+    self._flush_waiters : List[Future] = []
+
+    # Daemon, so the atexit close() hook still gets to run and flush whatever is left
+    self._thread = threading.Thread(target=self._run, name="WriteBehindQueue", daemon=True)
+    self._thread.start()
+
+
+  def increment_play_count(self, song_id : int, amount : int = 1) -> Future:
+    future = Future()
+    with self._condition:
+      if not self._accepting(future):
+        return future
+      merged = self._merged()
+      # Bumps can't be merged past a write that sets the play count outright
+      if "play_count" in merged.song_updates.get(song_id, ({}, []))[0]:
+        merged = self._new_merged()
+      plays, futures = merged.play_counts.setdefault(song_id, ([0], []))
+      plays[0] += amount
+      futures.append(future)
+      self._queued()
+    return future
+
+
+  def update_song(self, song_id : int, updates : Dict[str, Any]) -> Future:
+    future = Future()
+    with self._condition:
+      if not self._accepting(future):
+        return future
+      merged = self._merged()
+      # Updates are written after the bumps of their group, so setting the play count starts a new one
+      if "play_count" in updates and song_id in merged.play_counts:
+        merged = self._new_merged()
+      columns, futures = merged.song_updates.setdefault(song_id, ({}, []))
+      columns.update(updates)  # Later writes to the same column win
+      futures.append(future)
+      self._queued()
+    return future
+
+
+  def submit(self, operation : WriteOperation, tables : Iterable[str] = ()) -> Future:
+    """Queue `operation`. `tables` are the ones it writes to, and get passed on to `on_commit`"""
+    future = Future()
+    with self._condition:
+      if not self._accepting(future):
+        return future
+      self._entries.append((operation, future))
+      self._tables.update(tables)
+      self._queued()
+    return future
+
+
+  def flush(self) -> Future:
+    """Write everything queued so far right away. The returned future resolves once it's committed,
+    or gets the batch's exception if it couldn't be."""
+    future = Future()
+    with self._condition:
+      if self._pending_count == 0 and not self._in_flight:
+        future.set_result(True)
+        return future
+      self._flush_waiters.append(future)
+      self._condition.notify()
+    return future
+
+
+  def close(self):
+    """Flush whatever is left, and stop the worker thread"""
+    with self._condition:
+      if self._closed:
+        return
+      self._closed = True
+      self._condition.notify()
+    self._thread.join()
+
+
+  def _accepting(self, future : Future) -> bool:
+    # Called with the condition held. Fails `future` if nothing can be queued anymore
+    if self._closed:
+      future.set_exception(RuntimeError("WriteBehindQueue is closed"))
+      return False
+    return True
+
+
+  def _merged(self) -> _MergedWrites:
+    # Called with the condition held. The group new bumps and updates can join
+    if len(self._entries) > 0 and isinstance(self._entries[-1], _MergedWrites):
+      return self._entries[-1]
+    return self._new_merged()
+
+
+  def _new_merged(self) -> _MergedWrites:
+    merged = _MergedWrites()
+    self._entries.append(merged)
+    return merged
+
+
+  def _queued(self):
+    # Called with the condition held
+    self._pending_count += 1
+    if self._pending_count >= self._max_pending:
+      self._condition.notify()
+
+
+  def _run(self):
+    while True:
+      with self._condition:
+        self._condition.wait_for(
+          lambda: self._closed or len(self._flush_waiters) > 0 or self._pending_count >= self._max_pending,
+          timeout=self._interval)
+
+        entries,       self._entries       = self._entries, []
+        tables,        self._tables        = self._tables, set()
+        flush_waiters, self._flush_waiters = self._flush_waiters, []
+        self._pending_count = 0
+        self._in_flight = len(entries) > 0
+        closed = self._closed
+
+      error = None
+      if self._in_flight:
+        error = self._write_batch(entries, tables)
+        with self._condition:
+          self._in_flight = False
+      for waiter in flush_waiters:
+        if error is None:
+          waiter.set_result(True)
+        else:
+          waiter.set_exception(error)
+
+      if closed:
+        return
+
+
+  def _write_batch(self, entries, tables) -> Optional[Exception]:
+    # Returns the exception the batch failed with, None once it's committed
+    results : List[Tuple[List[Future], Any]] = []
+    with self._write_lock:
+      cursor = self._connection.cursor()
+      try:
+        cursor.execute("BEGIN")
+        for entry in entries:
+          if isinstance(entry, _MergedWrites):
+            self._write_merged(cursor, entry, results)
+          else:
+            self._write_operation(cursor, *entry, results)
+        self._connection.commit()
+
+      except Exception as e:
+        global_logger.error(f"WriteBehindQueue failed to write a batch: {e}")
+        self._connection.rollback()
+        for entry in entries:
+          for future in (entry.futures() if isinstance(entry, _MergedWrites) else [entry[1]]):
+            future.set_exception(e)
+        return e
+
+    if self._on_commit is not None:
+      merged = [entry for entry in entries if isinstance(entry, _MergedWrites)]
+      if len(merged) > 0:
+        tables.add("songs")
+      # Durations feed the playlist totals through a trigger
+      if any("duration" in columns for group in merged for columns, _ in group.song_updates.values()):
+        tables.add("playlists")
+      self._on_commit(tables)
+
+    for futures, result in results:
+      for future in futures:
+        future.set_result(result)
+
+
+  @staticmethod
+  def _write_merged(cursor : sqlite3.Cursor, merged : _MergedWrites, results : List[Tuple[List[Future], Any]]):
+    # One UPDATE per song, no matter how many times it got played since the last batch
+    for song_id, (plays, futures) in merged.play_counts.items():
+      cursor.execute("UPDATE songs SET play_count = play_count + ? WHERE id = ?", (plays[0], song_id))
+      results.append((futures, cursor.rowcount > 0))
+
+    for song_id, (columns, futures) in merged.song_updates.items():
+      set_clause = ", ".join(f"{column} = ?" for column in columns.keys())
+      cursor.execute(f"UPDATE songs SET {set_clause} WHERE id = ?", list(columns.values()) + [song_id])
+      results.append((futures, cursor.rowcount > 0))
+
+
+  @staticmethod
+  def _write_operation(cursor : sqlite3.Cursor, operation : WriteOperation, future : Future, results : List[Tuple[List[Future], Any]]):
+    # Each operation gets a savepoint, so one that fails doesn't take the whole batch with it
+    cursor.execute("SAVEPOINT write_behind_op")
+    try:
+      result = operation(cursor)
+      cursor.execute("RELEASE write_behind_op")
+    except sqlite3.IntegrityError as e:
+      global_logger.debug(f"WriteBehindQueue operation failed a constraint: {e}")
+      cursor.execute("ROLLBACK TO write_behind_op")
+      cursor.execute("RELEASE write_behind_op")
+      result = False
+    results.append(([future], result))
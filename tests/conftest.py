@@ -0,0 +1,17 @@
+import os
+import sys
+
+# The app runs from src/ and imports its modules by name, the tests do the same
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+
+import pytest
+
+
+@pytest.fixture
+def db(tmp_path):
+  """A fresh database, migrated to SCHEMA_VERSION"""
+  from database import DatabaseConnection
+  connection = DatabaseConnection(str(tmp_path / "library.db"))
+  yield connection
+  connection.close()
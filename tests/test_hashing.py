@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import soundfile as sf
+
+from hashing import hash_file
+from ingest import LibraryIngest
+
+
+def write_song(path, seconds : float = 0.1, value : float = 0.0):
+  sf.write(path, np.full((int(48000 * seconds), 2), value, dtype=np.float32), 48000)
+
+
+def cached_rows(db) -> int:
+  return db.get_connection().execute("SELECT COUNT(*) FROM hash_cache").fetchone()[0]
+
+
+def test_cache_is_keyed_by_device(db, tmp_path):
+  path = tmp_path / "a.wav"
+  write_song(path)
+  stat = os.stat(path)
+  key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+  db.cache_hashes([(stat.st_dev + 1, *key[1:], "full", "0" * 32)])
+
+  # Same inode, size, and mtime on another device isn't the same file
+  assert db.get_cached_hashes([key], "full") == {}
+  assert db.hasher.hash_file(str(path)) == hash_file(str(path))
+  assert db.get_cached_hashes([key], "full") == {key : hash_file(str(path))}
+
+
+def test_deleted_songs_leave_the_cache(db, tmp_path):
+  ingest = LibraryIngest(db)
+  for name, value in (("a.wav", 0.0), ("b.wav", 0.5)):
+    write_song(tmp_path / name, value=value)
+  ingest.ingest_directory(str(tmp_path))
+  assert cached_rows(db) == 2
+
+  os.remove(tmp_path / "a.wav")
+  assert ingest.rescan_directory(str(tmp_path))["removed"] == 1
+  assert cached_rows(db) == 1
+
+
+def test_deleting_a_song_leaves_the_cache(db, tmp_path):
+  write_song(tmp_path / "a.wav")
+  LibraryIngest(db).ingest_directory(str(tmp_path))
+  song_id = db.get_connection().execute("SELECT id FROM songs").fetchone()[0]
+  assert cached_rows(db) == 1
+
+  assert db.delete_song(song_id) is True
+  assert cached_rows(db) == 0
+
+
+def test_replaced_files_leave_the_cache(db, tmp_path):
+  ingest = LibraryIngest(db)
+  path = tmp_path / "a.wav"
+  write_song(path, value=0.0)
+  ingest.ingest_directory(str(tmp_path))
+
+  write_song(path, seconds=0.2, value=0.5)
+  assert ingest.rescan_directory(str(tmp_path))["updated"] == 1
+  assert cached_rows(db) == 1
+  assert db.get_connection().execute("SELECT file_hash FROM hash_cache").fetchone()[0] == hash_file(str(path))
@@ -0,0 +1,143 @@
+import pytest
+
+from match_cache import MatchCache
+
+
+DAY = 24 * 60 * 60
+
+
+class FakeClock:
+  def __init__(self, now : float = 1_000_000):
+    self.now = now
+
+  def __call__(self) -> float:
+    return self.now
+
+
+@pytest.fixture
+def clock():
+  return FakeClock()
+
+
+def metadata(track_id : str) -> dict:
+  return {"song_id" : track_id, "name" : f"Track {track_id}"}
+
+
+def put(cache : MatchCache, *track_ids : str):
+  cache.put_many([(track_id, f"https://music.youtube.com/watch?v={track_id}", metadata(track_id)) for track_id in track_ids])
+
+
+def cached_ids(db) -> set:
+  return {row[0] for row in db.get_connection().execute("SELECT track_id FROM spotify_matches")}
+
+
+def test_hit_returns_the_match(db, clock):
+  cache = MatchCache(db, clock=clock)
+  put(cache, "a")
+  assert cache.get("a") == ("https://music.youtube.com/watch?v=a", metadata("a"))
+  assert cache.get("missing") is None
+
+
+def test_entries_expire_after_the_ttl(db, clock):
+  cache = MatchCache(db, ttl=30 * DAY, clock=clock)
+  put(cache, "a")
+  clock.now += 30 * DAY - 1
+  assert cache.get("a") is not None
+  clock.now += 1
+  assert cache.get("a") is None
+
+  # Expired rows get dropped the next time anything is stored
+  put(cache, "b")
+  assert cached_ids(db) == {"b"}
+
+
+def test_hit_refreshes_last_used(db, clock):
+  cache = MatchCache(db, clock=clock)
+  put(cache, "a")
+  clock.now += 60
+  cache.get_many(["a"])
+  fetched_at, last_used = db.get_connection().execute(
+    "SELECT fetched_at, last_used FROM spotify_matches WHERE track_id = 'a'").fetchone()
+  assert (fetched_at, last_used) == (clock.now - 60, clock.now)
+
+
+def test_least_recently_used_get_evicted(db, clock):
+  cache = MatchCache(db, max_entries=2, clock=clock)
+  put(cache, "a")
+  clock.now += 1
+  put(cache, "b")
+  clock.now += 1
+  cache.get("a")  # b is now the least recently used one
+  clock.now += 1
+  put(cache, "c")
+  assert cached_ids(db) == {"a", "c"}
+
+
+def test_eviction_ties_go_to_the_oldest_fetch(db, clock):
+  cache = MatchCache(db, max_entries=2, clock=clock)
+  put(cache, "old")
+  clock.now += 1
+  put(cache, "new")
+  clock.now += 1
+  cache.get_many(["old", "new"])  # Same last_used for both
+  put(cache, "c")
+  assert cached_ids(db) == {"new", "c"}
+
+
+# ------ SpotifyDownloader against a local stand-in for spotdl ------
+
+class StubDownloader:
+  """Stands in for spotdl.Downloader, "downloads" every song to /music/<id>.opus"""
+  def __init__(self):
+    self.settings = {"output" : "/music"}
+    self.songs    = []
+
+  def download_song(self, song):
+    self.songs.append(song)
+    return song, f"/music/{song.song_id}.opus"
+
+
+def spotify_song(track_id : str, download_url : str | None = None):
+  from spotdl.types.song import Song
+  return Song(
+    name="Track", artists=["Artist"], artist="Artist", genres=[], disc_number=1, disc_count=1,
+    album_name="Album", album_artist="Artist", duration=180, year=2020, date="2020-01-01",
+    track_number=1, tracks_count=1, song_id=track_id, explicit=False, publisher="",
+    url=f"https://open.spotify.com/track/{track_id}", isrc=None, cover_url=None,
+    copyright_text=None, download_url=download_url)
+
+
+@pytest.fixture
+def spotify(db, clock, monkeypatch):
+  downloader = pytest.importorskip("downloader")
+  # Skips __init__, which wants Spotify credentials and builds the real spotdl Downloader
+  spotify = downloader.SpotifyDownloader.__new__(downloader.SpotifyDownloader)
+  spotify._downloader  = StubDownloader()
+  spotify._match_cache = MatchCache(db, clock=clock)
+
+  lookups = []
+  def from_url(url):
+    lookups.append(url)
+    return spotify_song(url.rsplit("/", 1)[-1])
+  monkeypatch.setattr(downloader.Song, "from_url", staticmethod(from_url))
+  spotify.lookups = lookups
+  return spotify
+
+
+def test_cached_song_skips_the_spotify_lookup(spotify):
+  url = "https://open.spotify.com/track/abc"
+  spotify._match_cache.put_many([("abc", "https://music.youtube.com/watch?v=xyz", spotify_song("abc").json)])
+
+  spotify.download_song_from_url(url)
+  assert spotify.lookups == []
+  assert spotify._downloader.songs[0].download_url == "https://music.youtube.com/watch?v=xyz"
+
+
+def test_uncached_song_gets_looked_up_and_remembered(spotify):
+  url = "https://open.spotify.com/track/abc"
+  # spotdl sets download_url once it found a match
+  spotify._downloader.download_song = lambda song : (setattr(song, "download_url", "https://youtu.be/found") or (song, "/music/abc.opus"))
+
+  spotify.download_song_from_url(url)
+  assert spotify.lookups == [url]
+  assert spotify._cached_song(url).download_url == "https://youtu.be/found"
@@ -0,0 +1,49 @@
+from play_queue import PlayQueue, songs_after, switch_delay
+
+
+def song(song_id : int) -> dict:
+  return {"id" : song_id, "file_path" : f"/music/{song_id}.wav", "user_title" : str(song_id)}
+
+
+def test_songs_after_returns_the_rest_in_order():
+  songs = [song(3), song(1), song(2), song(5)]
+  assert songs_after(songs, 1) == [(2, "/music/2.wav"), (5, "/music/5.wav")]
+  assert songs_after(songs, 5) == []
+
+
+def test_songs_after_unknown_song():
+  assert songs_after([song(1), song(2)], 7) == []
+
+
+def test_switch_delay_only_inside_the_window():
+  assert switch_delay(10_000, 5_000, window=300, lead=5) is None
+  assert switch_delay(10_000, 9_800, window=300, lead=5) == 195
+  assert switch_delay(10_000, 9_998, window=300, lead=5) == 0
+  # Past the end, or a duration that isn't known yet, is left to EndOfMedia
+  assert switch_delay(10_000, 10_000, window=300, lead=5) is None
+  assert switch_delay(0, 0, window=300, lead=5) is None
+
+
+def test_play_queue_skips_the_current_song():
+  queue = PlayQueue(exists=lambda path : True)
+  queue.set_songs([(1, "a"), (2, "b"), (3, "c")], current_id=1)
+  assert queue.pop() == (2, "b")
+  assert queue.peek() == (3, "c")
+  assert queue.pop() == (3, "c")
+  assert queue.pop() is None
+  assert len(queue) == 0
+
+
+def test_play_queue_drops_missing_files():
+  queue = PlayQueue(exists=lambda path : path != "gone")
+  queue.set_songs([(2, "gone"), (3, "c")], current_id=1)
+  assert queue.peek() == (3, "c")
+  assert len(queue) == 1
+
+
+def test_play_queue_set_songs_replaces_the_queue():
+  queue = PlayQueue(exists=lambda path : True)
+  queue.set_songs([(2, "b"), (3, "c")], current_id=1)
+  queue.set_songs([(5, "e")], current_id=4)
+  assert queue.pop() == (5, "e")
+  assert queue.peek() is None
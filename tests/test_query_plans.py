@@ -0,0 +1,30 @@
+import sqlite3
+
+from database import DatabaseConnection
+from migrations import SCHEMA_VERSION, get_schema_version, migrate
+
+
+def test_hot_queries_use_an_index(db):
+  assert get_schema_version(db.get_connection()) == SCHEMA_VERSION
+  assert db.check_query_plans() == {}
+
+
+def test_full_scans_get_reported(db):
+  # No index on user_note, so this one has to scan the whole table
+  db._HOT_QUERIES = dict(DatabaseConnection._HOT_QUERIES, by_note=("SELECT id FROM songs WHERE user_note = ?", ("",)))
+  offenders = db.check_query_plans()
+  assert list(offenders) == ["by_note"]
+  assert any(step.startswith("SCAN ") for step in offenders["by_note"])
+
+
+def test_migrating_an_empty_database(tmp_path):
+  path = tmp_path / "empty.db"
+  connection = sqlite3.connect(path)
+  assert migrate(connection) == (0, SCHEMA_VERSION)
+  connection.close()
+
+  db = DatabaseConnection(str(path))
+  try:
+    assert db.check_query_plans() == {}
+  finally:
+    db.close()
@@ -0,0 +1,71 @@
+import sqlite3
+import threading
+
+import pytest
+
+from write_queue import WriteBehindQueue
+
+
+@pytest.fixture
+def queue():
+  connection = sqlite3.connect(":memory:", check_same_thread=False)
+  connection.execute("CREATE TABLE songs (id INTEGER PRIMARY KEY, play_count INTEGER DEFAULT 0)")
+  connection.execute("INSERT INTO songs (id) VALUES (1)")
+  connection.commit()
+  queue = WriteBehindQueue(connection, threading.Lock(), interval=60)
+  yield queue
+  queue.close()
+  connection.close()
+
+
+def test_flush_resolves_once_committed(queue):
+  write = queue.increment_play_count(1)
+  assert queue.flush().result(timeout=5) is True
+  assert write.result(timeout=5) is True
+
+
+def test_flush_raises_when_the_batch_failed(queue):
+  def broken(cursor):
+    raise sqlite3.OperationalError("disk I/O error")
+  write = queue.submit(broken)
+  flushed = queue.flush()
+  with pytest.raises(sqlite3.OperationalError):
+    flushed.result(timeout=5)
+  with pytest.raises(sqlite3.OperationalError):
+    write.result(timeout=5)
+
+
+def test_writes_apply_in_submission_order(queue):
+  # The operation reads what the update before it wrote, and the update after it overwrites that
+  seen = []
+  def read_count(cursor):
+    seen.append(cursor.execute("SELECT play_count FROM songs WHERE id = 1").fetchone()[0])
+    return True
+  queue.update_song(1, {"play_count": 5})
+  queue.submit(read_count)
+  queue.update_song(1, {"play_count": 7})
+  queue.flush().result(timeout=5)
+  assert seen == [5]
+  assert queue._connection.execute("SELECT play_count FROM songs WHERE id = 1").fetchone()[0] == 7
+
+
+def test_play_count_set_after_bumps_wins(queue):
+  queue.increment_play_count(1)
+  queue.update_song(1, {"play_count": 0})
+  queue.increment_play_count(1)
+  queue.flush().result(timeout=5)
+  assert queue._connection.execute("SELECT play_count FROM songs WHERE id = 1").fetchone()[0] == 1
+
+
+def test_writes_after_close_fail(queue):
+  queue.close()
+  with pytest.raises(RuntimeError, match="closed"):
+    queue.increment_play_count(1).result(timeout=5)
+  with pytest.raises(RuntimeError, match="closed"):
+    queue.submit(lambda cursor: True).result(timeout=5)
+
+
+def test_database_writes_after_close_fail(db):
+  db.close()
+  with pytest.raises(RuntimeError, match="closed"):
+    db.increment_play_count(1).result(timeout=5)